@@ -3,42 +3,48 @@ import openpyxl as px
 from django.utils.timezone import localtime
 
 from yoyaku.accounts.models import User
-from yoyaku.booking.models import Booking
-
-
-def get_customers_xl():
-    """顧客一覧のエクセルファイルを作成し返す"""
-    wb = px.Workbook()
-    ws = wb.active
-    ws.title = '顧客データ'
-
-    customers = User.customers.all()
-
-    # 1行目の項目名を出力
-    header = ['顧客id', '名前', 'フリガナ', 'メールアドレス', '電話番号', 'LINE名', '年齢', '年代',
-              '職業', '郵便番号', '住所', '作業可能時間', '副業経験', 'お問い合わせ内容', 'メモ1', 'メモ2', '削除フラグ', '作成日時']
-    ws.append(header)
-
-    #  顧客情報を書き出す
-    output_fields = ['id', 'username', 'furigana', 'email', 'phone_number', 'linename', 'age', 'ages', 'job',
-                     'zip_code', 'zip', 'workable_time', 'side_business_experience', 'contact', 'memo1', 'memo2', 'is_active', 'date_joined']
-    for r, customer in enumerate(customers, 2):
-        for c, field in enumerate(output_fields, 1):
-            value = getattr(customer, field)
-            if field == 'ages':
-                value = str(value) if value else ''
-            if field == 'date_joined':
-                localized_dt = localtime(value)
-                value = localized_dt.strftime('%Y-%m-%d %H:%M')
-            ws.cell(row=r, column=c).value = value
-
-    # 2列目に列を挿入し、顧客の予約があればスタッフ名を2列目に書き出す
-    STAFF_COL = 2
-    ws.insert_cols(STAFF_COL)
-    ws.cell(row=1, column=STAFF_COL).value = 'スタッフ'
-    for r, customer in enumerate(customers, 2):
-        booking = Booking.objects.filter(customer=customer.id)
-        if len(booking) == 1:
-            ws.cell(row=r, column=2).value = booking[0].get_staff_name()
-
-    return wb
+
+# 1行目の項目名
+HEADER = ['顧客id', 'スタッフ', '名前', 'フリガナ', 'メールアドレス', '電話番号', 'LINE名', '年齢', '年代',
+          '職業', '郵便番号', '住所', '作業可能時間', '副業経験', 'お問い合わせ内容', 'メモ1', 'メモ2', '削除フラグ', '作成日時']
+
+# 書き出す顧客情報。スタッフ名は予約とスタッフを結合して取得する
+OUTPUT_FIELDS = ['id', 'booking__id', 'booking__staff__username', 'username', 'furigana', 'email', 'phone_number',
+                 'linename', 'age', 'ages__name', 'job', 'zip_code', 'zip', 'workable_time', 'side_business_experience',
+                 'contact', 'memo1', 'memo2', 'is_active', 'date_joined']
+
+CHUNK_SIZE = 2000
+
+
+def iter_customer_rows(chunk_size=CHUNK_SIZE):
+    """
+    顧客一覧の行を1行ずつ返す。
+    顧客・予約・スタッフ・年代を結合した1回のクエリをchunk_size件ずつ読み込み、全件をメモリに載せない。
+    スタッフは予約がある場合のみ書き出し、予約のスタッフが未定義の場合は'未定義'にする。
+    """
+    rows = (
+        User.customers.order_by('id')
+        .values_list(*OUTPUT_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    # 予約id、スタッフ名を除いた位置
+    ages_index = OUTPUT_FIELDS.index('ages__name') - 3
+    for (customer_id, booking_id, staff_name, *values, date_joined) in rows:
+        if booking_id is not None:
+            staff_name = staff_name or '未定義'
+        values[ages_index] = values[ages_index] or ''
+        yield [customer_id, staff_name, *values, localtime(date_joined).strftime('%Y-%m-%d %H:%M')]
+
+
+def write_customers_xl(file, chunk_size=CHUNK_SIZE):
+    """
+    顧客一覧のエクセルファイルを書き出す。
+    書き込み専用モードで1行ずつ書き出すため、顧客数によらずメモリの使用量は一定になる。
+    file: ファイル名またはファイルオブジェクト
+    """
+    wb = px.Workbook(write_only=True)
+    ws = wb.create_sheet('顧客データ')
+    ws.append(HEADER)
+    for row in iter_customer_rows(chunk_size):
+        ws.append(row)
+    wb.save(file)
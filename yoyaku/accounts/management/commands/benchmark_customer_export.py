@@ -0,0 +1,85 @@
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from yoyaku.accounts.excel_export_service import write_customers_xl
+from yoyaku.accounts.models import User
+from yoyaku.booking.models import Booking, BookingLimit
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = '顧客一覧のエクセルファイルの書き出しの処理時間とメモリ使用量を計測する。作成した顧客はロールバックする'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--rows', type=int, nargs='+', default=[10000, 100000, 300000], help='顧客数')
+        parser.add_argument('-b', '--batch-size', type=int, default=5000, help='顧客を一度に作成する数')
+        parser.add_argument('--memory', action='store_true', help='メモリ使用量のピークも計測する。計測中は処理が遅くなる')
+
+    def handle(self, *args, **options):
+        for rows in options['rows']:
+            try:
+                with transaction.atomic():
+                    self.create_customers(rows, options['batch_size'])
+                    result = self.measure()
+                    if options['memory']:
+                        result['peak'] = self.measure_peak_memory()
+                    raise Rollback
+            except Rollback:
+                pass
+
+            message = (
+                f"rows={rows} elapsed={result['elapsed']:.2f}s queries={result['queries']} "
+                f"size={result['size'] / 1024 / 1024:.1f}MB"
+            )
+            if options['memory']:
+                message += f" peak_memory={result['peak'] / 1024 / 1024:.1f}MB"
+            self.stdout.write(message)
+
+    def create_customers(self, rows, batch_size):
+        """顧客を作成し、10人に1人は予約を作成する"""
+        bl = BookingLimit.objects.create(limit=rows, start_datetime=timezone.now() + timezone.timedelta(days=3650))
+        for start in range(0, rows, batch_size):
+            customers = User.objects.bulk_create([
+                User(
+                    user_id=f'benchmark{i}',
+                    username=f'ベンチマーク{i}',
+                    email=f'benchmark{i}@example.com',
+                    furigana='ベンチマーク',
+                    phone_number=f'9{i:010}',
+                    job='会社員',
+                    age=30,
+                )
+                for i in range(start, min(start + batch_size, rows))
+            ])
+            Booking.objects.bulk_create([
+                Booking(customer=customer, booking_limit=bl) for customer in customers[::10]
+            ])
+
+    def measure(self):
+        """書き出しの処理時間とクエリ数、ファイルサイズを返す"""
+        # DEBUG=Trueの場合に顧客の作成時のクエリが記録されているため、削除してから計測する
+        reset_queries()
+        with tempfile.TemporaryFile() as file, CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            write_customers_xl(file)
+            elapsed = time.perf_counter() - started
+            return {'elapsed': elapsed, 'queries': len(queries), 'size': file.tell()}
+
+    def measure_peak_memory(self):
+        """書き出し中に確保したメモリのピークを返す"""
+        with tempfile.TemporaryFile() as file:
+            tracemalloc.start()
+            try:
+                write_customers_xl(file)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
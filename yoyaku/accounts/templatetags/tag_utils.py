@@ -27,19 +27,3 @@ def days_since_filter(value):
         return f'{delta.days}日'
     except (ValueError, TypeError):
         return ''
-
-
-@register.filter
-def get_usernames(update_staff_form_list, i):
-    """
-    UpdateStaffFormのリストから指定したインデックスの
-    選択可能な担当スタッフ名のリストを取得
-    {{ update_staff_form_list|get_usernames:x }}
-
-    update_staff_form_list: UpdateStaffFormのリスト
-    i : UpdateStaffFormのリストのインデックス番号
-
-    return str 選択可能なスタッフ名のリスト html形式
-    """
-
-    return update_staff_form_list[i]['staff']
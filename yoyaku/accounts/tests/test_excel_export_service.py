@@ -1,9 +1,12 @@
+from io import BytesIO
+
+import openpyxl as px
 from django.test import TestCase
 from django.utils.timezone import localtime
 
 from yoyaku.accounts.models import Ages
-from yoyaku.accounts.excel_export_service import get_customers_xl
-from yoyaku.tests.factories import BookingFactory, CustomerFactory, StaffFactory, SuperUserFactory
+from yoyaku.accounts.excel_export_service import write_customers_xl
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, CustomerFactory, StaffFactory, SuperUserFactory
 
 
 class TestExcelExportService(TestCase):
@@ -31,16 +34,24 @@ class TestExcelExportService(TestCase):
             memo1='メモ1',
             memo2='メモ2',
         )
-        self.booking = BookingFactory(customer=self.customer, staff=self.staff)
+        self.booking = BookingFactory(
+            customer=self.customer, staff=self.staff, booking_limit=BookingLimitFactory(limit=10)
+        )
+
+    def write_customers_xl(self, **kwargs):
+        file = BytesIO()
+        write_customers_xl(file, **kwargs)
+        file.seek(0)
+        return px.load_workbook(file)
 
-    def test_get_customers_xl(self):
+    def test_write_customers_xl(self):
         header = ['顧客id', 'スタッフ', '名前', 'フリガナ', 'メールアドレス', '電話番号', 'LINE名', '年齢', '年代',
                   '職業', '郵便番号', '住所', '作業可能時間', '副業経験', 'お問い合わせ内容', 'メモ1',
                   'メモ2', '削除フラグ', '作成日時']
         output_fields = ['id', 'staff', 'username', 'furigana', 'email', 'phone_number', 'linename', 'age', 'ages', 'job',
                          'zip_code', 'zip', 'workable_time', 'side_business_experience', 'contact', 'memo1', 'memo2',
                          'is_active', 'date_joined']
-        wb = get_customers_xl()
+        wb = self.write_customers_xl()
         ws = wb.active
         self.assertEqual(ws.title, '顧客データ')
 
@@ -64,3 +75,19 @@ class TestExcelExportService(TestCase):
         # customerは1人のため、３行目にデータはない
         for c, field in enumerate(output_fields, 1):
             self.assertIsNone(ws.cell(row=3, column=c).value)
+
+    def test_staff_name(self):
+        """予約がない顧客のスタッフは空欄、予約のスタッフが未定義の場合は未定義"""
+        no_booking = CustomerFactory()
+        BookingFactory(staff=None, booking_limit=self.booking.booking_limit)
+        ws = self.write_customers_xl(chunk_size=1).active
+        staff_names = [row[1] for row in ws.iter_rows(min_row=2, values_only=True)]
+        self.assertEqual(staff_names, [self.booking.get_staff_name(), None, '未定義'])
+        self.assertEqual(ws.cell(row=3, column=1).value, no_booking.id)
+
+    def test_constant_queries(self):
+        """顧客数によらず1回のクエリで書き出す"""
+        for _ in range(3):
+            BookingFactory(booking_limit=self.booking.booking_limit)
+        with self.assertNumQueries(1):
+            write_customers_xl(BytesIO(), chunk_size=2)
@@ -1,13 +1,18 @@
 import urllib.parse
+from io import BytesIO
+from unittest.mock import patch
 
 import factory
+import openpyxl as px
 from django.conf import settings
+from django.core.cache import cache
 from django.test import override_settings
 from django.urls import reverse, reverse_lazy
 
 from yoyaku.accounts.models import User
 from yoyaku.accounts.forms import StaffForm, CustomerForm, CustomerSearchForm
 from yoyaku.booking.models import Booking
+from yoyaku.core.pagination import encode_cursor
 from yoyaku.tests.factories import StaffFactory, CustomerFactory, BookingFactory
 from yoyaku.tests.test_case import AuthViewTestCase
 
@@ -184,6 +189,7 @@ class TestCustomerListView(AuthViewTestCase):
         return super().setUpTestData()
 
     def setUp(self):
+        cache.clear()
         self.login()
         self.viewname = 'accounts:顧客一覧'
 
@@ -267,6 +273,33 @@ class TestCustomerListView(AuthViewTestCase):
                 query_str = f'page=1&page_size={settings.PER_PAGE_SET[0]}&amp;{key}={value}'
                 self.assertContains(res, query_str)
 
+    @override_settings(APPROXIMATE_COUNT_THRESHOLD=2)
+    def test_get_approximate_count(self):
+        with patch('yoyaku.core.pagination.can_estimate', return_value=True), \
+                patch('yoyaku.core.pagination.estimate_count', return_value=1000):
+            res = self.client.get(reverse(self.viewname))
+        self.assertContains(res, '一覧： 約1000 件')
+
+    @override_settings(PER_PAGE_SET=[2, 3, 4], CURSOR_PAGINATION=True)
+    def test_cursor_pagination(self):
+        """カーソルでページ送りする場合も検索条件と表示数を引き継ぐ"""
+        res = self.client.get(reverse(self.viewname), {'email': 'example.com'})
+        self.assertEqual(res.context['page_obj'].object_list, self.customer_list[:0:-1])
+        next_cursor = res.context['page_obj'].next_cursor()
+        self.assertContains(res, f'cursor={next_cursor}&page_size=2&amp;email=example.com')
+
+        res = self.client.get(reverse(self.viewname), {'cursor': next_cursor, 'page_size': 2, 'email': 'example.com'})
+        self.assertEqual(res.context['page_obj'].object_list, self.customer_list[:1])
+        self.assertFalse(res.context['page_obj'].has_next())
+
+        res = self.client.get(reverse(self.viewname), {'cursor': 'a'})
+        self.assertEqual(res.status_code, 404)
+        # 並び順の項目の型に変換できない値
+        for values in ([{}], ['abc'], [None]):
+            with self.subTest(values=values):
+                res = self.client.get(reverse(self.viewname), {'cursor': encode_cursor(values)})
+                self.assertEqual(res.status_code, 404)
+
 
 class TestCustomerDetailView(AuthViewTestCase):
 
@@ -418,6 +451,10 @@ class TestCustomerListDownload(AuthViewTestCase):
         res = self.client.post(reverse(self.viewname))
         self.assertEqual(res.status_code, 200)
         self.assertEqual(res.headers['Content-Type'], 'application/ms-excel')
+        self.assertTrue(res.streaming)
+        content = b''.join(res.streaming_content)
+        self.assertEqual(int(res.headers['Content-Length']), len(content))
+        self.assertEqual(px.load_workbook(BytesIO(content)).active.title, '顧客データ')
 
         filename = '顧客一括データ.xls'
         quoted_filename = urllib.parse.quote(filename)
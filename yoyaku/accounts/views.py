@@ -1,11 +1,13 @@
+import tempfile
 import urllib.parse
+from wsgiref.util import FileWrapper
 
 from django.conf import settings
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_POST
@@ -16,7 +18,8 @@ from django.views.generic.list import ListView
 from yoyaku.accounts.forms import CustomerForm, CustomerSearchForm
 from yoyaku.accounts.models import User
 from yoyaku.accounts.forms import StaffForm
-from yoyaku.accounts.excel_export_service import get_customers_xl
+from yoyaku.accounts.excel_export_service import write_customers_xl
+from yoyaku.core.pagination import CachedCountPaginator, CursorPaginationMixin
 from yoyaku.core.utils import clean_page_size
 
 
@@ -88,7 +91,7 @@ class StaffDeleteView(DeleteView):
 
 
 @method_decorator(login_required, name='dispatch')
-class CustomerListView(ListView):
+class CustomerListView(CursorPaginationMixin, ListView):
     """
     検索条件にマッチした管理者以外のスタッフを表示する。
     最初は管理者以外のスタッフを全件表示する。
@@ -106,8 +109,10 @@ class CustomerListView(ListView):
     model = User
     form_class = CustomerSearchForm
     ordering = '-id'
+    cursor_ordering = ['-id']
     queryset = User.customers.is_active().select_related('booking__booking_limit', 'booking__staff')
     paginate_by = settings.PER_PAGE_SET[0]
+    paginator_class = CachedCountPaginator
     template_name = 'accounts/customer_list.html'
 
     def get_search_str(self, data):
@@ -216,6 +221,7 @@ class CustomerDeleteView(DeleteView):
 def customer_list_download(request):
     """
     エクセルファイルに顧客の全データを書き出しダウンロードする
+    一時ファイルに書き出し、一定のサイズずつ返すことでメモリの使用量を抑えている。
     quote()でファイル名に日本語を使えるようにしている。
     """
     if not request.user.is_superuser:
@@ -223,8 +229,12 @@ def customer_list_download(request):
 
     filename = '顧客一括データ.xls'
     quoted_filename = urllib.parse.quote(filename)
-    xl = get_customers_xl()
-    response = HttpResponse(content_type='application/ms-excel')
+    file = tempfile.TemporaryFile()
+    write_customers_xl(file)
+    size = file.tell()
+    file.seek(0)
+    # FileWrapperはレスポンスの送信後に一時ファイルを閉じる
+    response = StreamingHttpResponse(FileWrapper(file, 64 * 1024), content_type='application/ms-excel')
+    response['Content-Length'] = size
     response['Content-Disposition'] = f"attachment; filename='{quoted_filename}'; filename*=UTF-8''{quoted_filename}"
-    xl.save(response)
     return response
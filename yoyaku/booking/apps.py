@@ -5,3 +5,6 @@ class BookingConfig(AppConfig):
     name = 'yoyaku.booking'
     label = 'booking'
     verbose_name = 'Yoyaku Booking'
+
+    def ready(self):
+        from yoyaku.booking import signals  # noqa: F401
@@ -0,0 +1,115 @@
+from datetime import datetime, time, timedelta
+from math import ceil
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import localdate, make_aware, now
+
+from yoyaku.booking import virtual_slots
+from yoyaku.booking.models import BookingLimit, DailyOccupancy, SeatHold
+from yoyaku.booking.utils import date_range
+
+KEY_PREFIX = 'availability'
+HITS_KEY = f'{KEY_PREFIX}:hits'
+MISSES_KEY = f'{KEY_PREFIX}:misses'
+
+# キャッシュする予約枠の項目
+SLOT_FIELDS = ('id', 'start_datetime', 'limit', 'booked_count', 'state')
+
+
+def _get_key(day):
+    return f'{KEY_PREFIX}:{day.isoformat()}'
+
+
+def _incr(key, delta):
+    if not delta:
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, delta)
+
+
+def _fetch_slots(start_date, end_date):
+    """
+    DBから開始日〜終了日(含まない)の予約枠を取得し、日付をキーにした辞書で返す
+    仮想予約枠を使う場合は、予約枠がない時間枠に仮想予約枠を追加する
+    """
+    start = make_aware(datetime.combine(start_date, time()))
+    end = make_aware(datetime.combine(end_date, time()))
+    # 取得する期間の期限切れの一時確保は予約数から除いてから取得する
+    SeatHold.objects.sweep(start_datetime=start, end_datetime=end)
+    result = {}
+    bl_list = BookingLimit.objects.with_state(start_datetime__gte=start, start_datetime__lt=end).values(*SLOT_FIELDS)
+    for bl in bl_list:
+        result.setdefault(localdate(bl['start_datetime']), []).append(bl)
+    if virtual_slots.is_enabled():
+        virtual_slots.fill(result, start_date, end_date)
+    return result
+
+
+def _get_timeout(start_date, end_date):
+    """
+    開始日〜終了日(含まない)の予約枠をキャッシュする秒数を返す。
+    一時確保がある場合は、期限切れになった一時確保を解放して取得し直せるように最も早い有効期限までにする。
+    """
+    next_expiry = SeatHold.objects.get_next_expiry(
+        make_aware(datetime.combine(start_date, time())), make_aware(datetime.combine(end_date, time())))
+    if next_expiry is None:
+        return settings.AVAILABILITY_CACHE_TIMEOUT
+    return max(1, min(settings.AVAILABILITY_CACHE_TIMEOUT, ceil((next_expiry - now()).total_seconds())))
+
+
+def get_slots(start_date, end_date):
+    """
+    開始日〜終了日(含まない)の予約枠と状態の辞書のリストを開始日時順に返す。
+    日毎にキャッシュし、キャッシュにない日のみDBから取得する。
+    start_date: datetime.date 開始日
+    end_date: datetime.date 終了日
+    """
+    days = list(date_range(start_date, end_date - timedelta(days=1)))
+    keys = [_get_key(d) for d in days]
+    slots_by_key = cache.get_many(keys)
+    missing_days = [d for d, key in zip(days, keys) if key not in slots_by_key]
+    _incr(HITS_KEY, len(days) - len(missing_days))
+    _incr(MISSES_KEY, len(missing_days))
+
+    if missing_days:
+        fetch_end = missing_days[-1] + timedelta(days=1)
+        fetched = _fetch_slots(missing_days[0], fetch_end)
+        new_slots = {_get_key(d): fetched.get(d, []) for d in missing_days}
+        cache.set_many(new_slots, _get_timeout(missing_days[0], fetch_end))
+        slots_by_key.update(new_slots)
+
+    return [slot for key in keys for slot in slots_by_key[key]]
+
+
+def invalidate(datetimes):
+    """
+    指定した日時を含む日のキャッシュを削除し、コミット後に日毎の集計を更新する。
+    コミット前に別のリクエストが古いデータをキャッシュする場合があるため、コミット後にも削除する。
+    datetimes: datetime型のリスト
+    """
+    days = {localdate(dt) for dt in datetimes if dt}
+    if not days:
+        return
+    keys = [_get_key(d) for d in days]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+    transaction.on_commit(lambda: DailyOccupancy.objects.refresh(days))
+
+
+def invalidate_booking_limits(pk_list):
+    """指定した予約枠の日のキャッシュを削除する"""
+    invalidate(BookingLimit.objects.filter(pk__in=pk_list).values_list('start_datetime', flat=True))
+
+
+def get_stats():
+    """キャッシュのヒット数とミス数を返す"""
+    stats = cache.get_many([HITS_KEY, MISSES_KEY])
+    return {
+        'hits': stats.get(HITS_KEY, 0),
+        'misses': stats.get(MISSES_KEY, 0),
+    }
@@ -1,14 +1,17 @@
 import copy
 import re
 from datetime import datetime, time, timedelta
+from itertools import islice
 
 from django import forms
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.utils.timezone import make_aware, now
+from django.db import connection, transaction
+from django.utils.timezone import localdate, localtime, make_aware, now
 
 from yoyaku.accounts.models import User
-from yoyaku.booking.models import Booking, BookingLimit
+from yoyaku.booking import availability_cache, virtual_slots
+from yoyaku.booking.models import Booking, BookingLimit, DailyOccupancy, SeatHold
 from yoyaku.booking.utils import date_range, get_today0000, is_valid_booking_time, get_time_frames, get_start_times
 
 
@@ -24,6 +27,9 @@ def copy_boolean_field(copied, label):
 
 
 class BookingLimitEditForm(forms.ModelForm):
+    # save()で一度に作成・更新する予約枠の数
+    batch_size = 1000
+
     # 画面側でチェックを入れると全てのtimeにチェックされるため、clean()やsave()では利用しない
     time_all = forms.BooleanField(
         label='全て',
@@ -73,13 +79,26 @@ class BookingLimitEditForm(forms.ModelForm):
             self.add_error('start_datetime', ValidationError('開始日は終了日より前にしてください。', code='out_of_date'))
             return
 
-        start_dt_list = [start_dt for start_dt in self.iterate_checked_frame(data)]
-        bl_list = BookingLimit.objects.prefetch_related('bookings').filter(start_datetime__in=start_dt_list)
-        for bl in bl_list:
-            if data['limit'] < bl.bookings.count():
+        if 'limit' not in data:
+            return
+
+        # 予約数が変更後の枠数を上回る予約枠のみ取得し、チェックされた時間帯のものがあればエラーにする
+        checked_times = set(self.get_checked_times(data))
+        overflow_dt_list = (
+            BookingLimit.objects
+            .filter(
+                start_datetime__gte=data['start_datetime'],
+                start_datetime__lt=data['end_datetime'] + timedelta(days=1),
+                booked_count__gt=data['limit'],
+            )
+            .order_by('start_datetime')
+            .values_list('start_datetime', flat=True)
+        )
+        for start_dt in overflow_dt_list:
+            if localtime(start_dt).time() in checked_times:
                 raise ValidationError(
                     '開始日時%(value)sの枠数が予約数を下回っていたため変更できませんでした。',
-                    params={'value': bl.start_datetime.strftime('%Y-%m-%d %H:%M')},
+                    params={'value': localtime(start_dt).strftime('%Y-%m-%d %H:%M')},
                     code='booking_overflow',
                 )
 
@@ -89,26 +108,30 @@ class BookingLimitEditForm(forms.ModelForm):
         予約枠が存在する日時は枠数を更新する
         """
         data = self.cleaned_data
-        # 作成・更新する日時のリストを作成
-        start_dt_list = [start_dt for start_dt in self.iterate_checked_frame(data)]
-        # 更新対象を抽出
-        update_bl_list = BookingLimit.objects.filter(start_datetime__in=start_dt_list)
-
-        # 更新対象の予約枠数の変更と、作成対象を抽出
-        for bl in update_bl_list:
-            bl.limit = data['limit']
-            start_dt_list.remove(bl.start_datetime)
-
-        create_bl_list = [
-            BookingLimit(limit=data['limit'], start_datetime=dt)
-            for dt in start_dt_list
-        ]
-        BookingLimit.objects.bulk_update(update_bl_list, fields=['limit'])
-        BookingLimit.objects.bulk_create(create_bl_list)
+        frames = self.iterate_checked_frame(data)
+        # MySQLは重複を判定する列を指定できず、一意制約のある列で判定する
+        unique_fields = ['start_datetime'] if connection.features.supports_update_conflicts_with_target else None
+        with transaction.atomic():
+            # 開始日時が重複する予約枠は枠数のみ更新する。一度に大量のデータを作らないように分割する
+            while True:
+                bl_list = [
+                    BookingLimit(limit=data['limit'], start_datetime=dt)
+                    for dt in islice(frames, self.batch_size)
+                ]
+                if not bl_list:
+                    break
+                BookingLimit.objects.bulk_create(
+                    bl_list,
+                    update_conflicts=True,
+                    unique_fields=unique_fields,
+                    update_fields=['limit'],
+                )
+            # bulk_create()はシグナルが送信されないため、変更期間のキャッシュを削除する
+            availability_cache.invalidate(date_range(data['start_datetime'], data['end_datetime']))
 
-    def iterate_checked_frame(self, data):
+    def get_checked_times(self, data):
         """
-        変更期間内のチェックされている日時のデータを返すイテレーター
+        チェックされている時間のリストを返す
         data: フォームで入力されたデータ
         """
         checked_time_list = []
@@ -117,7 +140,14 @@ class BookingLimitEditForm(forms.ModelForm):
             if m and data[key]:
                 time_str = m.groups()[0]
                 checked_time_list.append(time(int(time_str[:2]), int(time_str[2:])))
+        return checked_time_list
 
+    def iterate_checked_frame(self, data):
+        """
+        変更期間内のチェックされている日時のデータを返すイテレーター
+        data: フォームで入力されたデータ
+        """
+        checked_time_list = self.get_checked_times(data)
         for d in date_range(data['start_datetime'], data['end_datetime']):
             for t in checked_time_list:
                 yield make_aware(datetime.combine(d, t))
@@ -201,13 +231,10 @@ class BookingSearchForm(forms.Form):
         if not from_datetime or not to_dateitme:
             return result
 
-        limit_total = sum(
-            BookingLimit.objects
-            .filter(start_datetime__gte=from_datetime, start_datetime__lt=to_dateitme)
-            .values_list('limit', flat=True)
-        )
-
         to_dateitme -= timedelta(days=1)  # filter用に1日増加した分を減らす
+        # 予約枠数は日毎の集計から合計する
+        limit_total = DailyOccupancy.objects.get_totals(localdate(from_datetime), localdate(to_dateitme))['total_limit']
+
         result += f"{from_datetime.strftime('%Y-%m-%d')} ~ {to_dateitme.strftime('%Y-%m-%d')}"
 
         staff = self.cleaned_data.get('staff')
@@ -299,7 +326,7 @@ class BookingForm(forms.ModelForm):
                 )
                 return
             # 予約枠がある場合は満席かチェックをする
-            bl_list = BookingLimit.objects.prefetch_related('bookings').filter(start_datetime=start_datetime)
+            bl_list = BookingLimit.objects.filter(start_datetime=start_datetime)
             if bl_list.exists() and self._is_filled(bl_list[0]):
                 self.add_booking_filled_error(start_datetime)
 
@@ -316,10 +343,14 @@ class BookingForm(forms.ModelForm):
             obj.booking_limit = self.cleaned_data['booking_limit']
         else:
             # カレンダーから指定した予約枠がない場合、BookingLimitを作成する
-            bl, created = BookingLimit.objects.get_or_create(
-                start_datetime=self.cleaned_data['start_datetime'],
-                defaults={'limit': 1},
-            )
+            # 仮想予約枠の場合は仮想予約枠の枠数で作成する
+            start_datetime = self.cleaned_data['start_datetime']
+            bl = virtual_slots.materialize(start_datetime)
+            if bl is None:
+                bl, created = BookingLimit.objects.get_or_create(
+                    start_datetime=start_datetime,
+                    defaults={'limit': 1},
+                )
             obj.booking_limit = bl
 
         obj.updated_by = updated_by
@@ -327,21 +358,10 @@ class BookingForm(forms.ModelForm):
         return obj
 
 
-class UpdateStaffForm(forms.Form):
-    """スタッフを更新するためのフォーム"""
-    staff = forms.ChoiceField(
-        choices=[],
-        widget=forms.Select(attrs={'class': 'form-control select-staff'}),
-    )
-
-    def __init__(self, choices, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # 選択肢をセットする
-        self.fields['staff'].choices = choices
-
-
 class RegisterBookingForm(forms.Form):
     """LPページで予約日時を設定するためのフォーム"""
+    # 予約枠の選択時に一時確保した際のトークン。booking_limitの検証で使うため先に定義する
+    seat_hold = forms.CharField(widget=forms.HiddenInput, required=False, max_length=32)
     booking_limit = forms.IntegerField(
         widget=forms.HiddenInput(
             attrs={
@@ -355,20 +375,22 @@ class RegisterBookingForm(forms.Form):
         },
     )
 
+    def get_filled_error(self):
+        return ValidationError('ご希望の予約日時は満席になりました。他の日時を選択してください。', code='filled')
+
     def clean_booking_limit(self):
 
         booking_limit_id = self.cleaned_data['booking_limit']
 
         try:
-            bl = BookingLimit.objects.select_for_update().get(id=booking_limit_id)
+            bl = BookingLimit.objects.get(id=booking_limit_id)
         except BookingLimit.DoesNotExist:
             raise ValidationError('予約枠を確保できませんでした。他の予約枠を選択してください。', code='invalid_choice')
 
-        if bl.is_filled():
-            raise ValidationError(
-                'ご希望の予約日時は満席になりました。他の日時を選択してください。',
-                code='filled',
-            )
+        # 満席かどうかの最終的な判定はsave()で予約数を加算する時に行う
+        # 予約枠を一時確保している場合は、確保した席が予約数に含まれているため満席でも予約できる
+        if bl.is_filled() and not self.has_seat_hold(bl):
+            raise self.get_filled_error()
         elif bl.start_datetime < now()+timedelta(minutes=60):
             raise ValidationError(
                 '予約日時が現在時刻より１時間未満のため予約できませんでした。他の希望日時を選択してください。',
@@ -377,6 +399,22 @@ class RegisterBookingForm(forms.Form):
 
         return booking_limit_id
 
+    def has_seat_hold(self, booking_limit):
+        token = self.cleaned_data.get('seat_hold')
+        return bool(token) and SeatHold.objects.filter(token=token, booking_limit=booking_limit).exists()
+
     def save(self, customer):
-        bl = BookingLimit.objects.get(id=self.cleaned_data['booking_limit'])
-        return Booking.objects.create(booking_limit=bl, customer=customer)
+        """
+        予約枠を一時確保している場合はその席で、していない場合は予約数を加算できた場合のみ予約を作成する。
+        満席だった場合はフォームにエラーを追加してNoneを返す。
+        """
+        booking_limit_id = self.cleaned_data['booking_limit']
+        token = self.cleaned_data.get('seat_hold')
+        is_held = bool(token) and SeatHold.objects.claim(token, booking_limit_id)
+        if not is_held and not BookingLimit.objects.reserve_seat(booking_limit_id):
+            self.add_error('booking_limit', self.get_filled_error())
+            return None
+
+        booking = Booking(booking_limit_id=booking_limit_id, customer=customer)
+        booking.save(seat_reserved=True)
+        return booking
@@ -0,0 +1,46 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import localdate
+
+from yoyaku.accounts.models import User
+from yoyaku.booking.staff_assignment import BATCH_SIZE, auto_assign_staff
+
+
+class Command(BaseCommand):
+    help = '担当スタッフが未定義の予約に、有効なスタッフを担当件数が均等になるように割り当てる'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=date.fromisoformat, help='開始日 YYYY-MM-DD 省略時は当日')
+        parser.add_argument('--to', dest='to_date', type=date.fromisoformat, help='終了日 YYYY-MM-DD 省略時は開始日')
+        parser.add_argument('-u', '--updated-by', help='更新者として記録するスタッフのユーザID')
+        parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help='割り当て結果を表示し、更新しない')
+
+    def handle(self, *args, **options):
+        start_date = options['from_date'] or localdate()
+        end_date = options['to_date'] or start_date
+        if end_date < start_date:
+            raise CommandError('終了日は開始日以降を指定してください。')
+        updated_by = None
+        if options['updated_by']:
+            updated_by = User.staffs.filter(user_id=options['updated_by']).first()
+            if updated_by is None:
+                raise CommandError(f"ユーザID {options['updated_by']} のスタッフが存在しません。")
+
+        result = auto_assign_staff(
+            start_date, end_date + timedelta(days=1), updated_by=updated_by, dry_run=options['dry_run'],
+            batch_size=options['batch_size'],
+        )
+
+        if options['dry_run'] or options['verbosity'] > 1:
+            usernames = dict(User.staffs.filter(id__in=result.loads).values_list('id', 'username'))
+            for staff_id, load in sorted(result.loads.items(), key=lambda item: (-item[1], item[0])):
+                self.stdout.write(f'{usernames.get(staff_id, staff_id)}: {load} 件')
+
+        verb = '割り当てます' if options['dry_run'] else '割り当てました'
+        self.stdout.write(f'{start_date} 〜 {end_date} の予約 {len(result.assignments)} 件にスタッフを{verb}。')
+        if result.skipped:
+            self.stdout.write(f'スタッフが足りず {result.skipped} 件は割り当てられませんでした。')
+        if result.conflicts:
+            self.stdout.write(f'他のスタッフにより変更されたため {len(result.conflicts)} 件は更新しませんでした。')
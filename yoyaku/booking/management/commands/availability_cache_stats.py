@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from yoyaku.booking import availability_cache
+
+
+class Command(BaseCommand):
+    help = '予約枠の空き状況のキャッシュのヒット数とミス数を表示する'
+
+    def handle(self, *args, **options):
+        stats = availability_cache.get_stats()
+        total = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / total * 100 if total else 0
+        self.stdout.write(f"hits={stats['hits']} misses={stats['misses']} hit_rate={hit_rate:.1f}%")
@@ -0,0 +1,62 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import localdate
+
+from yoyaku.booking.forms import BookingLimitEditForm
+from yoyaku.booking.utils import get_start_times
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = '予約枠の一括編集で全ての時間帯を変更した場合の処理時間を計測する。変更内容はロールバックする'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-m', '--months', type=int, nargs='+', default=[1, 6, 12], help='変更する期間(月)')
+
+    def handle(self, *args, **options):
+        for months in options['months']:
+            start = localdate() + timedelta(days=1)
+            end = start + timedelta(days=30 * months - 1)
+            data = {
+                'start_datetime': start.isoformat(),
+                'end_datetime': end.isoformat(),
+                'limit': 3,
+            }
+            data.update({f'time{t}'.replace(':', ''): True for t in get_start_times()})
+
+            try:
+                with transaction.atomic():
+                    # 1回目は予約枠の作成、2回目は更新になる
+                    created = self.measure(data)
+                    updated = self.measure(data)
+                    raise Rollback
+            except Rollback:
+                pass
+
+            self.stdout.write(
+                f'months={months} frames={created["frames"]} '
+                f'create={created["elapsed"]:.2f}s({created["queries"]} queries) '
+                f'update={updated["elapsed"]:.2f}s({updated["queries"]} queries)'
+            )
+
+    def measure(self, data):
+        """フォームの検証と保存の処理時間とクエリ数を返す"""
+        form = BookingLimitEditForm(data)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            if not form.is_valid():
+                raise ValueError(form.errors)
+            form.save()
+            elapsed = time.perf_counter() - started
+        return {
+            'frames': sum(1 for _ in form.iterate_checked_frame(form.cleaned_data)),
+            'elapsed': elapsed,
+            'queries': len(queries),
+        }
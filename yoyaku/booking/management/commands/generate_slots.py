@@ -0,0 +1,61 @@
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from django.utils.timezone import localdate, make_aware
+
+from yoyaku.booking import availability_cache
+from yoyaku.booking.models import BookingLimit, ScheduleTemplate
+from yoyaku.booking.utils import date_range
+
+
+def to_datetime(d):
+    return make_aware(datetime.combine(d, time()))
+
+
+class Command(BaseCommand):
+    help = 'テンプレートから指定した期間の予約枠を作成する。作成済みの予約枠は変更しない'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=date.fromisoformat, help='開始日 YYYY-MM-DD 省略時は翌日')
+        parser.add_argument('-d', '--days', type=int, default=90, help='作成する日数')
+        parser.add_argument('-b', '--batch-size', type=int, default=1000)
+        parser.add_argument('--resume', action='store_true', help='期間内の最後の予約枠の日から作成を再開する')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('日数は1以上を指定してください。')
+
+        start_date = options['from_date'] or localdate() + timedelta(days=1)
+        end_date = start_date + timedelta(days=options['days'] - 1)
+        if options['resume']:
+            start_date = self.get_resume_date(start_date, end_date)
+
+        frames = ScheduleTemplate.objects.iterate_frames(start_date, end_date)
+        total = 0
+        while True:
+            # 予約枠を一定数ずつ作成し、作成済みの予約枠は無視する。中断しても再実行できる
+            bl_list = [
+                BookingLimit(start_datetime=start_dt, limit=limit)
+                for start_dt, limit in islice(frames, options['batch_size'])
+            ]
+            if not bl_list:
+                break
+            BookingLimit.objects.bulk_create(bl_list, ignore_conflicts=True)
+            total += len(bl_list)
+            self.stdout.write(f'{localdate(bl_list[-1].start_datetime)} までの予約枠を処理しました。')
+
+        # bulk_create()はシグナルが送信されないため、作成期間のキャッシュを削除する
+        availability_cache.invalidate([to_datetime(d) for d in date_range(start_date, end_date)])
+        self.stdout.write(f'{start_date} 〜 {end_date} の予約枠 {total} 件を処理しました。')
+
+    def get_resume_date(self, start_date, end_date):
+        """期間内の最後の予約枠の日を返す。予約枠がない場合は開始日"""
+        latest = (
+            BookingLimit.objects
+            .filter(start_datetime__gte=to_datetime(start_date),
+                    start_datetime__lt=to_datetime(end_date + timedelta(days=1)))
+            .aggregate(latest=Max('start_datetime'))['latest']
+        )
+        return localdate(latest) if latest else start_date
@@ -0,0 +1,132 @@
+import statistics
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Count, Max
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils.timezone import now
+
+from yoyaku.accounts.models import User
+from yoyaku.booking.models import BookingLimit
+
+
+class Command(BaseCommand):
+    help = '予約フォームに同時に予約を送信し、処理性能と予約枠数を超える予約がないことを確認する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--requests', type=int, default=200, help='送信する予約の数')
+        parser.add_argument('-c', '--concurrency', type=int, default=20, help='同時に送信するスレッド数')
+        parser.add_argument('-s', '--slots', type=int, default=1, help='作成する予約枠の数')
+        parser.add_argument('-l', '--limit', type=int, default=10, help='予約枠の枠数')
+        parser.add_argument('--keep', action='store_true', help='作成した予約枠と顧客を削除しない')
+
+    def handle(self, *args, **options):
+        self.run_id = int(time.time())
+        bl_list = self.create_booking_limits(options['slots'], options['limit'])
+        requests = [self.get_post_data(i, bl_list[i % len(bl_list)]) for i in range(options['requests'])]
+
+        # テスト用のメールバックエンドを使い、testserverへのリクエストを許可する
+        try:
+            setup_test_environment()
+            is_setup = True
+        except RuntimeError:
+            is_setup = False
+
+        # 順番待ちの整理券や入場数を本番のキャッシュに書き込まないように、順番待ちを無効にする
+        try:
+            started = time.perf_counter()
+            with override_settings(WAITING_ROOM_CAPACITY=None), \
+                    ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                results = list(executor.map(self.post, requests))
+            elapsed = time.perf_counter() - started
+        finally:
+            if is_setup:
+                teardown_test_environment()
+
+        self.report(results, elapsed)
+        overbooked = self.verify(bl_list)
+        if not options['keep']:
+            self.cleanup(bl_list)
+
+        if overbooked:
+            raise CommandError(f'予約枠数を超えて予約された予約枠があります。 id={overbooked}')
+
+    def create_booking_limits(self, count, limit):
+        """既存の予約枠と重ならないように、最後の予約枠の翌日以降に予約枠を作成する"""
+        latest = BookingLimit.objects.aggregate(latest=Max('start_datetime'))['latest']
+        start = max(latest or now(), now()).replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+        return [
+            BookingLimit.objects.create(limit=limit, start_datetime=start + timedelta(minutes=30 * i))
+            for i in range(count)
+        ]
+
+    def get_post_data(self, i, booking_limit):
+        return {
+            'username': 'ろーどてすと',
+            'furigana': 'ロードテスト',
+            'email': f'loadtest{self.run_id}-{i}@example.com',
+            'age': 30,
+            'job': '会社員',
+            'phone_number': f'9{self.run_id % 10000:04}{i:06}',
+            'booking_limit': booking_limit.id,
+        }
+
+    def post(self, data):
+        """
+        予約を1件送信し、結果と処理時間を返す
+        結果 booked: 予約完了 rejected: フォームエラー lock_error: ロック待ちによるエラー error: その他のエラー
+        """
+        client = Client()
+        started = time.perf_counter()
+        try:
+            res = client.post(reverse('lp:予約フォーム'), data)
+            result = 'booked' if res.status_code == 302 else 'rejected'
+        except OperationalError as e:
+            result = 'lock_error' if 'lock' in str(e).lower() else 'error'
+        except Exception:
+            result = 'error'
+        finally:
+            connection.close()
+        return result, time.perf_counter() - started
+
+    def report(self, results, elapsed):
+        counter = Counter(result for result, _ in results)
+        latencies = sorted(latency * 1000 for _, latency in results)
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(latencies, n=100)
+            p50, p95, p99 = quantiles[49], quantiles[94], quantiles[98]
+        else:
+            p50 = p95 = p99 = latencies[0] if latencies else 0
+
+        self.stdout.write(f'requests={len(results)} elapsed={elapsed:.2f}s throughput={len(results) / elapsed:.1f}req/s')
+        self.stdout.write(f'latency p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms max={max(latencies, default=0):.1f}ms')
+        self.stdout.write(
+            f"booked={counter['booked']} rejected={counter['rejected']} "
+            f"lock_error={counter['lock_error']} error={counter['error']}"
+        )
+
+    def verify(self, bl_list):
+        """予約枠数を超える予約がある予約枠のidのリストを返す"""
+        bl_list = (
+            BookingLimit.objects.filter(id__in=[bl.id for bl in bl_list])
+            .annotate(actual_count=Count('bookings'))
+            .values('id', 'limit', 'booked_count', 'actual_count')
+        )
+        overbooked = []
+        for bl in bl_list:
+            self.stdout.write(
+                f"id={bl['id']} limit={bl['limit']} bookings={bl['actual_count']} booked_count={bl['booked_count']}"
+            )
+            if bl['limit'] < bl['actual_count']:
+                overbooked.append(bl['id'])
+        return overbooked
+
+    def cleanup(self, bl_list):
+        User.customers.filter(email__startswith=f'loadtest{self.run_id}-').delete()
+        BookingLimit.objects.filter(id__in=[bl.id for bl in bl_list]).delete()
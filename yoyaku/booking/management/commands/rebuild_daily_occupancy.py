@@ -0,0 +1,36 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from django.utils.timezone import localdate
+
+from yoyaku.booking.models import BookingLimit, DailyOccupancy
+from yoyaku.booking.utils import date_range
+
+
+class Command(BaseCommand):
+    help = '予約枠から日毎の予約状況の集計を作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=date.fromisoformat, help='開始日 YYYY-MM-DD')
+        parser.add_argument('--to', dest='to_date', type=date.fromisoformat, help='終了日 YYYY-MM-DD')
+        parser.add_argument('-d', '--days', type=int, default=31, help='一度に集計する日数')
+
+    def handle(self, *args, **options):
+        period = BookingLimit.objects.aggregate(first=Min('start_datetime'), last=Max('start_datetime'))
+        if not period['first'] and not (options['from_date'] and options['to_date']):
+            self.stdout.write('予約枠がありません。')
+            return
+
+        start_date = options['from_date'] or localdate(period['first'])
+        end_date = options['to_date'] or localdate(period['last'])
+        # 予約枠がない日も0件で保存し直すため、集計を削除せずに上書きする
+        count = 0
+        chunk_start = start_date
+        while chunk_start <= end_date:
+            chunk_end = min(chunk_start + timedelta(days=options['days'] - 1), end_date)
+            DailyOccupancy.objects.refresh(date_range(chunk_start, chunk_end))
+            count += (chunk_end - chunk_start).days + 1
+            chunk_start = chunk_end + timedelta(days=1)
+
+        self.stdout.write(f'{start_date} 〜 {end_date} の {count} 日分を集計しました。')
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from yoyaku.booking import availability_cache
+from yoyaku.booking.models import BookingLimit
+
+
+class Command(BaseCommand):
+    help = '予約枠の予約数を予約と一時確保の件数から集計し直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        checked = fixed = 0
+        while True:
+            pk_list = list(
+                BookingLimit.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not pk_list:
+                break
+            last_id = pk_list[-1]
+            checked += len(pk_list)
+
+            # 予約数がずれている予約枠のみ集計し直す
+            drifted_ids = list(
+                BookingLimit.objects.with_actual_count()
+                .filter(id__in=pk_list)
+                .exclude(booked_count=F('actual_count'))
+                .values_list('id', flat=True)
+            )
+            if drifted_ids:
+                with transaction.atomic():
+                    fixed += BookingLimit.objects.recount_booked_count(drifted_ids)
+                    availability_cache.invalidate_booking_limits(drifted_ids)
+
+        self.stdout.write(f'予約枠 {checked} 件中 {fixed} 件の予約数を修正しました。')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from yoyaku.booking.models import SeatHold
+
+
+class Command(BaseCommand):
+    help = '期限切れの予約枠の一時確保を解放する'
+
+    def handle(self, *args, **options):
+        released = SeatHold.objects.sweep()
+        self.stdout.write(f'{released} 件の一時確保を解放しました。')
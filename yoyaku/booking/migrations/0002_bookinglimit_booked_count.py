@@ -0,0 +1,34 @@
+# Generated by Django 4.1 on 2026-10-18 13:20
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def set_booked_count(apps, schema_editor):
+    """既存の予約枠の予約数を集計する"""
+    Booking = apps.get_model('booking', 'Booking')
+    BookingLimit = apps.get_model('booking', 'BookingLimit')
+    counts = (
+        Booking.objects.filter(booking_limit=OuterRef('pk'))
+        .values('booking_limit')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    BookingLimit.objects.update(booked_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookinglimit',
+            name='booked_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='予約数'),
+        ),
+        migrations.RunPython(set_booked_count, migrations.RunPython.noop),
+    ]
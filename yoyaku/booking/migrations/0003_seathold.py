@@ -0,0 +1,25 @@
+# Generated by Django 4.1 on 2026-10-18 13:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0002_bookinglimit_booked_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeatHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32, unique=True, verbose_name='トークン')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='有効期限')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日時')),
+                ('booking_limit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='seat_holds', to='booking.bookinglimit')),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.1 on 2026-10-18 13:44
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0003_seathold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True, verbose_name='日付')),
+                ('start_time', models.TimeField(blank=True, null=True, verbose_name='開始時間')),
+                ('reason', models.CharField(blank=True, max_length=255, verbose_name='理由')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日時')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScheduleTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, '月'), (1, '火'), (2, '水'), (3, '木'), (4, '金'), (5, '土'), (6, '日')], verbose_name='曜日')),
+                ('start_time', models.TimeField(verbose_name='開始時間')),
+                ('limit', models.PositiveIntegerField(verbose_name='予約枠数')),
+                ('valid_from', models.DateField(blank=True, null=True, verbose_name='適用開始日')),
+                ('valid_to', models.DateField(blank=True, null=True, verbose_name='適用終了日')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日時')),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1 on 2026-10-18 13:52
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def create_daily_occupancies(apps, schema_editor):
+    """既存の予約枠から日毎の予約状況を集計する"""
+    BookingLimit = apps.get_model('booking', 'BookingLimit')
+    DailyOccupancy = apps.get_model('booking', 'DailyOccupancy')
+    state_fields = {'●': 'available_count', '▲': 'few_count', '×': 'filled_count'}
+    occupancies = {}
+    bl_list = BookingLimit.objects.with_state().values_list('start_datetime', 'limit', 'booked_count', 'state')
+    for start_datetime, limit, booked_count, state in bl_list.iterator():
+        d = django.utils.timezone.localdate(start_datetime)
+        occupancy = occupancies.setdefault(d, DailyOccupancy(date=d))
+        occupancy.total_limit += limit
+        occupancy.total_booked += booked_count
+        field = state_fields[state]
+        setattr(occupancy, field, getattr(occupancy, field) + 1)
+    DailyOccupancy.objects.bulk_create(occupancies.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0004_scheduletemplate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyOccupancy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True, verbose_name='日付')),
+                ('total_limit', models.PositiveIntegerField(default=0, verbose_name='予約枠数合計')),
+                ('total_booked', models.PositiveIntegerField(default=0, verbose_name='予約数合計')),
+                ('available_count', models.PositiveIntegerField(default=0, verbose_name='予約可の予約枠数')),
+                ('few_count', models.PositiveIntegerField(default=0, verbose_name='残席わずかの予約枠数')),
+                ('filled_count', models.PositiveIntegerField(default=0, verbose_name='予約不可の予約枠数')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='更新日時')),
+            ],
+        ),
+        migrations.RunPython(create_daily_occupancies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-18 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0006_booking_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seathold',
+            name='session_key',
+            field=models.CharField(db_index=True, default='', max_length=40, verbose_name='セッションキー'),
+            preserve_default=False,
+        ),
+    ]
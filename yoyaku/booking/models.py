@@ -1,35 +1,113 @@
-from django.db import models
+import uuid
+from datetime import datetime
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, Exists, F, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from yoyaku.accounts.models import User
+from yoyaku.booking.utils import date_range
 
 
 class BookingLimitManager(models.Manager):
     use_in_migrations = True
 
-    def can_book(self, include=None):
+    def can_book(self, include=None, days=None):
         """
         予約可能な予約枠のリストを取得する。
         現在時刻以降の予約枠が空いている予約枠のリストを取得する
+        include: 満員でも含めるBookingLimitオブジェクト
+        days: 指定した場合は現在時刻からdays日後までの予約枠に絞る
         """
         start = timezone.now()
         where = {'start_datetime__gte': start}
+        if days is not None:
+            where['start_datetime__lt'] = start + timezone.timedelta(days=days)
 
-        bl_list = self.prefetch_related('bookings').filter(**where).order_by('start_datetime')
-        possible_ids = {bl.id for bl in bl_list if not bl.is_filled()}
+        condition = Q(booked_count__lt=F('limit'))
         if include:
-            possible_ids.add(include.id)
-        return bl_list.filter(id__in=possible_ids)
+            condition |= Q(id=include.id)
+        return self.filter(condition, **where).order_by('start_datetime')
+
+    def with_state(self, **where):
+        """
+        予約枠に残り枠数(rest)と状態(state)をDBで計算して付与したクエリセットを返す。
+        状態の判定はBookingLimit.get_state()と同じ。
+        where: 予約枠の検索条件
+        """
+        return (
+            self.filter(**where)
+            .order_by('start_datetime')
+            .alias(booked_count_200=F('booked_count') * 200)
+            .annotate(
+                rest=Case(
+                    When(booked_count__gte=F('limit'), then=Value(0)),
+                    default=F('limit') - F('booked_count'),
+                    output_field=models.IntegerField(),
+                ),
+                state=Case(
+                    When(booked_count__gte=F('limit'), then=Value('×')),
+                    When(Q(limit__lte=3) & Q(limit__lte=F('booked_count') + 1), then=Value('▲')),
+                    When(limit__in=(4, 5), limit__lte=F('booked_count') + 2, then=Value('▲')),
+                    # (残り枠数/枠数+0.005) < 0.3 を整数で計算する
+                    When(limit__gte=6, booked_count_200__gt=F('limit') * 141, then=Value('▲')),
+                    default=Value('●'),
+                    output_field=models.CharField(),
+                ),
+            )
+        )
+
+    def add_booked_count(self, pk, amount):
+        """
+        予約数をamountだけ増減する。
+        同時に更新されても数がずれないようにDB上で加算する。予約数は0未満にしない。
+        """
+        qs = self.filter(pk=pk)
+        if amount < 0:
+            qs = qs.filter(booked_count__gte=-amount)
+        return qs.update(booked_count=F('booked_count') + amount)
 
-    def customers_can_select(self, after_min):
+    def reserve_seat(self, pk):
         """
-        現在時刻から'after_min'分後以降の予約枠リストと状態を返す。満員含む。
+        予約枠に空きがある場合のみ予約数を1加算する。
+        空きの確認と加算を1つのUPDATE文で行うため、同時に予約されても枠数を超えない。
+        満席の場合は期限切れの一時確保を解放してから確保し直す。
+        return: 予約数を加算できた場合はTrue、満席か予約枠が存在しない場合はFalse
         """
-        start_datetime = timezone.now() + timezone.timedelta(minutes=after_min)
-        where = {'start_datetime__gte': start_datetime}
-        bl_list = self.prefetch_related('bookings').filter(**where).order_by('start_datetime')
-        return bl_list
+        def reserve():
+            return bool(self.filter(pk=pk, booked_count__lt=F('limit')).update(booked_count=F('booked_count') + 1))
+
+        return reserve() or (bool(SeatHold.objects.sweep(booking_limit_id=pk)) and reserve())
+
+    def with_actual_count(self):
+        """予約の件数と一時確保の件数の合計(actual_count)を付与したクエリセットを返す"""
+        return self.annotate(actual_count=_count_bookings_and_holds())
+
+    def recount_booked_count(self, pk_list):
+        """
+        指定した予約枠の予約数を予約と一時確保の件数から集計し直す。
+        pk_list: 予約枠のidのリスト
+        """
+        return self.filter(pk__in=pk_list).update(booked_count=_count_bookings_and_holds())
+
+
+def _count_bookings_and_holds():
+    """予約枠毎の予約と一時確保の件数の合計を求める式"""
+    def count(model):
+        counts = (
+            model.objects.filter(booking_limit=OuterRef('pk'))
+            .values('booking_limit')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        return Coalesce(Subquery(counts), 0)
+
+    return count(Booking) + count(SeatHold)
 
 
 class BookingLimit(models.Model):
@@ -38,9 +116,23 @@ class BookingLimit(models.Model):
     start_datetime = models.DateTimeField(_('開始日時'), unique=True)
     end_datetime = models.DateTimeField(_('終了日時'), null=True, blank=True)
     created_at = models.DateTimeField(_('作成日時'), default=timezone.now)
+    # 予約数。Bookingの作成・削除・予約枠の変更時に更新する。SeatHoldによる一時確保も含む
+    booked_count = models.PositiveIntegerField(_('予約数'), default=0)
 
     objects = BookingLimitManager()
 
+    def save(self, *args, **kwargs):
+        """
+        予約数は予約・一時確保の変更時にDB上で加算するため、更新時は保存しない。
+        読み込み後に予約された場合に、読み込み時の予約数で上書きしないようにする。
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'booked_count'
+            ]
+        super().save(*args, **kwargs)
+
     def formatted_start_datetime(self):
         format = '%Y年%m月%d日 %H時%M分'
         localized_dt = timezone.localtime(self.start_datetime)
@@ -61,16 +153,11 @@ class BookingLimit(models.Model):
         exclude: 予約数から除外するBookingオブジェクト。
         予約の更新時に予約に紐付くBookingLimitが満員でもエラーにしない様にしている。
         """
-        if exclude:
-            return self.limit <= self.bookings.exclude(id=exclude.id).count()
+        if exclude and exclude.booking_limit_id == self.id:
+            return self.limit <= self.booked_count - 1
 
         return self.limit <= self.booked_count
 
-    @property
-    def booked_count(self):
-        """予約数を返す"""
-        return self.bookings.count()
-
     def get_state(self):
         """
         残りの枠数から状態（●、▲、×）を判定する
@@ -94,9 +181,85 @@ class BookingLimit(models.Model):
             return '●'
 
 
+class BookingManager(models.Manager):
+
+    def assign_staff(self, booking_id, version, staff_id, updated_by):
+        """
+        予約の担当スタッフを1回のUPDATEで変更し、版数を1加算する。
+        読み込み時から版数が変わっている場合や、スタッフが無効な場合は更新しない。
+        version: 読み込み時の予約の版数
+        staff_id: 担当スタッフのid 未定義にする場合はNone
+        return: 更新した件数
+        """
+        qs = self.filter(id=booking_id, version=version)
+        if staff_id is not None:
+            qs = qs.filter(Exists(User.staffs.filter(id=staff_id, is_active=True)))
+        return qs.update(
+            staff_id=staff_id,
+            updated_by=updated_by,
+            updated_at=timezone.now(),
+            version=F('version') + 1,
+        )
+
+    def filter_versions(self, rows):
+        """
+        予約idと版数の組のいずれかに一致する予約のクエリセットを返す
+        rows: (予約id, 版数)のリスト
+        """
+        return self.filter(reduce(or_, (Q(id=booking_id, version=version) for booking_id, version in rows)))
+
+    def bulk_assign_staff(self, assignments, updated_by, batch_size=500):
+        """
+        複数の予約の担当スタッフを1つのトランザクションで変更し、版数を1加算する。
+        スタッフの確認は1回のクエリで行い、スタッフ毎に予約idと読み込み時の版数が一致する予約のみ1回のUPDATEで更新する。
+        assignments: (予約id, 読み込み時の版数, スタッフid)のリスト 未定義にする場合はスタッフidをNone
+        batch_size: 1回のUPDATEで更新する予約の最大件数
+        return: (更新した予約idと更新後の版数の辞書, 更新できなかった予約idのリスト)
+        """
+        staff_ids = {staff_id for _, _, staff_id in assignments if staff_id is not None}
+        active_staff_ids = set(User.staffs.is_active().filter(id__in=staff_ids).values_list('id', flat=True))
+        rows_by_staff = {}
+        rejected = set()
+        seen = set()
+        for i, (booking_id, version, staff_id) in enumerate(assignments):
+            # 同じ予約が複数回指定された場合は、2回目以降を競合とする
+            if booking_id in seen or (staff_id is not None and staff_id not in active_staff_ids):
+                rejected.add(i)
+            else:
+                rows_by_staff.setdefault(staff_id, []).append((booking_id, version))
+            seen.add(booking_id)
+
+        updated = {}
+        updated_at = timezone.now()
+        with transaction.atomic():
+            for staff_id, rows in rows_by_staff.items():
+                for start in range(0, len(rows), batch_size):
+                    batch = rows[start:start + batch_size]
+                    count = self.filter_versions(batch).update(
+                        staff_id=staff_id,
+                        updated_by=updated_by,
+                        updated_at=updated_at,
+                        version=F('version') + 1,
+                    )
+                    if count < len(batch):
+                        # 版数が変わっていた予約を除くため、更新後の版数と更新日時で更新できた予約を特定する
+                        matched = set(
+                            self.filter_versions([(booking_id, version + 1) for booking_id, version in batch])
+                            .filter(updated_at=updated_at)
+                            .values_list('id', flat=True)
+                        )
+                        batch = [(booking_id, version) for booking_id, version in batch if booking_id in matched]
+                    updated.update((booking_id, version + 1) for booking_id, version in batch)
+        conflicts = [
+            booking_id for i, (booking_id, _, _) in enumerate(assignments) if i in rejected or booking_id not in updated
+        ]
+        return updated, list(dict.fromkeys(conflicts))
+
+
 class Booking(models.Model):
     """
     予約のモデル
+    version: 版数 更新の度に1加算し、他ユーザによる更新の検出に使う
     """
     customer = models.OneToOneField(User, on_delete=models.CASCADE)
     booking_limit = models.ForeignKey(BookingLimit, on_delete=models.CASCADE, related_name='bookings')
@@ -104,27 +267,281 @@ class Booking(models.Model):
     updated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='updated_bookings')
     updated_at = models.DateTimeField(_('更新日時'), auto_now=True)
     created_at = models.DateTimeField(_('作成日時'), default=timezone.now)
+    version = models.PositiveIntegerField(_('版数'), default=1)
+
+    objects = BookingManager()
 
     def __repr__(self):
         return f'id={self.id}, 予約枠={self.booking_limit_id},顧客ID={self.customer_id} スタッフID={self.staff_id}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 予約枠の変更を検出するため、読み込み時の予約枠を保持する
+        if 'booking_limit_id' in instance.__dict__:
+            instance._loaded_booking_limit_id = instance.booking_limit_id
+        return instance
+
+    def save(self, *args, seat_reserved=False, **kwargs):
+        """
+        予約の作成時と予約枠の変更時に、予約枠の予約数を同じトランザクション内で更新する
+        seat_reserved: BookingLimitManager.reserve_seat()で予約数を加算済みの場合はTrue
+        """
+        adding = self._state.adding
+        loaded_booking_limit_id = getattr(self, '_loaded_booking_limit_id', None)
+        if not adding:
+            self.version += 1
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                if not seat_reserved:
+                    BookingLimit.objects.add_booked_count(self.booking_limit_id, 1)
+            elif loaded_booking_limit_id and loaded_booking_limit_id != self.booking_limit_id:
+                BookingLimit.objects.add_booked_count(loaded_booking_limit_id, -1)
+                BookingLimit.objects.add_booked_count(self.booking_limit_id, 1)
+        self._loaded_booking_limit_id = self.booking_limit_id
+
     def get_staff_name(self):
         return self.staff.username if self.staff else '未定義'
 
     def get_start_datetime(self):
         return self.booking_limit.start_datetime
 
-    def is_updated_by_others(self, dt, requestuser):
+
+class SeatHoldManager(models.Manager):
+
+    def hold(self, booking_limit_id, session_key):
+        """
+        予約枠に空きがある場合は一時確保し、予約数を1加算する。
+        満席の場合や予約枠が存在しない場合はNoneを返す。
+        session_key: 顧客のセッションキー。1つのセッションで一時確保できるのは1つの予約枠のみのため、
+        前に一時確保していた予約枠は解放してから確保する。
         """
-        指定日時以降に別のユーザによって更新されたかどうか
-        dt: 指定日時 datetime
-        requestuser: 更新者 accounts.model.User
+        with transaction.atomic():
+            for token in self.filter(session_key=session_key).values_list('token', flat=True):
+                self.release(token)
+            if not BookingLimit.objects.reserve_seat(booking_limit_id):
+                return None
+            expires_at = timezone.now() + timezone.timedelta(minutes=settings.SEAT_HOLD_MINUTES)
+            return self.create(
+                booking_limit_id=booking_limit_id, session_key=session_key, token=uuid.uuid4().hex,
+                expires_at=expires_at,
+            )
 
-        return
-        True: 別のユーザにより更新された
-        False: 前回と同じ更新者、または指定日時以降誰も更新していない
+    def claim(self, token, booking_limit_id):
+        """
+        一時確保を予約に使うため削除する。予約数は予約に引き継ぐため減らさない。
+        期限切れでも解放される前であれば使用できる。
+        return: 一時確保を削除できた場合はTrue
         """
-        if requestuser != self.updated_by and dt < self.updated_at:
+        count, _ = self.filter(token=token, booking_limit_id=booking_limit_id).delete()
+        return bool(count)
+
+    def release(self, token):
+        """一時確保を削除し、予約数を1減らす"""
+        booking_limit_id = self.filter(token=token).values_list('booking_limit_id', flat=True).first()
+        if booking_limit_id and self.filter(token=token).delete()[0]:
+            BookingLimit.objects.add_booked_count(booking_limit_id, -1)
             return True
+        return False
+
+    def sweep(self, booking_limit_id=None, start_datetime=None, end_datetime=None):
+        """
+        期限切れの一時確保を削除し、予約枠の予約数を減らす。
+        booking_limit_id: 指定した場合はその予約枠の一時確保のみ対象にする
+        start_datetime, end_datetime: 指定した場合は開始日時〜終了日時(含まない)の予約枠の一時確保のみ対象にする
+        return: 削除した一時確保の件数
+        """
+        expired = self.filter(expires_at__lt=timezone.now())
+        if booking_limit_id:
+            expired = expired.filter(booking_limit_id=booking_limit_id)
+        if start_datetime and end_datetime:
+            expired = expired.filter(
+                booking_limit__start_datetime__gte=start_datetime, booking_limit__start_datetime__lt=end_datetime)
+
+        released = 0
+        for bl_id in set(expired.values_list('booking_limit_id', flat=True)):
+            # 同時に予約に使われた一時確保を除くため、予約枠毎に削除できた件数だけ減らす
+            count, _ = expired.filter(booking_limit_id=bl_id).delete()
+            if count:
+                BookingLimit.objects.add_booked_count(bl_id, -count)
+                released += count
+        return released
+
+    def get_next_expiry(self, start_datetime, end_datetime):
+        """開始日時〜終了日時(含まない)の予約枠の一時確保のうち、最も早い有効期限を返す。ない場合はNone"""
+        return self.filter(
+            booking_limit__start_datetime__gte=start_datetime, booking_limit__start_datetime__lt=end_datetime,
+        ).aggregate(next_expiry=Min('expires_at'))['next_expiry']
+
+
+class SeatHold(models.Model):
+    """
+    予約フォームの入力中に予約枠を一時確保するモデル
+    確保している間は予約枠の予約数に含める。
+    """
+    booking_limit = models.ForeignKey(BookingLimit, on_delete=models.CASCADE, related_name='seat_holds')
+    token = models.CharField(_('トークン'), max_length=32, unique=True)
+    session_key = models.CharField(_('セッションキー'), max_length=40, db_index=True)
+    expires_at = models.DateTimeField(_('有効期限'), db_index=True)
+    created_at = models.DateTimeField(_('作成日時'), default=timezone.now)
+
+    objects = SeatHoldManager()
+
+
+class ScheduleTemplateManager(models.Manager):
+
+    def iterate_frames(self, start_date, end_date):
+        """
+        開始日〜終了日の予約枠の開始日時と予約枠数を開始日時順に返すジェネレーター。
+        有効期間外のテンプレートと、休業日に該当する日時は除外する。
+        start_date: datetime.date 開始日
+        end_date: datetime.date 終了日
+        return: (datetime, int)
+        """
+        templates_by_weekday = {}
+        for template in self.order_by('start_time'):
+            templates_by_weekday.setdefault(template.weekday, []).append(template)
+
+        closed = ScheduleException.objects.filter(date__gte=start_date, date__lte=end_date)
+        closed_days = {e.date for e in closed if e.start_time is None}
+        closed_frames = {(e.date, e.start_time) for e in closed if e.start_time is not None}
+
+        for d in date_range(start_date, end_date):
+            if d in closed_days:
+                continue
+            for template in templates_by_weekday.get(d.weekday(), []):
+                if template.is_valid_on(d) and (d, template.start_time) not in closed_frames:
+                    yield timezone.make_aware(datetime.combine(d, template.start_time)), template.limit
+
+
+class ScheduleTemplate(models.Model):
+    """毎週の予約枠を作成するためのテンプレート"""
+    WEEKDAY_CHOICES = ((0, '月'), (1, '火'), (2, '水'), (3, '木'), (4, '金'), (5, '土'), (6, '日'))
+
+    weekday = models.PositiveSmallIntegerField(_('曜日'), choices=WEEKDAY_CHOICES)
+    start_time = models.TimeField(_('開始時間'))
+    limit = models.PositiveIntegerField(_('予約枠数'))
+    # 有効期間。未設定の場合は期限なし
+    valid_from = models.DateField(_('適用開始日'), null=True, blank=True)
+    valid_to = models.DateField(_('適用終了日'), null=True, blank=True)
+    created_at = models.DateTimeField(_('作成日時'), default=timezone.now)
+
+    objects = ScheduleTemplateManager()
+
+    def __str__(self):
+        return f'{self.get_weekday_display()} {self.start_time:%H:%M} 予約枠数：{self.limit}'
+
+    def is_valid_on(self, d):
+        """指定した日が有効期間内かどうか"""
+        return (self.valid_from is None or self.valid_from <= d) and (self.valid_to is None or d <= self.valid_to)
+
+
+class ScheduleException(models.Model):
+    """
+    テンプレートから予約枠を作成しない日時(休業日など)
+    start_timeが未設定の場合は終日作成しない。
+    """
+    date = models.DateField(_('日付'), db_index=True)
+    start_time = models.TimeField(_('開始時間'), null=True, blank=True)
+    reason = models.CharField(_('理由'), max_length=255, blank=True)
+    created_at = models.DateTimeField(_('作成日時'), default=timezone.now)
+
+    def __str__(self):
+        time_str = f'{self.start_time:%H:%M}' if self.start_time else '終日'
+        return f'{self.date} {time_str} {self.reason}'
+
+
+class DailyOccupancyManager(models.Manager):
+
+    def refresh(self, dates):
+        """
+        指定した日の予約枠から日毎の集計を作り直す。予約枠がない日は0件で保存する。
+        dates: datetime.dateのリスト
+        """
+        dates = sorted(set(dates))
+        if not dates:
+            return
+        occupancies = {d: DailyOccupancy(date=d) for d in dates}
+
+        # 連続する日付をまとめて、日付の範囲毎に予約枠を取得する
+        condition = Q()
+        for start_date, end_date in _group_consecutive_dates(dates):
+            condition |= Q(
+                start_datetime__gte=_start_of_day(start_date),
+                start_datetime__lt=_start_of_day(end_date + timezone.timedelta(days=1)),
+            )
+        bl_list = (
+            BookingLimit.objects.with_state()
+            .filter(condition)
+            .values('start_datetime', 'limit', 'booked_count', 'state')
+        )
+        for bl in bl_list:
+            occupancy = occupancies.get(timezone.localdate(bl['start_datetime']))
+            if occupancy:
+                occupancy.add(bl)
+
+        now = timezone.now()
+        for occupancy in occupancies.values():
+            occupancy.updated_at = now
+        # MySQLは重複を判定する列を指定できず、一意制約のある列で判定する
+        unique_fields = ['date'] if connection.features.supports_update_conflicts_with_target else None
+        self.bulk_create(
+            occupancies.values(),
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=DailyOccupancy.TOTAL_FIELDS + ['updated_at'],
+        )
+
+    def get_totals(self, start_date, end_date):
+        """開始日〜終了日の集計の合計を辞書で返す"""
+        return self.filter(date__gte=start_date, date__lte=end_date).aggregate(
+            **{field: Coalesce(Sum(field), 0) for field in DailyOccupancy.TOTAL_FIELDS})
+
+
+def _start_of_day(d):
+    return timezone.make_aware(datetime.combine(d, datetime.min.time()))
+
+
+def _group_consecutive_dates(dates):
+    """昇順の日付のリストを連続する日付の(開始日, 終了日)のリストにする"""
+    ranges = []
+    for d in dates:
+        if ranges and ranges[-1][1] + timezone.timedelta(days=1) == d:
+            ranges[-1][1] = d
         else:
-            return False
+            ranges.append([d, d])
+    return ranges
+
+
+class DailyOccupancy(models.Model):
+    """
+    日毎の予約枠数と予約数の集計
+    予約・予約枠・一時確保の変更時に、変更した日の予約枠から集計し直す。
+    """
+    TOTAL_FIELDS = ['total_limit', 'total_booked', 'available_count', 'few_count', 'filled_count']
+    STATE_FIELDS = {'●': 'available_count', '▲': 'few_count', '×': 'filled_count'}
+
+    date = models.DateField(_('日付'), unique=True)
+    total_limit = models.PositiveIntegerField(_('予約枠数合計'), default=0)
+    # 一時確保を含む
+    total_booked = models.PositiveIntegerField(_('予約数合計'), default=0)
+    available_count = models.PositiveIntegerField(_('予約可の予約枠数'), default=0)
+    few_count = models.PositiveIntegerField(_('残席わずかの予約枠数'), default=0)
+    filled_count = models.PositiveIntegerField(_('予約不可の予約枠数'), default=0)
+    updated_at = models.DateTimeField(_('更新日時'), default=timezone.now)
+
+    objects = DailyOccupancyManager()
+
+    def __str__(self):
+        return f'{self.date} 予約状況：{self.total_booked} / {self.total_limit}'
+
+    def add(self, bl):
+        """
+        予約枠を集計に加える
+        bl: start_datetime, limit, booked_count, stateを持つ予約枠の辞書
+        """
+        self.total_limit += bl['limit']
+        self.total_booked += bl['booked_count']
+        field = self.STATE_FIELDS[bl['state']]
+        setattr(self, field, getattr(self, field) + 1)
@@ -0,0 +1,39 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from yoyaku.booking import availability_cache
+from yoyaku.booking.models import Booking, BookingLimit, SeatHold
+
+
+@receiver(post_delete, sender=Booking)
+def decrease_booked_count(sender, instance, **kwargs):
+    """
+    予約の削除時に予約枠の予約数を減らす。
+    顧客の削除などによるカスケード削除の場合も呼ばれる。
+    """
+    BookingLimit.objects.add_booked_count(instance.booking_limit_id, -1)
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def invalidate_booking_cache(sender, instance, **kwargs):
+    """予約の変更時に、変更前と変更後の予約枠の日の空き状況のキャッシュを削除する"""
+    pk_list = {instance.booking_limit_id, getattr(instance, '_loaded_booking_limit_id', None)}
+    if Booking.booking_limit.is_cached(instance) and len(pk_list - {None}) == 1:
+        availability_cache.invalidate([instance.booking_limit.start_datetime])
+    else:
+        availability_cache.invalidate_booking_limits(pk_list - {None})
+
+
+@receiver(post_save, sender=BookingLimit)
+@receiver(post_delete, sender=BookingLimit)
+def invalidate_booking_limit_cache(sender, instance, **kwargs):
+    """予約枠の変更時に、予約枠の日の空き状況のキャッシュを削除する"""
+    availability_cache.invalidate([instance.start_datetime])
+
+
+@receiver(post_save, sender=SeatHold)
+@receiver(post_delete, sender=SeatHold)
+def invalidate_seat_hold_cache(sender, instance, **kwargs):
+    """予約枠の一時確保・解放時に、予約枠の日の空き状況のキャッシュを削除する"""
+    availability_cache.invalidate_booking_limits([instance.booking_limit_id])
@@ -0,0 +1,97 @@
+import heapq
+from collections import Counter, namedtuple
+from datetime import datetime, time
+from itertools import groupby
+
+from django.db import transaction
+from django.utils.timezone import make_aware
+
+from yoyaku.accounts.models import User
+from yoyaku.booking.models import Booking
+
+# 担当スタッフの自動割り当ての結果
+# assignments: 予約idと割り当てたスタッフidの辞書
+# loads: スタッフidと期間内の担当件数の辞書
+# skipped: スタッフが足りず割り当てられなかった予約の件数
+# conflicts: 割り当て中に他のスタッフに変更されたため更新しなかった予約idのリスト
+AssignmentResult = namedtuple('AssignmentResult', ['assignments', 'loads', 'skipped', 'conflicts'])
+
+BATCH_SIZE = 1000
+
+
+def distribute(slots, staff_ids, loads=None):
+    """
+    予約枠毎の未割り当ての予約を、担当件数が最も少ないスタッフから順に割り当てる。
+    同じ予約枠に同じスタッフは割り当てない。予約枠に割り当てられるスタッフが足りない場合は残りを割り当てない。
+    slots: (未割り当ての予約idのリスト, 予約枠に割り当て済みのスタッフidの集合)のリスト
+    staff_ids: 割り当てるスタッフidのリスト 担当件数が同じ場合はリストの順に割り当てる
+    loads: スタッフidと割り当て済みの件数の辞書
+    return: 予約idとスタッフidの辞書
+    """
+    loads = loads or {}
+    heap = [(loads.get(staff_id, 0), i, staff_id) for i, staff_id in enumerate(staff_ids)]
+    heapq.heapify(heap)
+    assignments = {}
+    for booking_ids, assigned in slots:
+        picked = []
+        conflicted = []
+        while heap and len(picked) < len(booking_ids):
+            entry = heapq.heappop(heap)
+            (conflicted if entry[2] in assigned else picked).append(entry)
+        for booking_id, (load, i, staff_id) in zip(booking_ids, picked):
+            assignments[booking_id] = staff_id
+            heapq.heappush(heap, (load + 1, i, staff_id))
+        for entry in conflicted:
+            heapq.heappush(heap, entry)
+    return assignments
+
+
+def auto_assign_staff(start_date, end_date, updated_by=None, dry_run=False, batch_size=BATCH_SIZE):
+    """
+    開始日〜終了日(含まない)の担当スタッフが未定義の予約に、有効なスタッフを担当件数が均等になるように割り当てる。
+    担当件数には期間内の割り当て済みの予約を含む。読み込み時から版数が変わった予約は更新しない。
+    updated_by: 更新者のユーザ
+    dry_run: Trueの場合は割り当て結果を返すのみで更新しない
+    """
+    start = make_aware(datetime.combine(start_date, time()))
+    end = make_aware(datetime.combine(end_date, time()))
+    staff_ids = list(User.staffs.is_active().order_by('id').values_list('id', flat=True))
+
+    with transaction.atomic():
+        # 割り当て中に手動で変更されないように、期間内の予約をロックする
+        rows = (
+            Booking.objects.select_for_update(of=('self',))
+            .filter(booking_limit__start_datetime__gte=start, booking_limit__start_datetime__lt=end)
+            .order_by('booking_limit__start_datetime', 'booking_limit_id', 'id')
+            .values_list('booking_limit_id', 'id', 'staff_id', 'version')
+        )
+        slots = []
+        versions = {}
+        loads = Counter()
+        for _, group in groupby(rows, key=lambda row: row[0]):
+            booking_ids = []
+            assigned = set()
+            for _, booking_id, staff_id, version in group:
+                if staff_id is None:
+                    booking_ids.append(booking_id)
+                    versions[booking_id] = version
+                else:
+                    assigned.add(staff_id)
+                    loads[staff_id] += 1
+            if booking_ids:
+                slots.append((booking_ids, assigned))
+
+        assignments = distribute(slots, staff_ids, loads)
+        conflicts = []
+        if not dry_run:
+            _, conflicts = Booking.objects.bulk_assign_staff(
+                [(booking_id, versions[booking_id], staff_id) for booking_id, staff_id in assignments.items()],
+                updated_by,
+                batch_size=batch_size,
+            )
+            for booking_id in conflicts:
+                del assignments[booking_id]
+
+    skipped = len(versions) - len(assignments) - len(conflicts)
+    loads.update(assignments.values())
+    return AssignmentResult(assignments, dict(loads), skipped, conflicts)
@@ -1,36 +1,39 @@
 from django import template
 from django.conf import settings
-from django.utils.timezone import localtime
+from django.utils.timezone import localdate, localtime
 
-from yoyaku.booking.utils import get_start_times, get_time_frames
+from yoyaku.booking.utils import get_disp_hour_from, get_start_times, get_time_frames
 
 register = template.Library()
 
 
 def _create_limit_index(start, limit_list):
     """
-    日付と時間枠の行列を作成し、インデックスの値を予約数/予約枠にする
-    予約枠が存在しないばあいや0の場合は値を空にする
+    時間枠×日付の行列を作成し、値を[予約数, 予約枠数]にする
+    予約枠が存在しない場合や0の場合は値をNoneにする
+    最後の行は日毎の[予約数合計, 枠数合計]
     """
-    # 予約枠の一覧を初期化
-    limit_index = {t: [''] * settings.DISP_DAYS for t in get_start_times()}
-    # 日毎の[予約数合計, 枠数合計]のリストを初期化
+    frame_count = len(get_start_times())
+    first_minutes = get_disp_hour_from() * 60
+    start_date = localdate(start)
+    # 行列を初期化し、予約枠の開始日時から行と列の位置を計算して代入する
+    limit_index = [[None] * settings.DISP_DAYS for i in range(frame_count)]
     totals = [[0, 0] for i in range(settings.DISP_DAYS)]
-    # 予約枠数を行列に代入する
     for l in limit_list:
-        local_datetime = localtime(l.start_datetime)
-        day_index = (local_datetime - start).days
-        time_index = local_datetime.time().isoformat(timespec='minutes')
+        if l['limit'] <= 0:
+            continue
+        local_datetime = localtime(l['start_datetime'])
+        day_index = (local_datetime.date() - start_date).days
+        time_index = (local_datetime.hour * 60 + local_datetime.minute - first_minutes) // 30
+        if not (0 <= day_index < settings.DISP_DAYS and 0 <= time_index < frame_count):
+            continue
 
-        # 予約枠が1つ以上ある場合は予約数を検索し、予約数と枠数の結果を保存する。
-        # totalsを更新する。
-        if 0 < l.limit:
-            count = l.bookings.count()
-            limit_index[time_index][day_index] = [count, l.limit]
-            totals[day_index][0] += count
-            totals[day_index][1] += l.limit
+        count = l['booked_count']
+        limit_index[time_index][day_index] = [count, l['limit']]
+        totals[day_index][0] += count
+        totals[day_index][1] += l['limit']
 
-    limit_index['total'] = totals
+    limit_index.append(totals)
 
     return limit_index
 
@@ -41,6 +44,7 @@ def create_rows(limit_list, start, *args, **kwargs):
     予約枠の時間毎のデータと日毎の予約総数/枠総数をテーブルとして表示できるhtmlを生成する
     {% create_rows limit_list time_frames start as rows %}
         {{ rows|safe }}
+    limit_list: start_datetime, limit, booked_countを持つ予約枠の辞書のリスト
     time_frames: 時間枠のリスト
     limit_index: 時間と日時の行列
     start: 開始日
@@ -49,14 +53,9 @@ def create_rows(limit_list, start, *args, **kwargs):
     time_frames = get_time_frames()
 
     tr_list = []
-    for i, limit_lists in enumerate(limit_index.values()):
-        tr = f'<td>{time_frames[i]}</td>'
-        for l in limit_lists:
-            if type(l) == list:
-                tr += f'<td>{l[0]} / {l[1]}</td>'
-            else:
-                tr += '<td></td>'
-        tr = f'<tr>{tr}</tr>'
-        tr_list.append(tr)
+    for time_frame, limit_lists in zip(time_frames, limit_index):
+        td_list = [f'<td>{time_frame}</td>']
+        td_list.extend(f'<td>{l[0]} / {l[1]}</td>' if l else '<td></td>' for l in limit_lists)
+        tr_list.append(f'<tr>{"".join(td_list)}</tr>')
 
     return ''.join(tr_list)
@@ -0,0 +1,80 @@
+from datetime import date, datetime, timedelta
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils.timezone import make_aware, now
+
+from yoyaku.booking import availability_cache
+from yoyaku.booking.forms import BookingLimitEditForm
+from yoyaku.booking.models import Booking, SeatHold
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory
+
+
+class TestAvailabilityCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bl1 = BookingLimitFactory(limit=2, start_datetime=make_aware(datetime(2020, 1, 1, 9)))
+        self.bl2 = BookingLimitFactory(limit=1, start_datetime=make_aware(datetime(2020, 1, 2, 9)))
+
+    def get_states(self):
+        slots = availability_cache.get_slots(date(2020, 1, 1), date(2020, 1, 3))
+        return [(bl['id'], bl['booked_count'], bl['state']) for bl in slots]
+
+    def test_get_slots(self):
+        # 期限切れの一時確保の解放、予約枠の取得、一時確保の有効期限の取得
+        with self.assertNumQueries(3):
+            self.assertEqual(self.get_states(), [(self.bl1.id, 0, '●'), (self.bl2.id, 0, '▲')])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_states(), [(self.bl1.id, 0, '●'), (self.bl2.id, 0, '▲')])
+        self.assertEqual(availability_cache.get_stats(), {'hits': 2, 'misses': 2})
+
+    def test_invalidate_when_booking_changed(self):
+        self.get_states()
+        booking = BookingFactory(booking_limit=self.bl2)
+        with self.assertNumQueries(3):
+            self.assertEqual(self.get_states(), [(self.bl1.id, 0, '●'), (self.bl2.id, 1, '×')])
+        # 予約した日のみ再取得する
+        self.assertEqual(availability_cache.get_stats(), {'hits': 1, 'misses': 3})
+
+        booking = Booking.objects.get(id=booking.id)
+        booking.booking_limit = self.bl1
+        booking.save()
+        self.assertEqual(self.get_states(), [(self.bl1.id, 1, '▲'), (self.bl2.id, 0, '▲')])
+
+        booking.delete()
+        self.assertEqual(self.get_states(), [(self.bl1.id, 0, '●'), (self.bl2.id, 0, '▲')])
+
+    def test_invalidate_when_booking_limit_edited(self):
+        self.get_states()
+        form = BookingLimitEditForm({
+            'start_datetime': '2020-01-01',
+            'end_datetime': '2020-01-01',
+            'limit': 5,
+            'time0900': True,
+            'time1000': True,
+        })
+        self.assertTrue(form.is_valid())
+        form.save()
+        states = self.get_states()
+        self.assertEqual(len(states), 3)
+        self.assertEqual(states[0], (self.bl1.id, 0, '●'))
+
+    def test_slots_in_range(self):
+        BookingLimitFactory(limit=1, start_datetime=make_aware(datetime(2020, 1, 3, 9)))
+        self.assertEqual(len(self.get_states()), 2)
+        self.assertEqual(len(availability_cache.get_slots(date(2020, 1, 1), date(2020, 1, 1) + timedelta(days=1))), 1)
+
+    def test_expired_seat_hold(self):
+        """期限切れの一時確保は予約数に含めず、キャッシュは一時確保の有効期限までにする"""
+        seat_hold = SeatHold.objects.hold(self.bl2.id, 'session1')
+        SeatHold.objects.update(expires_at=now() + timedelta(seconds=30))
+        with patch.object(availability_cache.cache, 'set_many', wraps=cache.set_many) as set_many:
+            self.assertEqual(self.get_states(), [(self.bl1.id, 0, '●'), (self.bl2.id, 1, '×')])
+        self.assertLessEqual(set_many.call_args.args[1], 30)
+
+        SeatHold.objects.filter(id=seat_hold.id).update(expires_at=now() - timedelta(seconds=1))
+        cache.clear()
+        self.assertEqual(self.get_states(), [(self.bl1.id, 0, '●'), (self.bl2.id, 0, '▲')])
+        self.assertFalse(SeatHold.objects.exists())
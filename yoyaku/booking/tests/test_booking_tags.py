@@ -14,9 +14,22 @@ class TestMethods(TestCase):
     def test_create_rows(self):
         start_datetime = get_today0000() + timedelta(hours=9)
         BookingLimitFactory(limit=1, start_datetime=start_datetime)
-        limit_list = BookingLimit.objects.all()
+        limit_list = BookingLimit.objects.values('start_datetime', 'limit', 'booked_count')
         result = create_rows(limit_list, start_datetime)
 
         expected = '<tr><td>9:00~9:30</td><td>0 / 1</td><td></td></tr><tr><td>9:30~10:00</td><td></td><td></td></tr>' \
                    '<tr><td>合計</td><td>0 / 1</td><td>0 / 0</td></tr>'
-        self.assertEqual(result, expected)
\ No newline at end of file
+        self.assertEqual(result, expected)
+
+    @override_settings(DISP_DAYS=2, START_TIME='09:00', END_TIME='10:00')
+    def test_create_rows_out_of_range(self):
+        """表示期間と時間帯の範囲外の予約枠は表示しない"""
+        start_datetime = get_today0000()
+        for hours in (8, 10, 9 + 24 * 2, 9 - 24):
+            BookingLimitFactory(limit=1, start_datetime=start_datetime + timedelta(hours=hours))
+        limit_list = BookingLimit.objects.values('start_datetime', 'limit', 'booked_count')
+        result = create_rows(limit_list, start_datetime)
+
+        expected = '<tr><td>9:00~9:30</td><td></td><td></td></tr><tr><td>9:30~10:00</td><td></td><td></td></tr>' \
+                   '<tr><td>合計</td><td>0 / 0</td><td>0 / 0</td></tr>'
+        self.assertEqual(result, expected)
@@ -0,0 +1,179 @@
+from datetime import date, datetime, time
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import make_aware, utc
+
+from yoyaku.accounts.models import User
+from yoyaku.booking.models import Booking, BookingLimit, DailyOccupancy, ScheduleTemplate, SeatHold
+from yoyaku.lp import waiting_room
+from yoyaku.mail.models import SystemMail
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, MailAddressFactory, StaffFactory
+
+
+class TestRecountBookingLimits(TestCase):
+
+    def test_handle(self):
+        bl1 = BookingLimitFactory(limit=3, start_datetime=datetime(2020, 1, 1, tzinfo=utc))
+        bl2 = BookingLimitFactory(limit=3, start_datetime=datetime(2020, 1, 2, tzinfo=utc))
+        BookingFactory(booking_limit=bl1)
+        SeatHold.objects.hold(bl1.id, 'session1')
+        BookingLimit.objects.filter(id=bl1.id).update(booked_count=0)
+        BookingLimit.objects.filter(id=bl2.id).update(booked_count=3)
+
+        out = StringIO()
+        call_command('recount_booking_limits', batch_size=1, stdout=out)
+
+        bl1.refresh_from_db()
+        bl2.refresh_from_db()
+        self.assertEqual(bl1.booked_count, 2)
+        self.assertEqual(bl2.booked_count, 0)
+        self.assertIn('予約枠 2 件中 2 件', out.getvalue())
+
+
+class TestSweepSeatHolds(TestCase):
+
+    def test_handle(self):
+        bl = BookingLimitFactory(limit=3, start_datetime=datetime(2020, 1, 1, tzinfo=utc))
+        SeatHold.objects.hold(bl.id, 'session1')
+        SeatHold.objects.update(expires_at=datetime(2020, 1, 1, tzinfo=utc))
+
+        out = StringIO()
+        call_command('sweep_seat_holds', stdout=out)
+
+        bl.refresh_from_db()
+        self.assertEqual(bl.booked_count, 0)
+        self.assertIn('1 件の一時確保を解放しました。', out.getvalue())
+
+
+class TestBenchmarkBookingLimitEdit(TestCase):
+
+    def test_handle(self):
+        out = StringIO()
+        call_command('benchmark_booking_limit_edit', months=[1], stdout=out)
+
+        self.assertIn('months=1 frames=780', out.getvalue())
+        # 変更内容はロールバックする
+        self.assertFalse(BookingLimit.objects.exists())
+
+
+class TestGenerateSlots(TestCase):
+
+    def setUp(self):
+        # 2020-01-06は月曜日
+        ScheduleTemplate.objects.create(weekday=0, start_time=time(9), limit=2)
+        ScheduleTemplate.objects.create(weekday=0, start_time=time(10), limit=2)
+
+    def test_handle(self):
+        bl = BookingLimitFactory(limit=5, start_datetime=make_aware(datetime(2020, 1, 6, 9)))
+        out = StringIO()
+        call_command('generate_slots', '--from=2020-01-06', days=14, batch_size=3, stdout=out)
+
+        self.assertEqual(BookingLimit.objects.count(), 4)
+        self.assertIn('2020-01-06 〜 2020-01-19 の予約枠 4 件を処理しました。', out.getvalue())
+        # 作成済みの予約枠は変更しない
+        bl.refresh_from_db()
+        self.assertEqual(bl.limit, 5)
+
+        # 再実行しても重複して作成しない
+        call_command('generate_slots', '--from=2020-01-06', days=14, stdout=StringIO())
+        self.assertEqual(BookingLimit.objects.count(), 4)
+
+    def test_resume(self):
+        BookingLimitFactory(limit=2, start_datetime=make_aware(datetime(2020, 1, 13, 9)))
+        out = StringIO()
+        call_command('generate_slots', '--from=2020-01-06', days=14, resume=True, stdout=out)
+
+        self.assertIn('2020-01-13 〜 2020-01-19 の予約枠 2 件を処理しました。', out.getvalue())
+        self.assertEqual(BookingLimit.objects.count(), 2)
+
+
+class TestRebuildDailyOccupancy(TestCase):
+
+    def test_handle(self):
+        bl = BookingLimitFactory(limit=3, start_datetime=make_aware(datetime(2020, 1, 1, 9)))
+        BookingFactory(booking_limit=bl)
+        BookingLimitFactory(limit=2, start_datetime=make_aware(datetime(2020, 1, 3, 9)))
+        DailyOccupancy.objects.create(date=date(2020, 1, 2), total_limit=5)
+
+        out = StringIO()
+        call_command('rebuild_daily_occupancy', days=2, stdout=out)
+
+        self.assertIn('2020-01-01 〜 2020-01-03 の 3 日分を集計しました。', out.getvalue())
+        values = DailyOccupancy.objects.order_by('date').values_list('date', 'total_limit', 'total_booked')
+        self.assertEqual(list(values), [
+            (date(2020, 1, 1), 3, 1),
+            (date(2020, 1, 2), 0, 0),
+            (date(2020, 1, 3), 2, 0),
+        ])
+
+
+class TestAutoAssignStaff(TestCase):
+
+    def setUp(self):
+        self.staff = StaffFactory(username='担当者')
+        bl = BookingLimitFactory(limit=2, start_datetime=make_aware(datetime(2020, 1, 6, 10)))
+        self.booking = BookingFactory(booking_limit=bl, staff=None)
+
+    def test_handle(self):
+        out = StringIO()
+        call_command('auto_assign_staff', '--from=2020-01-06', stdout=out)
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.staff, self.staff)
+        self.assertIn('2020-01-06 〜 2020-01-06 の予約 1 件にスタッフを割り当てました。', out.getvalue())
+
+    def test_updated_by(self):
+        call_command('auto_assign_staff', '--from=2020-01-06', f'--updated-by={self.staff.user_id}', stdout=StringIO())
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.updated_by, self.staff)
+
+        with self.assertRaises(CommandError):
+            call_command('auto_assign_staff', '--from=2020-01-06', '--updated-by=unknown')
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('auto_assign_staff', '--from=2020-01-06', '--to=2020-01-07', '--dry-run', stdout=out)
+        self.booking.refresh_from_db()
+        self.assertIsNone(self.booking.staff)
+        self.assertIn('担当者: 1 件', out.getvalue())
+
+    def test_invalid_range(self):
+        with self.assertRaises(CommandError):
+            call_command('auto_assign_staff', '--from=2020-01-06', '--to=2020-01-05')
+
+
+class TestLoadtestBooking(TransactionTestCase):
+
+    fixtures = ['mail']
+
+    def setUp(self):
+        SystemMail.objects.filter(id=1).update(sender=MailAddressFactory())
+
+    def test_handle(self):
+        out = StringIO()
+        call_command('loadtest_booking', requests=3, concurrency=1, limit=2, stdout=out)
+
+        self.assertIn('booked=2 rejected=1 lock_error=0 error=0', out.getvalue())
+        self.assertIn('limit=2 bookings=2 booked_count=2', out.getvalue())
+        # 作成したデータは削除される
+        self.assertFalse(BookingLimit.objects.exists())
+        self.assertFalse(User.customers.exists())
+
+    @override_settings(WAITING_ROOM_CAPACITY=1)
+    def test_waiting_room_disabled(self):
+        """順番待ちを無効にして送信し、整理券をキャッシュに書き込まない"""
+        cache.clear()
+        out = StringIO()
+        call_command('loadtest_booking', requests=3, concurrency=1, limit=3, stdout=out)
+        self.assertIn('booked=3 rejected=0', out.getvalue())
+        self.assertIsNone(cache.get(waiting_room.TICKET_KEY))
+
+    def test_overbooked(self):
+        with patch.object(BookingLimit.objects, 'reserve_seat', return_value=True):
+            with self.assertRaises(CommandError):
+                call_command('loadtest_booking', requests=2, concurrency=1, limit=1, keep=True, stdout=StringIO())
+        self.assertEqual(Booking.objects.count(), 2)
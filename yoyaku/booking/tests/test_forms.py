@@ -1,12 +1,16 @@
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import patch
 
 from django import forms
 from django.core.exceptions import NON_FIELD_ERRORS
-from django.test import TestCase
-from django.utils.timezone import now, utc
-
-from yoyaku.booking.forms import BookingForm, BookingLimitEditForm, RegisterBookingForm, copy_boolean_field
-from yoyaku.booking.models import BookingLimit
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils.timezone import make_aware, now, utc
+
+from yoyaku.booking.forms import (
+    BookingForm, BookingLimitEditForm, BookingSearchForm, RegisterBookingForm, copy_boolean_field,
+)
+from yoyaku.booking.models import BookingLimit, DailyOccupancy, SeatHold
 from yoyaku.booking.utils import get_today0000
 from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, CustomerFactory, StaffFactory
 
@@ -58,6 +62,22 @@ class TestBookingLimitEditForm(TestCase):
         self.assertEqual(bl.limit, 3)
         self.assertEqual(bl.start_datetime, datetime(2020, 1, 1, tzinfo=timezone.utc))
 
+    def test_update_without_conflict_target(self):
+        """重複を判定する列を指定できないDB(MySQL)では、unique_fieldsを指定しない"""
+        data = {
+            'start_datetime': '2020-01-01',
+            'end_datetime': '2020-01-01',
+            'limit': 3,
+            'time0900': True,
+        }
+        form = BookingLimitEditForm(data)
+        self.assertTrue(form.is_valid())
+        with patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+                patch.object(BookingLimit.objects, 'bulk_create') as bulk_create:
+            form.save()
+        self.assertIsNone(bulk_create.call_args.kwargs['unique_fields'])
+        self.assertEqual(bulk_create.call_args.kwargs['update_fields'], ['limit'])
+
     def test_required(self):
         form = BookingLimitEditForm({})
         for required_field in ('start_datetime', 'end_datetime', 'limit'):
@@ -109,6 +129,32 @@ class TestBookingLimitEditForm(TestCase):
         form = BookingLimitEditForm(data)
         self.assertTrue(form.has_error(NON_FIELD_ERRORS, code='booking_overflow'))
 
+        # チェックしていない時間帯の予約枠は変更しないためエラーにしない
+        data = {**data, 'time0900': False, 'time0930': True}
+        form = BookingLimitEditForm(data)
+        self.assertTrue(form.is_valid())
+
+    def test_save_in_batches(self):
+        """作成と更新が混在する場合も分割して保存する"""
+        bl = BookingLimitFactory(limit=1, start_datetime=datetime(2020, 1, 1, 1, tzinfo=utc))
+        BookingFactory(booking_limit=bl)
+        data = {
+            'start_datetime': '2020-01-01',
+            'end_datetime': '2020-01-03',
+            'limit': 2,
+            'time0900': True,
+            'time1000': True,
+        }
+        form = BookingLimitEditForm(data)
+        form.batch_size = 4
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        self.assertEqual(BookingLimit.objects.filter(limit=2).count(), 6)
+        bl.refresh_from_db()
+        self.assertEqual(bl.limit, 2)
+        self.assertEqual(bl.booked_count, 1)
+
 
 class TestBookingForm(TestCase):
 
@@ -138,6 +184,25 @@ class TestBookingForm(TestCase):
         self.assertEqual(obj.staff, self.staff)
         self.assertEqual(obj.updated_by, self.staff)
 
+    @override_settings(VIRTUAL_SLOT_LIMIT=3)
+    def test_save_on_virtual_slot(self):
+        """仮想予約枠を使う場合、予約枠がない日時は仮想予約枠の枠数で予約枠を作成する"""
+        start_datetime = get_today0000() + timedelta(days=2, hours=9)
+        data = {
+            'staff': self.staff,
+            'customer': self.customer.id,
+            'start_datetime': start_datetime,
+            'select_booking_limit': False,
+        }
+        form = BookingForm(data)
+        self.assertTrue(form.is_valid())
+        obj = form.save(self.staff)
+
+        obj.booking_limit.refresh_from_db()
+        self.assertEqual(obj.booking_limit.start_datetime, start_datetime)
+        self.assertEqual(obj.booking_limit.limit, 3)
+        self.assertEqual(obj.booking_limit.booked_count, 1)
+
     def test_save_if_booking_limit_exist(self):
         """カレンダーから予約枠作成済みの日時を選んだ時のテスト"""
         data = {
@@ -233,6 +298,19 @@ class TestBookingForm(TestCase):
         self.assertEqual(bl, self.bl)
 
 
+class TestBookingSearchForm(TestCase):
+
+    def test_get_info(self):
+        bl = BookingLimitFactory(limit=3, start_datetime=make_aware(datetime(2020, 1, 1, 9)))
+        BookingLimitFactory(limit=2, start_datetime=make_aware(datetime(2020, 1, 2, 9)))
+        BookingLimitFactory(limit=4, start_datetime=make_aware(datetime(2020, 1, 3, 9)))
+        DailyOccupancy.objects.refresh([date(2020, 1, 1), date(2020, 1, 2), date(2020, 1, 3)])
+
+        form = BookingSearchForm({'from_datetime': '2020-01-01', 'to_datetime': '2020-01-02'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.get_info(1), '2020-01-01 ~ 2020-01-02 予約総数 / 予約枠総数 = 1 / 5')
+
+
 class TestRegisterBookingForm(TestCase):
 
     def setUp(self):
@@ -247,6 +325,39 @@ class TestRegisterBookingForm(TestCase):
         obj = form.save(customer)
         self.assertEqual(obj.customer, customer)
         self.assertEqual(obj.booking_limit, bl)
+        bl.refresh_from_db()
+        self.assertEqual(bl.booked_count, 1)
+
+    def test_save_if_filled_after_validation(self):
+        """検証後に別の予約で満席になった場合は予約を作成しない"""
+        bl = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(hours=5))
+        form = RegisterBookingForm({'booking_limit': bl.id})
+        self.assertTrue(form.is_valid())
+        BookingFactory(booking_limit=bl)
+
+        self.assertIsNone(form.save(CustomerFactory()))
+        self.assertTrue(form.has_error('booking_limit', code='filled'))
+        bl.refresh_from_db()
+        self.assertEqual(bl.booked_count, 1)
+        self.assertEqual(bl.bookings.count(), 1)
+
+    def test_save_with_seat_hold(self):
+        """一時確保した予約枠は満席でも予約できる"""
+        bl = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(hours=5))
+        seat_hold = SeatHold.objects.hold(bl.id, 'session1')
+        form = RegisterBookingForm({'booking_limit': bl.id, 'seat_hold': seat_hold.token})
+        self.assertTrue(form.is_valid())
+        self.assertIsNotNone(form.save(CustomerFactory()))
+        self.assertFalse(SeatHold.objects.exists())
+        bl.refresh_from_db()
+        self.assertEqual(bl.booked_count, 1)
+
+        # 他の顧客が一時確保している場合は満席
+        bl2 = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(hours=6))
+        SeatHold.objects.hold(bl2.id, 'session2')
+        form = RegisterBookingForm({'booking_limit': bl2.id, 'seat_hold': seat_hold.token})
+        self.assertFalse(form.is_valid())
+        self.assertTrue(form.has_error('booking_limit', code='filled'))
 
     def test_invalid_choice_error(self):
         data = {'booking_limit': 0}
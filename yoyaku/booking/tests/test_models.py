@@ -1,9 +1,13 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
+from unittest.mock import patch
 
+from django.db import connection
 from django.test import TestCase
-from django.utils.timezone import now, utc
+from django.utils.timezone import make_aware, now, utc
 
-from yoyaku.booking.models import BookingLimit
+from yoyaku.booking.models import (
+    Booking, BookingLimit, DailyOccupancy, ScheduleException, ScheduleTemplate, SeatHold,
+)
 from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, StaffFactory
 
 
@@ -20,12 +24,69 @@ class TestBookingLimitManager(TestCase):
         bl_list = BookingLimit.objects.can_book(include=bl_cannot_book2)
         self.assertEqual(bl_list.count(), 2)
 
-    def test_customers_can_select(self):
-        bl_cannot_select = BookingLimitFactory(limit=1, start_datetime=now())
-        bl_can_select = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(minutes=60))
-        bl_list = BookingLimit.objects.customers_can_select(after_min=30)
-        self.assertEqual(bl_list.count(), 1)
-        self.assertEqual(bl_list.last(), bl_can_select)
+    def test_can_book_filled(self):
+        bl_filled = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(minutes=60))
+        BookingFactory(booking_limit=bl_filled)
+        self.assertFalse(BookingLimit.objects.can_book().exists())
+        self.assertEqual(list(BookingLimit.objects.can_book(include=bl_filled)), [bl_filled])
+
+    def test_can_book_days(self):
+        bl_tomorrow = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(days=1))
+        BookingLimitFactory(limit=1, start_datetime=now()+timedelta(days=3))
+        self.assertEqual(BookingLimit.objects.can_book().count(), 2)
+        self.assertEqual(list(BookingLimit.objects.can_book(days=2)), [bl_tomorrow])
+
+    def test_reserve_seat(self):
+        bl = BookingLimitFactory(limit=2, start_datetime=now())
+        self.assertTrue(BookingLimit.objects.reserve_seat(bl.id))
+        self.assertTrue(BookingLimit.objects.reserve_seat(bl.id))
+        self.assertFalse(BookingLimit.objects.reserve_seat(bl.id))
+        self.assertFalse(BookingLimit.objects.reserve_seat(0))
+        bl.refresh_from_db()
+        self.assertEqual(bl.booked_count, 2)
+
+    def test_save_keeps_booked_count(self):
+        """読み込み後に予約された予約枠を保存しても、予約数を上書きしない"""
+        bl = BookingLimitFactory(limit=2, start_datetime=now())
+        BookingFactory(booking_limit=BookingLimit.objects.get(id=bl.id))
+        bl.limit = 1
+        bl.save()
+        bl.refresh_from_db()
+        self.assertEqual((bl.limit, bl.booked_count), (1, 1))
+
+    def test_reserve_seat_sweeps_expired_holds(self):
+        """満席でも期限切れの一時確保がある場合は解放して確保する"""
+        bl = BookingLimitFactory(limit=1, start_datetime=now())
+        SeatHold.objects.hold(bl.id, 'session1')
+        self.assertFalse(BookingLimit.objects.reserve_seat(bl.id))
+
+        SeatHold.objects.update(expires_at=now()-timedelta(seconds=1))
+        self.assertTrue(BookingLimit.objects.reserve_seat(bl.id))
+        self.assertFalse(SeatHold.objects.exists())
+        bl.refresh_from_db()
+        self.assertEqual(bl.booked_count, 1)
+
+    def test_with_state(self):
+        """状態の判定がBookingLimit.get_state()と一致する"""
+        params = [
+            (0, 0), (1, 1), (2, 0), (2, 1), (3, 3), (4, 1), (4, 2), (5, 2), (5, 3),
+            (6, 4), (6, 5), (10, 7), (10, 8), (20, 14), (20, 15),
+        ]
+        for i, (limit, booked) in enumerate(params):
+            bl = BookingLimitFactory(limit=limit, start_datetime=now()+timedelta(days=1, minutes=30*i))
+            for j in range(booked):
+                BookingFactory(booking_limit=bl)
+
+        with self.assertNumQueries(1):
+            rows = list(BookingLimit.objects.with_state().values('id', 'start_datetime', 'rest', 'state'))
+
+        self.assertEqual(len(rows), len(params))
+        for row in rows:
+            bl = BookingLimit.objects.get(id=row['id'])
+            with self.subTest(limit=bl.limit, booked=bl.booked_count):
+                self.assertEqual(row['state'], bl.get_state())
+                self.assertEqual(row['rest'], bl.limit - bl.booked_count)
+                self.assertEqual(row['start_datetime'], bl.start_datetime)
 
 
 class TestBookingLimit(TestCase):
@@ -61,11 +122,41 @@ class TestBookingLimit(TestCase):
             bl = BookingLimitFactory(limit=limit, start_datetime=now())
             for i in range(booked):
                 booking = BookingFactory(booking_limit=bl)
+            bl.refresh_from_db()
 
             with self.subTest(expected=expected):
                 assert bl.get_state() == expected
 
 
+    def test_booked_count_when_booking_moved(self):
+        """予約枠を変更すると、変更前と変更後の予約枠の予約数が更新される"""
+        bl2 = BookingLimitFactory(limit=1, start_datetime=datetime(2020, 1, 2, tzinfo=utc))
+        booking = BookingFactory(booking_limit=self.bl)
+        booking = Booking.objects.get(id=booking.id)
+        booking.booking_limit = bl2
+        booking.save()
+
+        self.bl.refresh_from_db()
+        bl2.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 0)
+        self.assertEqual(bl2.booked_count, 1)
+
+    def test_booked_count_when_booking_deleted(self):
+        """予約の削除時と、顧客の削除によるカスケード削除時に予約数が減る"""
+        booking1 = BookingFactory(booking_limit=self.bl)
+        booking2 = BookingFactory(booking_limit=self.bl)
+        self.bl.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 2)
+
+        booking1.delete()
+        self.bl.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 1)
+
+        booking2.customer.delete()
+        self.bl.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 0)
+
+
 class TestBookingModel(TestCase):
 
     def setUp(self):
@@ -81,16 +172,216 @@ class TestBookingModel(TestCase):
     def test_get_start_datetime(self):
         self.assertEqual(self.booking.get_start_datetime(), self.bl.start_datetime)
 
-    def test_is_updated_by_others(self):
-        user1 = StaffFactory()
-        user2 = StaffFactory()
-
-        dt_before_save = now()
-        self.booking.updated_by = user1
+    def test_save_increments_version(self):
+        self.assertEqual(self.booking.version, 1)
         self.booking.save()
-        dt_after_save = now()
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.version, 2)
+
+    def test_assign_staff(self):
+        staff = StaffFactory()
+        self.assertEqual(Booking.objects.assign_staff(self.booking.id, 1, staff.id, staff), 1)
+        self.booking.refresh_from_db()
+        self.assertEqual((self.booking.staff, self.booking.updated_by, self.booking.version), (staff, staff, 2))
+
+        # 版数が異なる場合は更新しない
+        self.assertEqual(Booking.objects.assign_staff(self.booking.id, 1, None, staff), 0)
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.staff, staff)
+
+    def test_assign_staff_inactive(self):
+        """無効なスタッフは割り当てない"""
+        staff = StaffFactory(is_active=False)
+        self.assertEqual(Booking.objects.assign_staff(self.booking.id, 1, staff.id, staff), 0)
+
+
+class TestBookingManager(TestCase):
+
+    def setUp(self):
+        self.staff = StaffFactory()
+        bl = BookingLimitFactory(limit=3, start_datetime=datetime(2020, 1, 1, tzinfo=utc))
+        self.bookings = [BookingFactory(booking_limit=bl, staff=None) for _ in range(3)]
+
+    def test_bulk_assign_staff(self):
+        assignments = [(b.id, b.version, self.staff.id) for b in self.bookings[:2]]
+        assignments.append((self.bookings[2].id, self.bookings[2].version, None))
+        # スタッフの確認、スタッフ毎のUPDATE 2回、セーブポイントの作成と解放
+        with self.assertNumQueries(5):
+            updated, conflicts = Booking.objects.bulk_assign_staff(assignments, self.staff)
+        self.assertEqual(updated, {b.id: 2 for b in self.bookings})
+        self.assertEqual(conflicts, [])
+        staff_ids = dict(Booking.objects.values_list('id', 'staff_id'))
+        self.assertEqual([staff_ids[b.id] for b in self.bookings], [self.staff.id, self.staff.id, None])
+
+    def test_bulk_assign_staff_conflicts(self):
+        """版数が異なる予約、無効なスタッフ、重複した予約は更新しない"""
+        inactive_staff = StaffFactory(is_active=False)
+        b1, b2, b3 = self.bookings
+        b1.save()
+        assignments = [
+            (b1.id, 1, self.staff.id),
+            (b2.id, 1, inactive_staff.id),
+            (b3.id, 1, self.staff.id),
+            (b3.id, 1, None),
+            (0, 1, self.staff.id),
+        ]
+        updated, conflicts = Booking.objects.bulk_assign_staff(assignments, self.staff)
+        self.assertEqual(updated, {b3.id: 2})
+        self.assertEqual(conflicts, [b1.id, b2.id, b3.id, 0])
+        b3.refresh_from_db()
+        self.assertEqual(b3.staff, self.staff)
+
+    def test_bulk_assign_staff_batch(self):
+        """UPDATEを分割しても、版数が一致する予約のみ更新する"""
+        b1, b2, b3 = self.bookings
+        b2.save()
+        assignments = [(b.id, 1, self.staff.id) for b in self.bookings]
+        updated, conflicts = Booking.objects.bulk_assign_staff(assignments, self.staff, batch_size=2)
+        self.assertEqual(updated, {b1.id: 2, b3.id: 2})
+        self.assertEqual(conflicts, [b2.id])
+        b2.refresh_from_db()
+        self.assertIsNone(b2.staff)
+        self.assertEqual(b2.version, 2)
+
+
+class TestSeatHoldManager(TestCase):
+
+    def setUp(self):
+        self.bl = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(hours=5))
+
+    def test_hold(self):
+        seat_hold = SeatHold.objects.hold(self.bl.id, 'session1')
+        self.assertEqual(seat_hold.booking_limit_id, self.bl.id)
+        self.assertEqual(seat_hold.session_key, 'session1')
+        self.assertGreater(seat_hold.expires_at, now())
+        self.bl.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 1)
+
+        # 満席の場合は確保できない
+        self.assertIsNone(SeatHold.objects.hold(self.bl.id, 'session2'))
+
+    def test_hold_same_session(self):
+        """同じセッションで前に一時確保した予約枠は解放する"""
+        bl2 = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(hours=6))
+        seat_hold = SeatHold.objects.hold(self.bl.id, 'session1')
+        seat_hold2 = SeatHold.objects.hold(bl2.id, 'session1')
+        self.assertIsNotNone(seat_hold2)
+        self.assertFalse(SeatHold.objects.filter(id=seat_hold.id).exists())
+        self.bl.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 0)
+
+        # 同じ予約枠を確保し直す
+        self.assertIsNotNone(SeatHold.objects.hold(bl2.id, 'session1'))
+        self.assertEqual(SeatHold.objects.filter(session_key='session1').count(), 1)
+
+    def test_claim(self):
+        seat_hold = SeatHold.objects.hold(self.bl.id, 'session1')
+        self.assertFalse(SeatHold.objects.claim(seat_hold.token, self.bl.id + 1))
+        self.assertTrue(SeatHold.objects.claim(seat_hold.token, self.bl.id))
+        self.assertFalse(SeatHold.objects.claim(seat_hold.token, self.bl.id))
+        # 予約数は予約に引き継ぐため減らさない
+        self.bl.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 1)
+
+    def test_release(self):
+        seat_hold = SeatHold.objects.hold(self.bl.id, 'session1')
+        self.assertTrue(SeatHold.objects.release(seat_hold.token))
+        self.assertFalse(SeatHold.objects.release(seat_hold.token))
+        self.bl.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 0)
+
+    def test_sweep(self):
+        expired = SeatHold.objects.hold(self.bl.id, 'session1')
+        SeatHold.objects.filter(id=expired.id).update(expires_at=now()-timedelta(seconds=1))
+        bl2 = BookingLimitFactory(limit=1, start_datetime=now()+timedelta(hours=6))
+        SeatHold.objects.hold(bl2.id, 'session2')
+
+        self.assertEqual(SeatHold.objects.sweep(), 1)
+        self.bl.refresh_from_db()
+        bl2.refresh_from_db()
+        self.assertEqual(self.bl.booked_count, 0)
+        self.assertEqual(bl2.booked_count, 1)
+
+        # 期限切れの一時確保は他の顧客が予約枠を確保するときに解放される
+        SeatHold.objects.filter(booking_limit=bl2).update(expires_at=now()-timedelta(seconds=1))
+        self.assertIsNotNone(SeatHold.objects.hold(bl2.id, 'session3'))
+        self.assertEqual(SeatHold.objects.filter(booking_limit=bl2).count(), 1)
+
+    def test_sweep_range(self):
+        """期間を指定した場合は、期間内の予約枠の一時確保のみ解放する"""
+        bl2 = BookingLimitFactory(limit=1, start_datetime=self.bl.start_datetime + timedelta(hours=1))
+        SeatHold.objects.hold(self.bl.id, 'session1')
+        SeatHold.objects.hold(bl2.id, 'session2')
+        SeatHold.objects.update(expires_at=now()-timedelta(seconds=1))
+
+        start = self.bl.start_datetime
+        self.assertEqual(SeatHold.objects.sweep(start_datetime=start, end_datetime=start + timedelta(hours=1)), 1)
+        self.assertEqual(list(SeatHold.objects.values_list('booking_limit_id', flat=True)), [bl2.id])
+
+    def test_get_next_expiry(self):
+        seat_hold = SeatHold.objects.hold(self.bl.id, 'session1')
+        start = self.bl.start_datetime
+        self.assertEqual(SeatHold.objects.get_next_expiry(start, start + timedelta(hours=1)), seat_hold.expires_at)
+        self.assertIsNone(SeatHold.objects.get_next_expiry(start + timedelta(hours=1), start + timedelta(hours=2)))
+
+
+class TestScheduleTemplateManager(TestCase):
+
+    def test_iterate_frames(self):
+        # 2020-01-06は月曜日
+        ScheduleTemplate.objects.create(weekday=0, start_time=time(10), limit=2)
+        ScheduleTemplate.objects.create(weekday=0, start_time=time(9), limit=1)
+        ScheduleTemplate.objects.create(weekday=1, start_time=time(9), limit=3, valid_to=date(2020, 1, 7))
+        ScheduleException.objects.create(date=date(2020, 1, 13), start_time=time(10))
+        ScheduleException.objects.create(date=date(2020, 1, 20))
+
+        frames = list(ScheduleTemplate.objects.iterate_frames(date(2020, 1, 6), date(2020, 1, 21)))
+        self.assertEqual(frames, [
+            (make_aware(datetime(2020, 1, 6, 9)), 1),
+            (make_aware(datetime(2020, 1, 6, 10)), 2),
+            (make_aware(datetime(2020, 1, 7, 9)), 3),
+            (make_aware(datetime(2020, 1, 13, 9)), 1),
+        ])
+
+
+class TestDailyOccupancyManager(TestCase):
+
+    def setUp(self):
+        self.bl1 = BookingLimitFactory(limit=1, start_datetime=make_aware(datetime(2020, 1, 1, 9)))
+        self.bl2 = BookingLimitFactory(limit=6, start_datetime=make_aware(datetime(2020, 1, 1, 9, 30)))
+        self.bl3 = BookingLimitFactory(limit=2, start_datetime=make_aware(datetime(2020, 1, 3, 9)))
+        BookingFactory(booking_limit=self.bl1)
+
+    def test_refresh(self):
+        DailyOccupancy.objects.refresh([date(2020, 1, 1), date(2020, 1, 2), date(2020, 1, 3)])
+        values = DailyOccupancy.objects.order_by('date').values_list(
+            'date', 'total_limit', 'total_booked', 'available_count', 'few_count', 'filled_count')
+        self.assertEqual(list(values), [
+            (date(2020, 1, 1), 7, 1, 1, 0, 1),
+            (date(2020, 1, 2), 0, 0, 0, 0, 0),
+            (date(2020, 1, 3), 2, 0, 1, 0, 0),
+        ])
+        self.assertEqual(DailyOccupancy.objects.get_totals(date(2020, 1, 1), date(2020, 1, 3)), {
+            'total_limit': 9, 'total_booked': 1, 'available_count': 2, 'few_count': 0, 'filled_count': 1,
+        })
+
+    def test_refresh_without_conflict_target(self):
+        """重複を判定する列を指定できないDB(MySQL)では、unique_fieldsを指定しない"""
+        with patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+                patch.object(DailyOccupancy.objects, 'bulk_create') as bulk_create:
+            DailyOccupancy.objects.refresh([date(2020, 1, 1)])
+        self.assertIsNone(bulk_create.call_args.kwargs['unique_fields'])
+        self.assertTrue(bulk_create.call_args.kwargs['update_conflicts'])
+
+    def test_refresh_on_change(self):
+        """予約の変更をコミットした後に、変更した日の集計を更新する"""
+        with self.captureOnCommitCallbacks(execute=True):
+            BookingFactory(booking_limit=self.bl3)
+        occupancy = DailyOccupancy.objects.get(date=date(2020, 1, 3))
+        self.assertEqual((occupancy.total_booked, occupancy.few_count), (1, 1))
+        self.assertFalse(DailyOccupancy.objects.filter(date=date(2020, 1, 1)).exists())
 
-        self.assertFalse(self.booking.is_updated_by_others(dt_before_save, user1))
-        self.assertFalse(self.booking.is_updated_by_others(dt_after_save, user1))
-        self.assertTrue(self.booking.is_updated_by_others(dt_before_save, user2))
-        self.assertFalse(self.booking.is_updated_by_others(dt_after_save, user2))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bl3.delete()
+        occupancy.refresh_from_db()
+        self.assertEqual((occupancy.total_limit, occupancy.total_booked, occupancy.few_count), (0, 0, 0))
@@ -0,0 +1,85 @@
+from datetime import date, datetime
+from unittest.mock import patch
+
+from django.db.models import F
+from django.test import TestCase
+from django.utils.timezone import make_aware
+
+from yoyaku.booking.models import Booking
+from yoyaku.booking.staff_assignment import auto_assign_staff, distribute
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, StaffFactory
+
+
+class TestDistribute(TestCase):
+
+    def test_least_loaded(self):
+        """担当件数が少ないスタッフから順に割り当てる"""
+        slots = [([1, 2], set()), ([3], set()), ([4, 5, 6], set())]
+        assignments = distribute(slots, [10, 20, 30], loads={10: 2})
+        self.assertEqual(assignments, {1: 20, 2: 30, 3: 20, 4: 30, 5: 10, 6: 20})
+
+    def test_slot_conflict(self):
+        """予約枠に割り当て済みのスタッフと、同じ予約枠内で割り当てたスタッフは割り当てない"""
+        slots = [([1, 2, 3], {10})]
+        assignments = distribute(slots, [10, 20, 30])
+        self.assertEqual(assignments, {1: 20, 2: 30})
+
+    def test_no_staff(self):
+        self.assertEqual(distribute([([1], set())], []), {})
+
+
+class TestAutoAssignStaff(TestCase):
+
+    def setUp(self):
+        self.staff1 = StaffFactory()
+        self.staff2 = StaffFactory()
+        StaffFactory(is_active=False)
+        self.bl1 = BookingLimitFactory(limit=3, start_datetime=make_aware(datetime(2020, 1, 1, 10)))
+        self.bl2 = BookingLimitFactory(limit=3, start_datetime=make_aware(datetime(2020, 1, 2, 10)))
+        self.assigned = BookingFactory(booking_limit=self.bl1, staff=self.staff1)
+        self.bookings = [
+            BookingFactory(booking_limit=self.bl1, staff=None),
+            BookingFactory(booking_limit=self.bl1, staff=None),
+            BookingFactory(booking_limit=self.bl2, staff=None),
+        ]
+
+    def test_auto_assign_staff(self):
+        result = auto_assign_staff(date(2020, 1, 1), date(2020, 1, 3), updated_by=self.staff1)
+
+        b1, b2, b3 = self.bookings
+        # b2はbl1に割り当てられるスタッフがいない。b3は担当件数が同じためidの小さいスタッフを割り当てる
+        self.assertEqual(result.assignments, {b1.id: self.staff2.id, b3.id: self.staff1.id})
+        self.assertEqual(result.loads, {self.staff1.id: 2, self.staff2.id: 1})
+        self.assertEqual(result.skipped, 1)
+        staff_ids = dict(Booking.objects.values_list('id', 'staff_id'))
+        self.assertEqual([staff_ids[b.id] for b in self.bookings], [self.staff2.id, None, self.staff1.id])
+        self.assertEqual(result.conflicts, [])
+        b1.refresh_from_db()
+        self.assertEqual((b1.version, b1.updated_by), (2, self.staff1))
+
+    def test_conflicts(self):
+        """割り当て中に版数が変わった予約は更新しない"""
+        b1 = self.bookings[0]
+        bulk_assign_staff = Booking.objects.bulk_assign_staff
+
+        def change_and_assign(*args, **kwargs):
+            Booking.objects.filter(id=b1.id).update(version=F('version') + 1)
+            return bulk_assign_staff(*args, **kwargs)
+
+        with patch.object(Booking.objects, 'bulk_assign_staff', side_effect=change_and_assign):
+            result = auto_assign_staff(date(2020, 1, 1), date(2020, 1, 3))
+        self.assertEqual(result.assignments, {self.bookings[2].id: self.staff1.id})
+        self.assertEqual(result.conflicts, [b1.id])
+        self.assertEqual(result.skipped, 1)
+        b1.refresh_from_db()
+        self.assertIsNone(b1.staff)
+
+    def test_date_range(self):
+        """終了日は含まない"""
+        result = auto_assign_staff(date(2020, 1, 2), date(2020, 1, 3))
+        self.assertEqual(result.assignments, {self.bookings[2].id: self.staff1.id})
+
+    def test_dry_run(self):
+        result = auto_assign_staff(date(2020, 1, 1), date(2020, 1, 3), dry_run=True)
+        self.assertEqual(len(result.assignments), 2)
+        self.assertFalse(Booking.objects.filter(id__in=[b.id for b in self.bookings], staff__isnull=False).exists())
@@ -1,9 +1,13 @@
-from datetime import timezone
+import json
 
+from django.core.cache import cache
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.timezone import utc
 
+from yoyaku.accounts.models import User
 from yoyaku.booking.forms import *
 from yoyaku.booking.models import Booking, BookingLimit
 from yoyaku.booking.utils import get_today0000
@@ -13,9 +17,25 @@ from yoyaku.tests.test_case import AuthViewTestCase
 
 class TestBookingLimitListView(AuthViewTestCase):
     def setUp(self):
+        cache.clear()
         self.login()
         self.viewname = 'booking:予約枠一覧'
 
+    def test_get_constant_queries(self):
+        """予約枠の数によらずクエリ数が一定"""
+        def count_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse(self.viewname))
+            return len(queries)
+
+        BookingFactory(booking_limit=BookingLimitFactory(limit=2, start_datetime=get_today0000() + timedelta(hours=9)))
+        expected = count_queries()
+        for i in range(1, settings.DISP_DAYS, 7):
+            bl = BookingLimitFactory(limit=2, start_datetime=get_today0000() + timedelta(days=i, hours=9))
+            BookingFactory(booking_limit=bl)
+        self.assertEqual(count_queries(), expected)
+
     def test_get(self):
         """初回表示 ページ数指定なし"""
         res = self.client.get(reverse(self.viewname))
@@ -77,6 +97,7 @@ class TestBookingLimitListView(AuthViewTestCase):
 class TestBookingListView(AuthViewTestCase):
 
     def setUp(self):
+        cache.clear()
         self.login()
         self.set_bookings()
         self.viewname = 'booking:予約一覧'
@@ -95,13 +116,54 @@ class TestBookingListView(AuthViewTestCase):
                 booking_limit=bl_list[int(i / 2)],
             )
 
+    @override_settings(PER_PAGE_SET=[5, 10], CURSOR_PAGINATION=True)
+    def test_cursor_pagination(self):
+        expected = list(
+            Booking.objects.filter(booking_limit__start_datetime__gte=get_today0000())
+            .order_by('booking_limit__start_datetime', 'id')
+        )
+        object_list = []
+        params = {'page_size': 5}
+        while True:
+            res = self.client.get(reverse(self.viewname), params)
+            page_obj = res.context['page_obj']
+            object_list.extend(page_obj.object_list)
+            if not page_obj.has_next():
+                break
+            params['cursor'] = page_obj.next_cursor()
+        self.assertEqual(object_list, expected)
+
+    @override_settings(PER_PAGE_SET=[1, 10])
+    def test_staff_options_rendered_once(self):
+        """スタッフの選択肢は行数によらずページ内で1回だけ描画し、各行は現在のスタッフのみ描画する"""
+        staff = StaffFactory()
+        option = f'<option value="{staff.id}">{staff.username}</option>'
+        counts = []
+        for page_size in settings.PER_PAGE_SET:
+            with self.subTest(page_size=page_size):
+                res = self.client.get(reverse(self.viewname), {'page_size': page_size})
+                rows = len(res.context['page_obj'].object_list)
+                self.assertContains(res, 'class="form-control select-staff"', count=rows)
+                counts.append(res.content.decode().count(option))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_inactive_staff_option(self):
+        """無効なスタッフが割り当てられた予約は、その行のみ選択肢に表示する"""
+        staff = StaffFactory(is_active=False)
+        booking = Booking.objects.filter(booking_limit__start_datetime__gte=get_today0000()).earliest('booking_limit__start_datetime', 'id')
+        booking.staff = staff
+        booking.save()
+        res = self.client.get(reverse(self.viewname))
+        self.assertNotIn((staff.id, staff.username), res.context['staff_choices'])
+        self.assertContains(res, f'<option value="{staff.id}" selected>{staff.username}</option>', count=1)
+
     def test_get_if_booking_zero(self):
         """予約0件時のテスト"""
         BookingLimit.objects.all().delete()
         res = self.client.get(reverse(self.viewname))
 
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(res.context['staff_form_list'], [])
+        self.assertEqual(len(res.context['staff_choices']), User.staffs.is_active().count())
         self.assertEqual(res.context['where_str'], '')
         self.assertTemplateUsed(res, 'booking/booking_list.html')
 
@@ -326,13 +388,13 @@ class TestUpdateBookingUserView(AuthViewTestCase):
             {
                 'staff_id': self.staff.id,
                 'booking_id': self.booking.id,
-                'requested_at': datetime.now(),
+                'version': self.booking.version,
             },
             HTTP_X_REQUESTED_WITH='XMLHttpRequest',
         )
         self.booking.refresh_from_db()
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(res.content.decode('utf-8'), '{"msg": "スタッフを更新しました。"}')
+        self.assertEqual(res.content.decode('utf-8'), '{"msg": "スタッフを更新しました。", "version": 2}')
         self.assertEqual(self.booking.staff.id, self.staff.id)
         self.assertEqual(self.booking.updated_by, self.staff)
 
@@ -352,7 +414,7 @@ class TestUpdateBookingUserView(AuthViewTestCase):
             {
                 'staff_id': not_active_staff.id,
                 'booking_id': self.booking.id,
-                'requested_at': datetime.now(),
+                'version': self.booking.version,
             },
             HTTP_X_REQUESTED_WITH='XMLHttpRequest',
         )
@@ -367,29 +429,118 @@ class TestUpdateBookingUserView(AuthViewTestCase):
             reverse(self.viewname),
             {
                 'staff_id': self.booking.staff.id,
-                'booking_id': 11,
-                'requested_at': datetime.now(),
+                'booking_id': 0,
+                'version': self.booking.version,
             },
             HTTP_X_REQUESTED_WITH='XMLHttpRequest',
         )
         self.assertEqual(res.content.decode('utf-8'), '{"msg": "reload"}')
 
+    def test_post_constant_queries(self):
+        """予約の読み込みをせず、1回のUPDATEで更新する"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(
+                reverse(self.viewname),
+                {'staff_id': self.staff.id, 'booking_id': self.booking.id, 'version': self.booking.version},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            )
+        sql_list = [q['sql'] for q in queries if 'booking_booking' in q['sql']]
+        self.assertEqual(len(sql_list), 1)
+        self.assertTrue(sql_list[0].startswith('UPDATE'))
+
+    def test_post_unassign(self):
+        """スタッフを未定義に変更する"""
+        res = self.client.post(
+            reverse(self.viewname),
+            {'staff_id': '', 'booking_id': self.booking.id, 'version': self.booking.version},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        self.assertEqual(res.content.decode('utf-8'), '{"msg": "スタッフを更新しました。", "version": 2}')
+        self.booking.refresh_from_db()
+        self.assertIsNone(self.booking.staff)
+
+    def test_invalid_version(self):
+        res = self.client.post(
+            reverse(self.viewname),
+            {'staff_id': self.staff.id, 'booking_id': self.booking.id, 'version': 'a'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        self.assertEqual(res.content.decode('utf-8'), '{"msg": "reload"}')
+
     def test_updated_by_others(self):
-        requested_at = datetime.now(tz=timezone.utc)
+        """読み込み後に他ユーザにより更新された場合は更新しない"""
+        version = self.booking.version
         staff_sub = StaffFactory()
         self.booking.updated_by = staff_sub
-        self.booking.updated_at = datetime.now(tz=timezone.utc)
         self.booking.save()
         res = self.client.post(
             reverse(self.viewname),
             {
-                'staff_id': self.booking.staff.id,
+                'staff_id': self.staff.id,
                 'booking_id': self.booking.id,
-                'requested_at': requested_at,
+                'version': version,
             },
             HTTP_X_REQUESTED_WITH='XMLHttpRequest',
         )
         self.assertEqual(res.content.decode('utf-8'), '{"msg": "reload"}')
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.updated_by, staff_sub)
+
+
+class TestBulkUpdateBookingUserView(AuthViewTestCase):
+
+    def setUp(self):
+        self.login()
+        bl = BookingLimitFactory(limit=3, start_datetime=datetime(2020, 1, 1, tzinfo=utc))
+        self.bookings = [BookingFactory(booking_limit=bl, staff=None) for _ in range(3)]
+        self.viewname = 'booking:予約担当一括変更'
+
+    def post(self, assignments):
+        return self.client.post(
+            reverse(self.viewname),
+            {'assignments': json.dumps(assignments)},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+
+    def test_post(self):
+        res = self.post([[b.id, b.version, self.staff.id] for b in self.bookings])
+        self.assertEqual(res.status_code, 200)
+        result = json.loads(res.content)
+        self.assertEqual(result['updated'], {str(b.id): 2 for b in self.bookings})
+        self.assertEqual(result['conflicts'], [])
+        self.assertEqual(Booking.objects.filter(staff=self.staff).count(), len(self.bookings))
+
+    def test_post_constant_queries(self):
+        """予約の件数によらずクエリ数が一定"""
+        def count_queries(bookings):
+            with CaptureQueriesContext(connection) as queries:
+                self.post([[b.id, b.version, self.staff.id] for b in bookings])
+            return len(queries)
+
+        expected = count_queries(self.bookings[:1])
+        for b in self.bookings:
+            b.refresh_from_db()
+        self.assertEqual(count_queries(self.bookings), expected)
+
+    def test_post_conflicts(self):
+        b1, b2, b3 = self.bookings
+        b1.save()
+        res = self.post([[b.id, 1, None if b == b2 else self.staff.id] for b in self.bookings])
+        result = json.loads(res.content)
+        self.assertEqual(result['updated'], {str(b2.id): 2, str(b3.id): 2})
+        self.assertEqual(result['conflicts'], [b1.id])
+
+    def test_invalid_assignments(self):
+        for value in ['', '[1]', '[[1, 2]]', '[["a", 1, null]]', '{"a": 1}']:
+            with self.subTest(value=value):
+                res = self.client.post(
+                    reverse(self.viewname), {'assignments': value}, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+                )
+                self.assertEqual(res.content.decode('utf-8'), '{"msg": "reload"}')
+
+    def test_is_not_ajax_error(self):
+        res = self.client.post(reverse(self.viewname), {})
+        self.assertEqual(res.status_code, 404)
 
 
 class TestBookingDeleteView(AuthViewTestCase):
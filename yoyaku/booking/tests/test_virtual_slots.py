@@ -0,0 +1,68 @@
+from datetime import datetime, time, timedelta
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils.timezone import localdate, make_aware
+
+from yoyaku.booking import availability_cache, virtual_slots
+from yoyaku.booking.models import BookingLimit
+from yoyaku.tests.factories import BookingLimitFactory
+
+
+@override_settings(VIRTUAL_SLOT_LIMIT=2)
+class TestVirtualSlots(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tomorrow = localdate() + timedelta(days=1)
+        self.bl = BookingLimitFactory(limit=1, start_datetime=make_aware(datetime.combine(self.tomorrow, time(9))))
+
+    def test_get_slots(self):
+        slots = availability_cache.get_slots(self.tomorrow - timedelta(days=2), self.tomorrow + timedelta(days=1))
+        # 当日より前の日は仮想予約枠を追加しない
+        self.assertEqual(len(slots), 26 * 2)
+        self.assertEqual(len([slot for slot in slots if slot['id'] is None]), 26 * 2 - 1)
+
+        tomorrow_slots = [slot for slot in slots if localdate(slot['start_datetime']) == self.tomorrow]
+        self.assertEqual(tomorrow_slots[0]['id'], self.bl.id)
+        self.assertEqual(tomorrow_slots[1], {
+            'id': None,
+            'start_datetime': make_aware(datetime.combine(self.tomorrow, time(9, 30))),
+            'limit': 2,
+            'booked_count': 0,
+            'state': '●',
+        })
+
+    def test_materialize(self):
+        start_datetime = make_aware(datetime.combine(self.tomorrow, time(9, 30)))
+        bl = virtual_slots.materialize(start_datetime)
+        self.assertEqual(bl.limit, 2)
+        self.assertEqual(virtual_slots.materialize(start_datetime), bl)
+        self.assertEqual(virtual_slots.materialize(self.bl.start_datetime), self.bl)
+
+        for invalid in (
+            make_aware(datetime.combine(self.tomorrow, time(9, 15))),
+            make_aware(datetime.combine(self.tomorrow, time(22))),
+            make_aware(datetime.combine(self.tomorrow - timedelta(days=2), time(9))),
+        ):
+            with self.subTest(start_datetime=invalid):
+                self.assertIsNone(virtual_slots.materialize(invalid))
+        self.assertEqual(BookingLimit.objects.count(), 2)
+
+    @override_settings(VIRTUAL_SLOT_DAYS=2)
+    def test_days(self):
+        """仮想予約枠はVIRTUAL_SLOT_DAYS日後まで"""
+        slots = availability_cache.get_slots(self.tomorrow, self.tomorrow + timedelta(days=3))
+        self.assertEqual({localdate(slot['start_datetime']) for slot in slots}, {self.tomorrow})
+
+        self.assertIsNotNone(virtual_slots.materialize(make_aware(datetime.combine(self.tomorrow, time(10)))))
+        self.assertIsNone(
+            virtual_slots.materialize(make_aware(datetime.combine(self.tomorrow + timedelta(days=1), time(10)))))
+        self.assertIsNone(virtual_slots.materialize(make_aware(datetime(2999, 1, 1, 10))))
+        self.assertEqual(BookingLimit.objects.count(), 2)
+
+    @override_settings(VIRTUAL_SLOT_LIMIT=None)
+    def test_disabled(self):
+        slots = availability_cache.get_slots(self.tomorrow, self.tomorrow + timedelta(days=1))
+        self.assertEqual(len(slots), 1)
+        self.assertIsNone(virtual_slots.materialize(make_aware(datetime.combine(self.tomorrow, time(9, 30)))))
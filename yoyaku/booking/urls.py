@@ -12,4 +12,5 @@ urlpatterns = [
     path('<int:pk>/update', views.BookingUpdateView.as_view(), name='予約変更'),
     path('<int:pk>/delete', views.BookingDeleteView.as_view(), name='予約削除'),
     path('update_booking_user', views.UpdateBookingUserView.as_view(), name='予約担当変更'),
+    path('bulk_update_booking_user', views.BulkUpdateBookingUserView.as_view(), name='予約担当一括変更'),
 ]
@@ -1,5 +1,5 @@
 import json
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
@@ -7,15 +7,17 @@ from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.utils.decorators import method_decorator
-from django.utils.timezone import make_aware, utc
+from django.utils.timezone import localdate, make_aware
 from django.views.decorators.http import require_POST
 from django.views.generic.base import TemplateView, View
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
 from django.views.generic.list import ListView
 
 from yoyaku.accounts.models import User
-from yoyaku.booking.forms import BookingForm, BookingLimitEditForm, BookingSearchForm, UpdateStaffForm
-from yoyaku.booking.models import Booking, BookingLimit
+from yoyaku.booking import availability_cache
+from yoyaku.booking.forms import BookingForm, BookingLimitEditForm, BookingSearchForm
+from yoyaku.booking.models import Booking
+from yoyaku.core.pagination import CachedCountPaginator, CursorPaginationMixin
 from yoyaku.core.utils import clean_page_size
 from yoyaku.booking.utils import get_time_frames, get_today0000
 
@@ -45,13 +47,8 @@ class BookingLimitListView(TemplateView):
         except (OverflowError, ValueError):
             raise Http404()
 
-        limit_list = (
-            BookingLimit.objects.prefetch_related('bookings')
-            .filter(
-                start_datetime__gte=str(start),
-                start_datetime__lt=str(start + timedelta(days=settings.DISP_DAYS)),
-            )
-            .order_by('start_datetime')
+        limit_list = availability_cache.get_slots(
+            localdate(start), localdate(start + timedelta(days=settings.DISP_DAYS))
         )
 
         context.update({
@@ -74,7 +71,7 @@ class BookingLimitListView(TemplateView):
 
 
 @method_decorator(login_required, name='dispatch')
-class BookingListView(ListView):
+class BookingListView(CursorPaginationMixin, ListView):
     """予約一覧"""
     extra_context = {
         'segment': '予約',
@@ -89,7 +86,9 @@ class BookingListView(ListView):
     model = Booking
     form_class = BookingSearchForm
     ordering = 'booking_limit__start_datetime'
+    cursor_ordering = ['booking_limit__start_datetime', 'id']
     paginate_by = settings.PER_PAGE_SET[0]
+    paginator_class = CachedCountPaginator
 
     def get_search_str(self, data):
         """
@@ -148,26 +147,16 @@ class BookingListView(ListView):
             .order_by(self.ordering)
         )
 
-    def get_staff_form_list(self, page_obj):
-        # 管理者以外のスタッフを表示する
-        staff_choices = [('', '未定義')]
-        staff_choices.extend(list(User.staffs.is_active().values_list('id', 'username')))
-
-        result = []
-        for b in page_obj.object_list:
-            initial = {'staff': b.staff_id} if b.staff_id else {}
-
-            if b.staff and not b.staff.is_active:
-                deleted_staff = [(b.staff_id, b.staff.username)]
-                result.append(UpdateStaffForm(choices=staff_choices + deleted_staff, initial=initial))
-            else:
-                result.append(UpdateStaffForm(choices=staff_choices, initial=initial))
-
-        return result
+    def get_staff_choices(self):
+        """
+        スタッフの選択肢。ページ内で1回だけ描画し、各行のセレクトボックスで共有する
+        無効なスタッフが割り当てられている予約は、その行のみ選択肢に追加する
+        """
+        return list(User.staffs.is_active().values_list('id', 'username'))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['staff_form_list'] = self.get_staff_form_list(context['page_obj'])
+        context['staff_choices'] = self.get_staff_choices()
         context['where_str'] = self.get_search_str(self.request.GET)
         context['form'] = self.form_class()
         return context
@@ -254,28 +243,50 @@ class UpdateBookingUserView(View):
         return super().dispatch(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
-        result = {'msg': 'スタッフを更新しました。'}
+        """読み込み時から他ユーザにより更新された場合や、スタッフが無効な場合はリロードメッセージを返す"""
+        result = {'msg': 'reload'}
         try:
-            staff_id = request.POST['staff_id']
-            booking_id = request.POST['booking_id']
-            requested_at = request.POST['requested_at']
-            staff = None
-            if staff_id:
-                staff = User.staffs.get(id=staff_id, is_active=True)
-            booking = Booking.objects.get(id=booking_id)
-
-            # 他ユーザによる更新確認
-            dt = datetime.fromisoformat(requested_at).astimezone(utc)
-            if booking.is_updated_by_others(dt, request.user):
-                json_str = json.dumps({'msg': 'reload'}, ensure_ascii=False)
-                return HttpResponse(json_str)
-
-            booking.staff = staff
-            booking.updated_by = request.user
-            booking.save()
-        except (Booking.DoesNotExist, User.DoesNotExist, ValueError):
-            result['msg'] = 'reload'
+            staff_id = int(request.POST['staff_id']) if request.POST['staff_id'] else None
+            booking_id = int(request.POST['booking_id'])
+            version = int(request.POST['version'])
+        except ValueError:
+            version = None
+
+        if version is not None and Booking.objects.assign_staff(booking_id, version, staff_id, request.user):
+            result = {'msg': 'スタッフを更新しました。', 'version': version + 1}
+
+        json_str = json.dumps(result, ensure_ascii=False)
+        return HttpResponse(json_str)
 
+
+@method_decorator(login_required, name='dispatch')
+@method_decorator(require_POST, name='dispatch')
+class BulkUpdateBookingUserView(UpdateBookingUserView):
+    """
+    選択した複数の予約の担当スタッフを一括で変更する
+    assignments: [予約id, 版数, スタッフid]のリストのJSON 未定義にする場合はスタッフidをnull
+    """
+
+    def parse_assignments(self, value):
+        assignments = []
+        for booking_id, version, staff_id in json.loads(value):
+            assignments.append((int(booking_id), int(version), int(staff_id) if staff_id else None))
+        return assignments
+
+    def post(self, request, *args, **kwargs):
+        try:
+            assignments = self.parse_assignments(request.POST['assignments'])
+        except (KeyError, TypeError, ValueError):
+            return HttpResponse(json.dumps({'msg': 'reload'}))
+
+        updated, conflicts = Booking.objects.bulk_assign_staff(assignments, request.user)
+        result = {
+            'msg': f'スタッフを{len(updated)}件更新しました。',
+            'updated': updated,
+            'conflicts': conflicts,
+        }
+        if conflicts:
+            result['msg'] += f' {len(conflicts)}件は他のスタッフにより変更されたため更新できませんでした。'
         json_str = json.dumps(result, ensure_ascii=False)
         return HttpResponse(json_str)
 
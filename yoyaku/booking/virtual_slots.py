@@ -0,0 +1,68 @@
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.utils.timezone import localdate, localtime, make_aware
+
+from yoyaku.booking.models import BookingLimit
+from yoyaku.booking.utils import date_range, get_start_times, is_valid_booking_time
+
+# 仮想予約枠は予約枠のデータが存在しない時間枠を、settings.VIRTUAL_SLOT_LIMITの枠数で予約できるものとして表示する。
+# 予約・一時確保・予約枠の編集をした時に初めて予約枠のデータを作成する。
+
+
+def is_enabled():
+    return settings.VIRTUAL_SLOT_LIMIT is not None
+
+
+def get_last_date():
+    """仮想予約枠を使える最後の日。当日からsettings.VIRTUAL_SLOT_DAYS日間"""
+    return localdate() + timedelta(days=settings.VIRTUAL_SLOT_DAYS - 1)
+
+
+def is_frame(start_datetime):
+    """仮想予約枠の開始日時として正しいかどうか。当日より前と、仮想予約枠を使える最後の日より後の日時は対象外"""
+    dt = localtime(start_datetime)
+    return (
+        is_valid_booking_time(dt)
+        and dt.second == 0 and dt.microsecond == 0
+        and localdate() <= dt.date() <= get_last_date()
+    )
+
+
+def get_slot(start_datetime):
+    """仮想予約枠の辞書を返す。キャッシュする予約枠と同じ項目で、idはNone"""
+    bl = BookingLimit(limit=settings.VIRTUAL_SLOT_LIMIT, start_datetime=start_datetime)
+    return {
+        'id': None,
+        'start_datetime': start_datetime,
+        'limit': bl.limit,
+        'booked_count': bl.booked_count,
+        'state': bl.get_state(),
+    }
+
+
+def fill(slots_by_day, start_date, end_date):
+    """
+    日付をキーにした予約枠の辞書に、予約枠がない時間枠の仮想予約枠を追加する
+    start_date: datetime.date 開始日
+    end_date: datetime.date 終了日(含まない)
+    """
+    start_times = [time.fromisoformat(t) for t in get_start_times()]
+    for d in date_range(max(start_date, localdate()), min(end_date - timedelta(days=1), get_last_date())):
+        slots = slots_by_day.setdefault(d, [])
+        existing = {localtime(bl['start_datetime']).time() for bl in slots}
+        slots.extend(get_slot(make_aware(datetime.combine(d, t))) for t in start_times if t not in existing)
+        slots.sort(key=lambda bl: bl['start_datetime'])
+    return slots_by_day
+
+
+def materialize(start_datetime):
+    """
+    仮想予約枠の予約枠のデータを返す。存在しない場合は既定の枠数で作成する。
+    仮想予約枠を使わない場合や、開始日時が正しくない場合はNone
+    """
+    if not is_enabled() or not is_frame(start_datetime):
+        return None
+    bl, _ = BookingLimit.objects.get_or_create(
+        start_datetime=start_datetime, defaults={'limit': settings.VIRTUAL_SLOT_LIMIT})
+    return bl
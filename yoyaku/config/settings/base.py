@@ -162,11 +162,44 @@ CACHES = {
     }
 }
 
+# 予約枠の空き状況のキャッシュ保持時間(秒) 予約、予約枠の変更時は該当日のキャッシュを削除する
+AVAILABILITY_CACHE_TIMEOUT = 60 * 60
+
+# 予約フォームで予約枠を選択してから一時確保しておく時間(分)
+SEAT_HOLD_MINUTES = 10
+
+# 予約枠のデータがない時間枠を予約できる仮想予約枠として表示する場合の枠数。Noneの場合は使わない
+# 仮想予約枠は予約・予約枠の編集時に予約枠のデータを作成する
+VIRTUAL_SLOT_LIMIT = None
+# 仮想予約枠を使える日数(当日を含む)。これより先の日時は予約枠のデータがある場合のみ予約できる
+VIRTUAL_SLOT_DAYS = 60
+
+# 予約フォームに同時に入場できる顧客の数。Noneの場合は順番待ちを行わない
+# 予約の受付開始時など、アクセスが集中する時のみ設定する
+WAITING_ROOM_CAPACITY = None
+# 予約フォームに入場してから予約を送信できる時間(秒)
+WAITING_ROOM_ADMISSION_SECONDS = 60 * 15
+
 
 AUTH_USER_IDS = (1,)
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# システムメールの更新日時のキャッシュ保持時間(秒) システムメールの変更時は削除する
+SYSTEM_MAIL_CACHE_TIMEOUT = 60 * 5
+
+# 送信待ちメールの送信を試行する回数。超えた場合は送信失敗とする
+MAIL_OUTBOX_MAX_ATTEMPTS = 5
+# 送信待ちメールの送信に失敗した場合に再送信するまでの時間(秒) 失敗する度に2倍にする
+MAIL_OUTBOX_RETRY_SECONDS = 60
+# 送信待ちメールを1秒間に送信する最大の件数。Noneの場合は制限しない
+MAIL_OUTBOX_RATE_LIMIT = None
+# 送信待ちメールを送信中にしておく時間(秒) 送信中にワーカーが停止した場合は、この時間が過ぎてから再送信する
+MAIL_OUTBOX_LEASE_SECONDS = 60 * 5
+# deliver_mailコマンドを常時実行して送信待ちメールを送信する場合はTrue
+# Falseの場合は、予約完了メールを予約のコミット後にリクエスト内で送信する
+MAIL_OUTBOX_WORKER = True
+
 HOSTNAME = ''
 YOYAKU_ADMIN_PATH = 'yoyaku-admin'
 SITE_NAME = 'YOYAKU'
@@ -174,8 +207,16 @@ SITE_NAME = 'YOYAKU'
 # 一覧に表示するレコード数の切り替えリスト
 PER_PAGE_SET = (25, 50, 100)
 
+# 予約一覧と顧客一覧のページ送りを、ページ番号ではなくカーソルで行うかどうか。件数が多い場合に使う
+CURSOR_PAGINATION = False
+
+# 一覧の件数をキャッシュする時間(秒)
+COUNT_CACHE_TIMEOUT = 60
+# 一覧の件数がこの件数を超える場合はDBの統計情報から推定した概算の件数を表示する。Noneの場合は常に正確な件数を表示する
+APPROXIMATE_COUNT_THRESHOLD = 10000
+
 # 表示日数
-DISP_DAYS = 14
+DISP_DAYS = 60
 
 # 受付時間 09:00 ~ 22:00
 START_TIME = '09:00'
@@ -0,0 +1,296 @@
+import base64
+import hashlib
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+COUNT_KEY_PREFIX = 'count'
+
+
+def can_estimate(queryset):
+    """DBの統計情報から件数を推定できるかどうか"""
+    return connections[queryset.db].vendor in ('postgresql', 'mysql')
+
+
+def estimate_count(queryset):
+    """
+    DBの統計情報から件数を推定する。推定できない場合はNone
+    PostgreSQLとMySQLの実行計画の行数を使う。
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            return int(plan[0]['Plan']['Plan Rows'])
+
+        if connection.vendor == 'mysql':
+            cursor.execute(f'EXPLAIN {sql}', params)
+            columns = [col[0].lower() for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            if not rows or any(row['rows'] is None for row in rows):
+                return None
+            # 結合する表毎の行数と、検索条件で絞り込まれる割合(%)を掛け合わせる
+            estimated = 1
+            for row in rows:
+                estimated *= row['rows'] * float(row.get('filtered') or 100) / 100
+            return int(estimated)
+
+    return None
+
+
+def get_count(queryset):
+    """
+    検索結果の件数と、概算かどうかを返す。
+    件数は検索条件毎にsettings.COUNT_CACHE_TIMEOUT秒キャッシュする。
+    settings.APPROXIMATE_COUNT_THRESHOLDを超える場合は、DBの統計情報から推定した件数にする。
+    """
+    queryset = queryset.order_by()
+    sql, params = queryset.query.sql_with_params()
+    key = f'{COUNT_KEY_PREFIX}:{hashlib.md5(f"{sql}{params}".encode()).hexdigest()}'
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    threshold = settings.APPROXIMATE_COUNT_THRESHOLD
+    result = None
+    # しきい値までの件数を数え、しきい値を超える場合のみ推定する
+    # 推定できないDBでは全件を数え直すことになるため、しきい値までの件数は数えない
+    if threshold is not None and can_estimate(queryset) and threshold < queryset[:threshold + 1].count():
+        estimated = estimate_count(queryset)
+        if estimated is not None:
+            result = (max(estimated, threshold + 1), True)
+    if result is None:
+        result = (queryset.count(), False)
+
+    cache.set(key, result, settings.COUNT_CACHE_TIMEOUT)
+    return result
+
+
+class CachedCountPaginator(Paginator):
+    """
+    件数をキャッシュし、件数が多い場合は概算にするページネーター
+    概算の場合は最後のページが実際と異なるため、ページ番号の上限を検証せず、
+    概算の件数で取得する範囲を切り詰めずに次のページがあるか判定する。
+    """
+    @cached_property
+    def _count(self):
+        return get_count(self.object_list)
+
+    @property
+    def count(self):
+        return self._count[0]
+
+    @property
+    def is_approximate(self):
+        return self._count[1]
+
+    def validate_number(self, number):
+        if not self.is_approximate:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('ページ番号が正しくありません。')
+        if number < 1:
+            raise EmptyPage('ページ番号が1未満です。')
+        return number
+
+    def page(self, number):
+        if not self.is_approximate:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        # 1件多く取得して、さらに先のページがあるか判定する
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        has_next = len(object_list) > self.per_page
+        return ApproximatePage(object_list[:self.per_page], number, self, has_next)
+
+
+class ApproximatePage(Page):
+    """件数が概算の場合のページ 次のページがあるかは取得した件数で判定する"""
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+def encode_cursor(values, previous=False):
+    """並び順の項目の値とページ送りの方向から、urlに使うカーソル文字列を作成する"""
+    data = {'v': [v.isoformat() if isinstance(v, datetime) else v for v in values], 'p': previous}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソル文字列から(並び順の項目の値のリスト, 前のページかどうか)を返す"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(data['v'], list):
+            raise TypeError
+        return data['v'], bool(data['p'])
+    except (ValueError, TypeError, KeyError):
+        raise Http404('カーソルが正しくありません。')
+
+
+def get_keyset_condition(ordering, values, previous=False):
+    """
+    並び順の項目の値より後(previousの場合は前)のレコードを検索する条件を返す
+    (a > 1) OR (a = 1 AND b > 2) のように、前の項目が同じ値の場合は次の項目で比較する
+    ordering: 並び順の項目のリスト 降順の場合は先頭に-を付ける
+    """
+    condition = Q()
+    for i, field in enumerate(ordering):
+        desc = field.startswith('-')
+        name = field.lstrip('-')
+        lookup = 'lt' if desc != previous else 'gt'
+        q = Q(**{f'{name}__{lookup}': values[i]})
+        for prev_field, prev_value in zip(ordering[:i], values[:i]):
+            q &= Q(**{prev_field.lstrip('-'): prev_value})
+        condition |= q
+    return condition
+
+
+def reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+
+
+class CursorPaginator:
+    """
+    並び順の項目の値をカーソルにしてページ送りするページネーター。
+    OFFSETを使わないため、後ろのページでも検索の負荷が変わらない。
+    ordering: 並び順の項目のリスト 一意になるように最後はidにする
+    """
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = list(ordering)
+
+    @cached_property
+    def _count(self):
+        return get_count(self.queryset)
+
+    @property
+    def count(self):
+        return self._count[0]
+
+    @property
+    def is_approximate(self):
+        return self._count[1]
+
+    def get_page(self, cursor=None):
+        queryset = self.queryset
+        previous = False
+        if cursor:
+            values, previous = decode_cursor(cursor)
+            values = self.to_python(values)
+            queryset = queryset.filter(get_keyset_condition(self.ordering, values, previous))
+
+        ordering = reverse_ordering(self.ordering) if previous else self.ordering
+        # 1件多く取得して、さらに先のページがあるか判定する
+        object_list = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if previous:
+            object_list.reverse()
+            return CursorPage(object_list, self, has_previous=has_more, has_next=True)
+        return CursorPage(object_list, self, has_previous=bool(cursor), has_next=has_more)
+
+    def get_field(self, field):
+        """並び順の項目のモデルのフィールドを返す"""
+        model = self.queryset.model
+        for name in field.lstrip('-').split('__'):
+            model_field = model._meta.get_field(name)
+            model = model_field.related_model
+        return model_field
+
+    def to_python(self, values):
+        """カーソルの値を並び順の項目の型に変換する。変換できない場合は404"""
+        if len(values) != len(self.ordering):
+            raise Http404('カーソルが正しくありません。')
+        try:
+            values = [self.get_field(field).to_python(value) for field, value in zip(self.ordering, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise Http404('カーソルが正しくありません。')
+        if None in values:
+            raise Http404('カーソルが正しくありません。')
+        return values
+
+    def get_values(self, obj):
+        """レコードの並び順の項目の値を返す"""
+        values = []
+        for field in self.ordering:
+            value = obj
+            for name in field.lstrip('-').split('__'):
+                value = getattr(value, name)
+            values.append(value)
+        return values
+
+
+class CursorPage:
+    """カーソルでページ送りする場合のpage_obj"""
+    def __init__(self, object_list, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_previous = has_previous and bool(object_list)
+        self._has_next = has_next and bool(object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def previous_cursor(self):
+        if self.has_previous():
+            return encode_cursor(self.paginator.get_values(self.object_list[0]), previous=True)
+        return None
+
+    def next_cursor(self):
+        if self.has_next():
+            return encode_cursor(self.paginator.get_values(self.object_list[-1]))
+        return None
+
+
+class CursorPaginationMixin:
+    """
+    settings.CURSOR_PAGINATIONがTrueの場合、ListViewのページ送りをカーソルで行う。
+    cursor_ordering: 並び順の項目のリスト
+    """
+    cursor_ordering = None
+
+    def is_cursor_pagination(self):
+        return settings.CURSOR_PAGINATION and self.cursor_ordering is not None
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.is_cursor_pagination():
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = CursorPaginator(queryset, page_size, self.cursor_ordering)
+        page = paginator.get_page(self.request.GET.get('cursor'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cursor_pagination'] = self.is_cursor_pagination()
+        return context
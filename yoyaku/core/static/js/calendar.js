@@ -21,7 +21,9 @@ function datetime_format(date) {
 }
 
 original = {
-    initFullCalendar: function(slotMinTime, slotMaxTime) {
+    // eventsUrl: 表示期間の予約枠の状態を返すurl
+    // holdUrl: 選択した予約枠を一時確保するurl
+    initFullCalendar: function(slotMinTime, slotMaxTime, eventsUrl, holdUrl) {
         document.addEventListener('DOMContentLoaded', function() {
             var calendarEl = document.getElementById('fullCalendar');
             $calendar = $('#fullCalendar');
@@ -71,6 +73,28 @@ original = {
                     }
                 ],
 
+                // 表示期間の予約枠のみ取得してカレンダーに追加する
+                eventSources: [{
+                    events: function(fetchInfo, successCallback, failureCallback) {
+                        $.ajax({
+                            type: "GET",
+                            url: eventsUrl,
+                            data: {
+                                "start": fetchInfo.startStr,
+                                "end": fetchInfo.endStr,
+                            },
+                            dataType: "json",
+                        }).done(function(data) {
+                            // 再取得したイベントは選択中の予約枠のidで色付けする
+                            selectedEvent = null;
+                            successCallback(data.slots.map(createEvent));
+                            showSelectedName();
+                        }).fail(function(XMLHttpRequest, status, e) {
+                            failureCallback(e);
+                        });
+                    },
+                }],
+
                 eventClick: function(info) {
                     // 満席の予約枠を選択した場合は何もしない
                     if (info.event.title == "×") {
@@ -79,33 +103,60 @@ original = {
                     // 値を取得
                     target_id = "id_booking_limit"
                     var element = document.getElementById(target_id);
+                    var holdElement = document.getElementById("id_seat_hold");
                     const selelcted_id = element.value;
-                    if (selelcted_id) {
-                        old_event = calendar.getEventById(selelcted_id);
-                        // selected_idのイベントを取得して背景色をリセット
-                        old_event.setProp("backgroundColor", '#ffffff'); //白色
-                        old_event.setProp("borderColor", old_event.textColor);
+                    if (info.event.id == selelcted_id || info.event == selectedEvent) {
+                        return;
                     }
-                    document.getElementById("selected_name").innerText = datetime_format(info.event.start);
-                    document.getElementById("selected_name2").innerText = datetime_format(info.event.start);
-                    element.value = info.event.id;
-                    element.dataset.backgroundColor = info.event.backgroundColor;
-                    element.dataset.borderColor = info.event.borderColor;
-
-                    info.event.setProp("backgroundColor", '#ffea58'); // 黄色
-                    info.event.setProp("borderColor", '#ff5c88'); // 赤色
+
+                    // 予約枠を一時確保できた場合のみ選択する。前に確保した予約枠は解放される
+                    $.ajax({
+                        type: "POST",
+                        url: holdUrl,
+                        data: {
+                            "booking_limit": info.event.extendedProps.bookingLimitId,
+                            "start_datetime": info.event.extendedProps.startStr,
+                            "csrfmiddlewaretoken": $("input[name=csrfmiddlewaretoken]").val(),
+                        },
+                        dataType: "json",
+                    }).done(function(data) {
+                        holdElement.value = data.token;
+                        old_event = selectedEvent || (selelcted_id ? calendar.getEventById(selelcted_id) : null);
+                        // 表示期間内にselected_idのイベントがあれば背景色をリセット
+                        if (old_event) {
+                            old_event.setProp("backgroundColor", '#ffffff'); //白色
+                            old_event.setProp("borderColor", old_event.textColor);
+                        }
+                        document.getElementById("selected_name").innerText = datetime_format(info.event.start);
+                        document.getElementById("selected_name2").innerText = datetime_format(info.event.start);
+                        // 仮想予約枠の場合は作成された予約枠のidになる
+                        element.value = data.booking_limit;
+                        selectedEvent = info.event;
+                        element.dataset.backgroundColor = info.event.backgroundColor;
+                        element.dataset.borderColor = info.event.borderColor;
+
+                        info.event.setProp("backgroundColor", '#ffea58'); // 黄色
+                        info.event.setProp("borderColor", '#ff5c88'); // 赤色
+                    }).fail(function(XMLHttpRequest) {
+                        var data = XMLHttpRequest.responseJSON;
+                        alert(data && data.msg ? data.msg : '予約枠を確保できませんでした。');
+                        // 満席になった予約枠の表示を更新する
+                        calendar.refetchEvents();
+                    });
                 },
             });
-            // 予約枠をカレンダーに追加
-            var name = document.getElementsByName('hidden');
             var element = document.getElementById("id_booking_limit");
             const selelcted_id = element.value;
+            var selectedEvent = null;
 
-            name.forEach(element => {
-                var start = new Date(Date.parse(element.dataset.startdatetime));
-                var end = new Date(Date.parse(element.dataset.startdatetime));
+            // 予約枠 [id, 開始日時, 状態] からカレンダーのイベントを作成
+            // 仮想予約枠はidがないため、開始日時をイベントのidにする
+            function createEvent(slot) {
+                var id = slot[0] === null ? slot[1] : String(slot[0]);
+                var start = new Date(Date.parse(slot[1]));
+                var end = new Date(Date.parse(slot[1]));
                 end.setMinutes(end.getMinutes() + 30); // 30分枠に固定
-                var state = element.dataset.state;
+                var state = slot[2];
 
                 var textcolor = '';
                 if (state == "●") {
@@ -116,17 +167,21 @@ original = {
                     textcolor = '#999999';
                 }
 
-                backgroundColor ='#ffffff';
-                borderColor = textcolor;
-                
-                // フォームエラーで再読み込みしたとき前回選択した予約枠があれば色付けする。
-                if (element.id == selelcted_id){
+                var backgroundColor = '#ffffff';
+                var borderColor = textcolor;
+
+                // フォームエラーで再読み込みしたときや表示期間を変更したとき、選択中の予約枠があれば色付けする。
+                if (id == element.value) {
                     backgroundColor = '#ffea58';
                     borderColor = '#ff5c88';
                 }
-                
-                var event = {
-                    id: element.id,
+
+                return {
+                    id: id,
+                    extendedProps: {
+                        bookingLimitId: slot[0] === null ? '' : slot[0],
+                        startStr: slot[1],
+                    },
                     title: state,
                     start: start,
                     end: end,
@@ -134,18 +189,22 @@ original = {
                     backgroundColor: backgroundColor,
                     borderColor: borderColor,
                 };
-                calendar.addEvent(event);
-            });
-
-            calendar.render();
+            }
 
             // 再読み込みの場合選択した予約枠の開始日時を表示
-            if (selelcted_id != ''){
-                selected_event = calendar.getEventById(selelcted_id);
-                document.getElementById("selected_name").innerText = datetime_format(selected_event.start);
-                document.getElementById("selected_name2").innerText = datetime_format(selected_event.start);
+            function showSelectedName() {
+                if (selelcted_id == '') {
+                    return;
+                }
+                var selected_event = calendar.getEventById(selelcted_id);
+                if (selected_event) {
+                    document.getElementById("selected_name").innerText = datetime_format(selected_event.start);
+                    document.getElementById("selected_name2").innerText = datetime_format(selected_event.start);
+                }
             }
 
+            calendar.render();
+
         });
 
     },
@@ -0,0 +1,143 @@
+import base64
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.http import Http404
+from django.test import TestCase, override_settings
+from django.utils.timezone import make_aware
+
+from yoyaku.booking.models import Booking, BookingLimit
+from yoyaku.core.pagination import CachedCountPaginator, CursorPaginator, encode_cursor, get_count
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory
+
+
+class TestCursorPaginator(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # 開始日時が同じ予約枠はないため、limitの順で並べて同じ値の場合をidで比較する
+        cls.bl_list = [
+            BookingLimitFactory(limit=i // 2, start_datetime=make_aware(datetime(2020, 1, 1, 9 + i)))
+            for i in range(5)
+        ]
+
+    def get_pages(self, ordering):
+        paginator = CursorPaginator(BookingLimit.objects.all(), 2, ordering)
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(pages[-1].next_cursor()))
+        return paginator, pages
+
+    def test_next(self):
+        paginator, pages = self.get_pages(['limit', 'id'])
+        self.assertEqual([page.object_list for page in pages], [self.bl_list[0:2], self.bl_list[2:4], self.bl_list[4:]])
+        self.assertFalse(pages[0].has_previous())
+        self.assertTrue(pages[2].has_previous())
+
+        # 前のページに戻る
+        page = paginator.get_page(pages[2].previous_cursor())
+        self.assertEqual(page.object_list, self.bl_list[2:4])
+        page = paginator.get_page(page.previous_cursor())
+        self.assertEqual(page.object_list, self.bl_list[0:2])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_descending(self):
+        _, pages = self.get_pages(['-start_datetime', '-id'])
+        self.assertEqual(
+            [page.object_list for page in pages],
+            [self.bl_list[4:2:-1], self.bl_list[2:0:-1], self.bl_list[0:1]],
+        )
+
+    def test_invalid_cursor(self):
+        paginator = CursorPaginator(BookingLimit.objects.all(), 2, ['id'])
+        invalid_values = [
+            base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+            for data in ({'v': '1', 'p': False}, {'v': 1, 'p': False}, [1])
+        ]
+        for cursor in ('a', encode_cursor([1, 2]), *invalid_values):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(Http404):
+                    paginator.get_page(cursor)
+
+    def test_invalid_cursor_value(self):
+        """並び順の項目の型に変換できない値のカーソルは404"""
+        paginator = CursorPaginator(BookingLimit.objects.all(), 2, ['start_datetime', 'id'])
+        for values in ([{}, 1], ['abc', 1], [None, 1], ['2020-01-01T09:00:00+09:00', 'abc'], [[], 1]):
+            with self.subTest(values=values):
+                with self.assertRaises(Http404):
+                    paginator.get_page(encode_cursor(values))
+
+        # 関連先の項目の値も変換する
+        bl = self.bl_list[0]
+        BookingFactory(booking_limit=bl)
+        paginator = CursorPaginator(Booking.objects.all(), 2, ['booking_limit__start_datetime', 'id'])
+        for values in ([{}, 1], ['abc', 1]):
+            with self.subTest(values=values):
+                with self.assertRaises(Http404):
+                    paginator.get_page(encode_cursor(values))
+        page = paginator.get_page(encode_cursor([bl.start_datetime.isoformat(), 0]))
+        self.assertEqual(len(page), 1)
+
+
+class TestCachedCountPaginator(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            BookingLimitFactory(limit=i, start_datetime=make_aware(datetime(2020, 1, 1, 9 + i)))
+
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(APPROXIMATE_COUNT_THRESHOLD=None)
+    def test_get_count(self):
+        queryset = BookingLimit.objects.filter(limit__gte=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_count(queryset), (4, False))
+        # 検索条件が同じ場合はキャッシュした件数を使う。並び順は区別しない
+        with self.assertNumQueries(0):
+            self.assertEqual(get_count(queryset.order_by('-id')), (4, False))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_count(queryset.filter(limit__gte=2)), (3, False))
+
+    @override_settings(APPROXIMATE_COUNT_THRESHOLD=3)
+    def test_approximate_count(self):
+        with patch('yoyaku.core.pagination.can_estimate', return_value=True), \
+                patch('yoyaku.core.pagination.estimate_count', return_value=100):
+            paginator = CachedCountPaginator(BookingLimit.objects.order_by('id'), 2)
+            self.assertEqual(paginator.count, 100)
+            self.assertTrue(paginator.is_approximate)
+            # 概算の場合は最後のページを超えてもエラーにしない
+            self.assertEqual(len(paginator.page(10)), 0)
+
+            # しきい値以下の場合は正確な件数
+            paginator = CachedCountPaginator(BookingLimit.objects.filter(limit__lt=3).order_by('id'), 2)
+            self.assertEqual(paginator.count, 3)
+            self.assertFalse(paginator.is_approximate)
+
+    @override_settings(APPROXIMATE_COUNT_THRESHOLD=1)
+    def test_approximate_count_below_actual(self):
+        """推定した件数が実際より少ない場合も、最後のレコードまでページ送りできる"""
+        with patch('yoyaku.core.pagination.can_estimate', return_value=True), \
+                patch('yoyaku.core.pagination.estimate_count', return_value=2):
+            paginator = CachedCountPaginator(BookingLimit.objects.order_by('id'), 2)
+            self.assertEqual(paginator.count, 2)
+            pages = [paginator.page(1)]
+            while pages[-1].has_next():
+                pages.append(paginator.page(pages[-1].next_page_number()))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(
+            [bl for page in pages for bl in page.object_list],
+            list(BookingLimit.objects.order_by('id')),
+        )
+
+    @override_settings(APPROXIMATE_COUNT_THRESHOLD=3)
+    def test_approximate_count_not_estimated(self):
+        """DBの統計情報から推定できない場合は、しきい値までの件数を数えずに正確な件数を数える"""
+        paginator = CachedCountPaginator(BookingLimit.objects.order_by('id'), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 5)
+        self.assertFalse(paginator.is_approximate)
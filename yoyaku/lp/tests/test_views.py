@@ -1,16 +1,19 @@
 from datetime import timedelta
+from unittest.mock import patch
 
 from django.core import mail
-from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
+from django.utils.timezone import localtime, now
 
 from yoyaku.accounts.forms import RegisterCustomerForm
 from yoyaku.accounts.models import User
 from yoyaku.booking.forms import RegisterBookingForm
-from yoyaku.booking.models import Booking
+from yoyaku.booking.models import Booking, BookingLimit, SeatHold
 from yoyaku.booking.utils import get_today0000
-from yoyaku.mail.models import SystemMail
-from yoyaku.tests.factories import BookingLimitFactory, MailAddressFactory
+from yoyaku.mail.models import MailOutbox, SystemMail
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, MailAddressFactory
 
 
 class TestBookingView(TestCase):
@@ -33,7 +36,7 @@ class TestBookingView(TestCase):
         res = self.client.get(reverse(self.viewname))
         self.assertEqual(res.status_code, 200)
         self.assertTemplateUsed(res, 'lp/booking_form.html')
-        self.assertEqual(len(res.context['booking_limit_list']), 1)
+        self.assertContains(res, reverse('lp:予約枠状態'))
         self.assertTrue(isinstance(res.context['form'], RegisterCustomerForm))
         self.assertTrue(isinstance(res.context['form2'], RegisterBookingForm))
 
@@ -57,6 +60,34 @@ class TestBookingView(TestCase):
         self.assertEqual(Booking.objects.filter(customer=customer).count(), 1)
         self.assertRedirects(res, reverse('lp:予約完了'))
 
+    @override_settings(HOSTNAME='example.com')
+    def test_post_filled_while_submitting(self):
+        """入力内容の検証後に満席になった場合は顧客を登録しない"""
+        reserve_seat = BookingLimit.objects.reserve_seat
+
+        def reserve_seat_after_other_booking(pk):
+            reserve_seat(pk)
+            return reserve_seat(pk)
+
+        with patch.object(BookingLimit.objects, 'reserve_seat', side_effect=reserve_seat_after_other_booking):
+            res = self.client.post(
+                reverse(self.viewname),
+                {
+                    'username': 'てすと',
+                    'furigana': 'テスト',
+                    'email': 'test@example.com',
+                    'age': 40,
+                    'job': '社長',
+                    'phone_number': '01234567890',
+                    'booking_limit': self.bl.id,
+                },
+            )
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.context['form2_errors'].has_error('booking_limit', 'filled'))
+        self.assertFalse(User.customers.filter(email='test@example.com').exists())
+        self.assertFalse(Booking.objects.exists())
+        self.assertFalse(MailOutbox.objects.exists())
+
     @override_settings(HOSTNAME='example.com')
     def test_send_mail(self):
         """登録時に送信されるメールのテスト メールのタグ変換テスト"""
@@ -72,6 +103,11 @@ class TestBookingView(TestCase):
                 'booking_limit': self.bl.id,
             },
         )
+        # 予約時は送信待ちメールに追加し、送信しない
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(MailOutbox.objects.count(), 1)
+
+        MailOutbox.objects.deliver()
         self.assertEqual(len(mail.outbox), 1)
         m = mail.outbox[0]
         self.assertEqual(m.subject, 'てすと')
@@ -97,6 +133,184 @@ class TestBookingView(TestCase):
         self.assertTrue(res.context['form2_errors'].has_error('booking_limit', 'invalid_choice'))
 
 
+@override_settings(HOSTNAME='example.com', WAITING_ROOM_CAPACITY=1)
+class TestWaitingRoom(TestCase):
+
+    fixtures = ['mail']
+
+    def setUp(self):
+        cache.clear()
+        self.bl = BookingLimitFactory(limit=1, start_datetime=(get_today0000() + timedelta(days=1, hours=9)))
+        SystemMail.objects.filter(name='顧客登録完了メール').update(sender=MailAddressFactory())
+        self.viewname = 'lp:予約フォーム'
+
+    def test_waiting_room(self):
+        res = self.client.get(reverse(self.viewname))
+        self.assertEqual(res.status_code, 200)
+        self.assertTemplateUsed(res, 'lp/booking_form.html')
+
+        # 定員を超えた場合は順番待ちページを表示する
+        client2 = Client()
+        res = client2.get(reverse(self.viewname))
+        self.assertEqual(res.status_code, 503)
+        self.assertTemplateUsed(res, 'lp/waiting_room.html')
+        res = client2.get(reverse('lp:順番待ち状況'))
+        self.assertEqual(res.json(), {'admitted': False, 'waiting_count': 0})
+
+        # 入場済みの顧客が予約すると次の顧客が入場できる
+        res = self.client.post(
+            reverse(self.viewname),
+            {
+                'username': 'てすと',
+                'furigana': 'テスト',
+                'email': 'test@example.com',
+                'age': 40,
+                'job': '社長',
+                'phone_number': '01234567890',
+                'booking_limit': self.bl.id,
+            },
+        )
+        self.assertRedirects(res, reverse('lp:予約完了'))
+        res = client2.get(reverse('lp:順番待ち状況'))
+        self.assertTrue(res.json()['admitted'])
+        res = client2.get(reverse(self.viewname))
+        self.assertEqual(res.status_code, 200)
+
+    def test_status_without_ticket(self):
+        res = self.client.get(reverse('lp:順番待ち状況'))
+        self.assertEqual(res.json(), {'admitted': True, 'waiting_count': 0})
+
+
+class TestBookingLimitStateView(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bl = BookingLimitFactory(limit=1, start_datetime=(get_today0000() + timedelta(days=1, hours=9)))
+        self.bl2 = BookingLimitFactory(limit=1, start_datetime=(get_today0000() + timedelta(days=8, hours=9)))
+        BookingFactory(booking_limit=self.bl2)
+        self.viewname = 'lp:予約枠状態'
+
+    def test_get(self):
+        start = get_today0000()
+        params = [
+            (start, start + timedelta(days=7), [[self.bl.id, localtime(self.bl.start_datetime).isoformat(), '▲']]),
+            (start + timedelta(days=7), start + timedelta(days=14),
+             [[self.bl2.id, localtime(self.bl2.start_datetime).isoformat(), '×']]),
+            (start + timedelta(days=14), start + timedelta(days=21), []),
+        ]
+        for from_dt, to_dt, expected in params:
+            with self.subTest(start=from_dt):
+                res = self.client.get(reverse(self.viewname), {'start': from_dt.isoformat(), 'end': to_dt.isoformat()})
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.json(), {'slots': expected})
+
+    def test_get_naive_datetime(self):
+        start = get_today0000()
+        res = self.client.get(
+            reverse(self.viewname),
+            {'start': start.strftime('%Y-%m-%d'), 'end': (start + timedelta(days=7)).strftime('%Y-%m-%d')},
+        )
+        self.assertEqual(len(res.json()['slots']), 1)
+
+    def test_invalid_params(self):
+        for params in ({}, {'start': 'a', 'end': 'b'}):
+            with self.subTest(params=params):
+                res = self.client.get(reverse(self.viewname), params)
+                self.assertEqual(res.status_code, 400)
+
+
+class TestSeatHoldView(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bl = BookingLimitFactory(limit=1, start_datetime=(get_today0000() + timedelta(days=1, hours=9)))
+        self.viewname = 'lp:予約枠確保'
+        # 予約フォームを開いた時にセッションを作成する
+        self.client.get(reverse('lp:予約フォーム'))
+
+    def test_post(self):
+        res = self.client.post(reverse(self.viewname), {'booking_limit': self.bl.id})
+        self.assertEqual(res.status_code, 200)
+        seat_hold = SeatHold.objects.get(booking_limit=self.bl)
+        self.assertEqual(res.json()['token'], seat_hold.token)
+
+        self.assertEqual(seat_hold.session_key, self.client.session.session_key)
+
+        # 他のセッションからは満席
+        client2 = Client()
+        client2.get(reverse('lp:予約フォーム'))
+        res = client2.post(reverse(self.viewname), {'booking_limit': self.bl.id})
+        self.assertEqual(res.status_code, 409)
+
+        # 同じセッションでは前に確保した予約枠を解放して確保し直す
+        res = self.client.post(reverse(self.viewname), {'booking_limit': self.bl.id})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(SeatHold.objects.filter(booking_limit=self.bl).count(), 1)
+
+    def test_post_one_hold_per_session(self):
+        """1つのセッションで一時確保できるのは1つの予約枠のみ"""
+        bl2 = BookingLimitFactory(limit=1, start_datetime=self.bl.start_datetime + timedelta(hours=1))
+        self.client.post(reverse(self.viewname), {'booking_limit': self.bl.id})
+        res = self.client.post(reverse(self.viewname), {'booking_limit': bl2.id})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(list(SeatHold.objects.values_list('booking_limit', flat=True)), [bl2.id])
+
+    @override_settings(VIRTUAL_SLOT_LIMIT=1)
+    def test_post_virtual_slot(self):
+        """仮想予約枠は予約枠を作成してから一時確保する"""
+        start_datetime = self.bl.start_datetime + timedelta(minutes=30)
+        res = self.client.post(
+            reverse(self.viewname), {'booking_limit': '', 'start_datetime': localtime(start_datetime).isoformat()})
+        self.assertEqual(res.status_code, 200)
+        bl = BookingLimit.objects.get(start_datetime=start_datetime)
+        self.assertEqual(res.json()['booking_limit'], bl.id)
+        self.assertEqual(bl.booked_count, 1)
+
+    @override_settings(VIRTUAL_SLOT_LIMIT=1, VIRTUAL_SLOT_DAYS=30)
+    def test_post_virtual_slot_out_of_days(self):
+        """仮想予約枠を使える日数より先の日時は予約枠を作成しない"""
+        start_datetime = self.bl.start_datetime + timedelta(days=30)
+        res = self.client.post(
+            reverse(self.viewname), {'booking_limit': '', 'start_datetime': localtime(start_datetime).isoformat()})
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(BookingLimit.objects.filter(start_datetime=start_datetime).exists())
+
+    def test_invalid_params(self):
+        for params in ({}, {'booking_limit': 'a'}, {'start_datetime': localtime(self.bl.start_datetime).isoformat()}):
+            with self.subTest(params=params):
+                res = self.client.post(reverse(self.viewname), params)
+                self.assertEqual(res.status_code, 400)
+
+    @override_settings(VIRTUAL_SLOT_LIMIT=1)
+    def test_post_before_can_select(self):
+        """予約フォームで選択できない、現在時刻から90分後より前の予約枠は一時確保しない"""
+        bl = BookingLimitFactory(limit=1, start_datetime=now().replace(second=0, microsecond=0) + timedelta(minutes=30))
+        res = self.client.post(reverse(self.viewname), {'booking_limit': bl.id})
+        self.assertEqual(res.status_code, 400)
+        start_datetime = get_today0000()
+        res = self.client.post(
+            reverse(self.viewname), {'booking_limit': '', 'start_datetime': localtime(start_datetime).isoformat()})
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(SeatHold.objects.exists())
+        self.assertFalse(BookingLimit.objects.filter(start_datetime=start_datetime).exists())
+
+    def test_post_without_session(self):
+        """予約フォームを開いていないセッションのない顧客は一時確保できない"""
+        res = Client().post(reverse(self.viewname), {'booking_limit': self.bl.id})
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(SeatHold.objects.exists())
+
+    @override_settings(WAITING_ROOM_CAPACITY=1)
+    def test_post_waiting_room(self):
+        """順番待ちを行う場合は、予約フォームに入場済みの顧客のみ一時確保できる"""
+        res = self.client.post(reverse(self.viewname), {'booking_limit': self.bl.id})
+        self.assertEqual(res.status_code, 403)
+
+        self.client.get(reverse('lp:予約フォーム'))
+        res = self.client.post(reverse(self.viewname), {'booking_limit': self.bl.id})
+        self.assertEqual(res.status_code, 200)
+
+
 class TestBookingDoneView(TestCase):
     @override_settings(HOSTNAME='example.com')
     def test_get(self):
@@ -6,4 +6,7 @@ app_name = 'lp'
 urlpatterns = [
     path('booking_form', views.BookingView.as_view(), name='予約フォーム'),
     path('booking_done', views.BookingDoneView.as_view(), name='予約完了'),
+    path('booking_limits', views.BookingLimitStateView.as_view(), name='予約枠状態'),
+    path('seat_hold', views.SeatHoldView.as_view(), name='予約枠確保'),
+    path('waiting_room', views.WaitingRoomStatusView.as_view(), name='順番待ち状況'),
 ]
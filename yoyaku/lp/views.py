@@ -1,14 +1,60 @@
+from datetime import datetime, timedelta
+
 from django.db import transaction
-from django.http import HttpResponseRedirect
-from django.views.generic import TemplateView
+from django.http import HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.timezone import is_naive, localdate, localtime, make_aware, now
+from django.views.generic import TemplateView, View
 
+from yoyaku.booking import availability_cache, virtual_slots
 from yoyaku.booking.forms import RegisterBookingForm
-from yoyaku.booking.models import BookingLimit
+from yoyaku.booking.models import BookingLimit, SeatHold
+from yoyaku.lp import waiting_room
 from yoyaku.lp.booking_strategies import get_booking_strategy
 from yoyaku.mail.send_mails import send_customer_registered_mail
 
+# 現在時刻から何分後以降の予約枠を予約フォームで選択できるか
+CAN_SELECT_AFTER_MIN = 90
+
+
+def parse_datetime(value):
+    """ISO 8601形式の日時をタイムゾーン付きのdatetimeに変換する"""
+    dt = datetime.fromisoformat(value)
+    return make_aware(dt) if is_naive(dt) else dt
+
+
+class WaitingRoomMixin:
+    """
+    予約フォームに同時に入場できる顧客の数を制限する。
+    入場できない場合は整理券を発行し、順番が来るまで順番待ちページを表示する。
+    """
+    waiting_template_name = 'lp/waiting_room.html'
+    # 順番待ちページで入場できるか確認する間隔(秒)
+    polling_interval = 5
+
+    def dispatch(self, request, *args, **kwargs):
+        if not waiting_room.is_enabled() or waiting_room.is_admitted(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        ticket = waiting_room.get_ticket(request) or waiting_room.issue_ticket()
+        if waiting_room.can_enter(ticket):
+            response = super().dispatch(request, *args, **kwargs)
+            waiting_room.admit(response, ticket)
+            return response
+
+        context = {
+            'waiting_count': waiting_room.get_waiting_count(ticket),
+            'polling_interval': self.polling_interval,
+            'status_url': reverse('lp:順番待ち状況'),
+        }
+        response = render(request, self.waiting_template_name, context, status=503)
+        response['Retry-After'] = self.polling_interval
+        waiting_room.set_ticket(response, ticket)
+        return response
+
 
-class BookingView(TemplateView):
+class BookingView(WaitingRoomMixin, TemplateView):
     """
     予約の登録には顧客情報登録用フォームと、予約登録用フォームを使う
     """
@@ -38,14 +84,17 @@ class BookingView(TemplateView):
         if 'form2_errors' not in kwargs:
             context['form2_errors'] = []
 
-        bl_list = BookingLimit.objects.customers_can_select(after_min=90)
-        context['booking_limit_list'] = bl_list
         return context
 
     def get_template_names(self):
         return self.get_booking_strategy().get_booking_template_name()
 
-    @transaction.atomic
+    def get(self, request, *args, **kwargs):
+        # 予約枠の一時確保はセッション毎に行うため、予約フォームを開いた時にセッションを作成する
+        if not request.session.session_key:
+            request.session.create()
+        return super().get(request, *args, **kwargs)
+
     def post(self, request, *args, **kwargs):
         customer_form = self.get_customer_form()
         booking_form = RegisterBookingForm(self.request.POST)
@@ -55,11 +104,25 @@ class BookingView(TemplateView):
             return self.forms_invalid(customer_form, booking_form)
 
     def forms_valid(self, customer_form, booking_form):
-        customer = customer_form.save()
-        booking = booking_form.save(customer)
-        send_customer_registered_mail(booking)
+        # 予約枠の行ロックを保持する時間を短くするため、予約数の加算はトランザクションの最後に行う
+        with transaction.atomic():
+            customer = customer_form.save()
+            booking = booking_form.save(customer)
+            if booking is None:
+                # 満席の場合は顧客の登録を取り消す
+                transaction.set_rollback(True)
+            else:
+                # 予約と同じトランザクションで送信待ちメールに追加し、送信はdeliver_mailコマンドで行う
+                send_customer_registered_mail(booking)
+
+        if booking is None:
+            return self.forms_invalid(customer_form, booking_form)
+
         redirect_to = self.get_booking_strategy().get_booking_done_url()
-        return HttpResponseRedirect(redirect_to)
+        response = HttpResponseRedirect(redirect_to)
+        if waiting_room.is_enabled():
+            waiting_room.leave(self.request, response)
+        return response
 
     def forms_invalid(self, customer_form, booking_form):
         kwargs = {
@@ -70,7 +133,8 @@ class BookingView(TemplateView):
             # 予約画面のカレンダー表示の都合により、予約枠エラーの場合はエラー表示用フォームと、
             # 再作成したフォームを使い分ける
             kwargs['form2_errors'] = booking_form
-            kwargs['form2'] = RegisterBookingForm()
+            # 一時確保した予約枠は、別の予約枠を選択したときに解放できるようにトークンを引き継ぐ
+            kwargs['form2'] = RegisterBookingForm(initial={'seat_hold': booking_form.data.get('seat_hold', '')})
         return self.render_to_response(self.get_context_data(**kwargs))
 
 
@@ -78,3 +142,94 @@ class BookingDoneView(TemplateView):
     """予約完了ページ"""
     def get_template_names(self):
         return get_booking_strategy().get_booking_done_template_name()
+
+
+class BookingLimitStateView(View):
+    """
+    予約フォームのカレンダーに表示する期間の予約枠の状態をjson形式で返す。
+    start, end: 表示期間 ISO 8601形式の日時
+    レスポンスの予約枠は[id, 開始日時, 状態]のリスト。仮想予約枠のidはnull
+    """
+    # 1回のリクエストで取得できる最大日数
+    max_days = 62
+
+    def get(self, request, *args, **kwargs):
+        try:
+            start = parse_datetime(request.GET['start'])
+            end = parse_datetime(request.GET['end'])
+        except (KeyError, ValueError):
+            return JsonResponse({'msg': '期間の指定が正しくありません。'}, status=400,
+                                json_dumps_params={'ensure_ascii': False})
+
+        end = min(end, start + timedelta(days=self.max_days))
+        # 予約枠の空き状況は日毎にキャッシュされているため、日単位で取得してから絞り込む
+        bl_list = availability_cache.get_slots(localdate(start), localdate(end) + timedelta(days=1))
+        start = max(start, now() + timedelta(minutes=CAN_SELECT_AFTER_MIN))
+        slots = [
+            [bl['id'], localtime(bl['start_datetime']).isoformat(), bl['state']]
+            for bl in bl_list if start <= bl['start_datetime'] < end
+        ]
+        return JsonResponse({'slots': slots}, json_dumps_params={'ensure_ascii': False})
+
+
+class SeatHoldView(View):
+    """
+    予約フォームで選択した予約枠を一時確保し、予約枠のid、トークンと有効期限をjson形式で返す。
+    booking_limit: 予約枠のid
+    start_datetime: 仮想予約枠を選択した場合の開始日時。予約枠のデータを作成してから一時確保する
+    一時確保はセッション毎に1つのみのため、同じセッションで前に一時確保した予約枠は解放する。
+    予約フォームを開いた時に作成したセッションと、順番待ちを行う場合は入場済みであることが必要。
+    """
+    def get_booking_limit_id(self):
+        """一時確保する予約枠のidを返す。予約フォームで選択できない日時の場合はValueError"""
+        start = now() + timedelta(minutes=CAN_SELECT_AFTER_MIN)
+        if self.request.POST.get('booking_limit'):
+            booking_limit_id = int(self.request.POST['booking_limit'])
+            if not BookingLimit.objects.filter(id=booking_limit_id, start_datetime__gte=start).exists():
+                raise ValueError
+            return booking_limit_id
+
+        start_datetime = parse_datetime(self.request.POST['start_datetime'])
+        bl = virtual_slots.materialize(start_datetime) if start_datetime >= start else None
+        if bl is None:
+            raise ValueError
+        return bl.id
+
+    def post(self, request, *args, **kwargs):
+        if not request.session.session_key or (waiting_room.is_enabled() and not waiting_room.is_admitted(request)):
+            return JsonResponse({'msg': '予約フォームを開き直してください。'}, status=403,
+                                json_dumps_params={'ensure_ascii': False})
+
+        try:
+            booking_limit_id = self.get_booking_limit_id()
+        except (KeyError, ValueError):
+            return JsonResponse({'msg': '予約枠の指定が正しくありません。'}, status=400,
+                                json_dumps_params={'ensure_ascii': False})
+
+        seat_hold = SeatHold.objects.hold(booking_limit_id, request.session.session_key)
+        if seat_hold is None:
+            return JsonResponse({'msg': 'ご希望の予約日時は満席になりました。他の日時を選択してください。'}, status=409,
+                                json_dumps_params={'ensure_ascii': False})
+
+        return JsonResponse({
+            'booking_limit': booking_limit_id,
+            'token': seat_hold.token,
+            'expires_at': localtime(seat_hold.expires_at).isoformat(),
+        })
+
+
+class WaitingRoomStatusView(View):
+    """
+    順番待ちページから、予約フォームに入場できるかどうかをjson形式で返す。
+    DBにアクセスせずにキャッシュのみを参照する。
+    """
+    def get(self, request, *args, **kwargs):
+        ticket = waiting_room.get_ticket(request)
+        if ticket is None:
+            # 整理券がない場合は予約フォームを開き直して整理券を受け取る
+            return JsonResponse({'admitted': True, 'waiting_count': 0})
+
+        return JsonResponse({
+            'admitted': waiting_room.can_enter(ticket),
+            'waiting_count': waiting_room.get_waiting_count(ticket),
+        })
@@ -0,0 +1,92 @@
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+
+KEY_PREFIX = 'waiting_room'
+# 最後に発行した整理券番号
+TICKET_KEY = f'{KEY_PREFIX}:ticket'
+# 予約フォームに入場できる最大の整理券番号
+SERVING_KEY = f'{KEY_PREFIX}:serving'
+
+TICKET_COOKIE = 'waiting_room_ticket'
+ADMISSION_COOKIE = 'waiting_room_admission'
+SALT = 'yoyaku.lp.waiting_room'
+
+
+def _incr(key, delta):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        return cache.incr(key, delta)
+
+
+def is_enabled():
+    return bool(settings.WAITING_ROOM_CAPACITY)
+
+
+def issue_ticket():
+    """整理券番号を発行する"""
+    return _incr(TICKET_KEY, 1)
+
+
+def get_serving():
+    """
+    入場できる最大の整理券番号を返す。
+    入場の有効期間が過ぎる毎に、それまでの入場者は退場したとみなして定員分の入場枠を追加する。
+    そのため同時に予約フォームを使う顧客は最大で定員の2倍程度になる。
+    """
+    timeout = settings.WAITING_ROOM_ADMISSION_SECONDS
+    period = int(time.time() // timeout)
+    if not cache.add(f'{KEY_PREFIX}:period:{period}', 1, timeout=timeout * 2):
+        return cache.get(SERVING_KEY, 0)
+
+    # 空いている時間に入場枠が溜まらないように、発行済みの整理券番号を基準にする
+    serving = min(cache.get(SERVING_KEY, 0), cache.get(TICKET_KEY, 0)) + settings.WAITING_ROOM_CAPACITY
+    cache.set(SERVING_KEY, serving, timeout=None)
+    return serving
+
+
+def can_enter(ticket):
+    return ticket <= get_serving()
+
+
+def get_waiting_count(ticket):
+    """自分より前に待っている人数を返す"""
+    return max(ticket - get_serving() - 1, 0)
+
+
+def get_ticket(request):
+    """cookieの整理券番号を返す。整理券がない場合はNone"""
+    ticket = request.get_signed_cookie(TICKET_COOKIE, default=None, salt=SALT)
+    return int(ticket) if ticket and ticket.isdigit() else None
+
+
+def set_ticket(response, ticket):
+    response.set_signed_cookie(TICKET_COOKIE, ticket, salt=SALT, httponly=True)
+
+
+def is_admitted(request):
+    """入場の有効期間内かどうか"""
+    try:
+        request.get_signed_cookie(
+            ADMISSION_COOKIE, salt=SALT, max_age=settings.WAITING_ROOM_ADMISSION_SECONDS)
+    except (KeyError, signing.BadSignature):
+        return False
+    return True
+
+
+def admit(response, ticket):
+    """入場を許可したことをcookieに記録する"""
+    response.set_signed_cookie(
+        ADMISSION_COOKIE, ticket, salt=SALT, max_age=settings.WAITING_ROOM_ADMISSION_SECONDS, httponly=True)
+    response.delete_cookie(TICKET_COOKIE)
+
+
+def leave(request, response):
+    """予約が完了した顧客を退場させ、次の整理券番号の顧客を入場できるようにする"""
+    if is_admitted(request):
+        _incr(SERVING_KEY, 1)
+    response.delete_cookie(ADMISSION_COOKIE)
@@ -5,3 +5,6 @@ class MailConfig(AppConfig):
     name = 'yoyaku.mail'
     label = 'mail'
     verbose_name = 'Yoyaku Mail'
+
+    def ready(self):
+        from yoyaku.mail import signals  # noqa: F401
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from yoyaku.mail.models import MailOutbox
+
+
+class Command(BaseCommand):
+    help = '送信待ちのメールをまとめて送信する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=100, help='1つの接続で送信するメールの数')
+        parser.add_argument('-r', '--rate', type=float, help='1秒間に送信する最大の件数 省略時はsettings.MAIL_OUTBOX_RATE_LIMIT')
+        parser.add_argument('--loop', action='store_true', help='終了せずに送信待ちのメールを送信し続ける')
+        parser.add_argument('-i', '--interval', type=float, default=5, help='--loop指定時に送信待ちのメールがない場合に待つ秒数')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = MailOutbox.objects.deliver(options['batch_size'], rate=options['rate'])
+            total_sent += sent
+            total_failed += failed
+            if sent + failed:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(f'{total_sent} 件のメールを送信しました。 送信に失敗したメール: {total_failed} 件')
@@ -0,0 +1,27 @@
+from datetime import date, timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localdate
+
+from yoyaku.mail.send_mails import send_booking_reminders
+
+
+class Command(BaseCommand):
+    help = '対象日に予約がある顧客へ予約日時通知メールを送信する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', dest='target_date', type=date.fromisoformat, help='対象日 YYYY-MM-DD 省略時は翌日')
+        parser.add_argument('-c', '--chunk-size', type=int, default=1000, help='一度に読み込む予約の数')
+        parser.add_argument('--resume', action='store_true', help='前回送信待ちに追加した予約の次から再開する')
+        parser.add_argument('--enqueue-only', action='store_true', help='送信待ちに追加のみ行い、送信はdeliver_mailコマンドで行う')
+        parser.add_argument('-b', '--batch-size', type=int, default=100, help='1つの接続で送信するメールの数')
+        parser.add_argument('-r', '--rate', type=float, help='1秒間に送信する最大の件数 省略時はsettings.MAIL_OUTBOX_RATE_LIMIT')
+
+    def handle(self, *args, **options):
+        target_date = options['target_date'] or localdate() + timedelta(days=1)
+        count = send_booking_reminders(target_date, chunk_size=options['chunk_size'], resume=options['resume'])
+        self.stdout.write(f'{target_date} の予約 {count} 件の予約日時通知メールを送信待ちに追加しました。')
+
+        if not options['enqueue_only']:
+            call_command('deliver_mail', batch_size=options['batch_size'], rate=options['rate'], stdout=self.stdout)
@@ -0,0 +1,34 @@
+# Generated by Django 4.1 on 2026-10-18 14:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_email', models.EmailField(max_length=254, verbose_name='送信元')),
+                ('to', models.EmailField(max_length=254, verbose_name='送信先')),
+                ('subject', models.CharField(blank=True, max_length=255, verbose_name='件名')),
+                ('body', models.TextField(blank=True, verbose_name='本文')),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, '送信待ち'), (1, '送信済み'), (2, '送信失敗')], default=0, verbose_name='状態')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='送信回数')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='送信日時')),
+                ('last_error', models.TextField(blank=True, verbose_name='エラー')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='送信完了日時')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日時')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mailoutbox',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='mail_mailou_status_b508c7_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-18 15:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0002_mailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systemmail',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='更新日時'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1 on 2026-10-18 14:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0006_booking_version'),
+        ('mail', '0003_systemmail_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailoutbox',
+            name='booking',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mails', to='booking.booking'),
+        ),
+        migrations.AddField(
+            model_name='mailoutbox',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, verbose_name='内容のハッシュ'),
+        ),
+        migrations.AddField(
+            model_name='mailoutbox',
+            name='system_mail',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='mail.systemmail'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailoutbox',
+            constraint=models.UniqueConstraint(fields=('booking', 'system_mail', 'content_hash'), name='unique_mail_delivery'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 14:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0004_mail_delivery_log'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mailoutbox',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, '送信待ち'), (3, '送信中'), (1, '送信済み'), (2, '送信失敗')], default=0, verbose_name='状態'),
+        ),
+    ]
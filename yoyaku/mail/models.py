@@ -1,5 +1,12 @@
-from django.core.mail import send_mail
-from django.db import models
+import hashlib
+import re
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import models, transaction
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
@@ -25,11 +32,104 @@ class MailTag(models.Model):
         return self.name
 
 
+# メールタグと、予約から置換する値を返す関数。値がNoneの場合は置換しない
+MAIL_TAG_VALUES = {
+    '__NAME__': lambda booking: booking.customer.username,
+    '__MAILADDRESS__': lambda booking: booking.customer.email,
+    '__TEL__': lambda booking: booking.customer.phone_number,
+    '__RESERVATION_DATE__': lambda booking: booking.booking_limit.formatted_start_datetime(),
+}
+MAIL_TAG_PATTERN = re.compile('(' + '|'.join(map(re.escape, MAIL_TAG_VALUES)) + ')')
+
+# プロセス内でキャッシュする、システムメールのidとCompiledMailの辞書
+_compiled_mails = {}
+
+
+class CompiledMail:
+    """
+    件名と本文をメールタグの位置で分割したシステムメール。
+    分割したリストは偶数番目が文字列、奇数番目がメールタグになる。
+    """
+
+    def __init__(self, system_mail):
+        self.id = system_mail.id
+        self.updated_at = system_mail.updated_at
+        self.from_email = system_mail.sender.email if system_mail.sender_id else settings.DEFAULT_FROM_EMAIL
+        self.subject = MAIL_TAG_PATTERN.split(system_mail.subject)
+        self.content = MAIL_TAG_PATTERN.split(system_mail.content)
+        self.tags = set(self.subject[1::2]) | set(self.content[1::2])
+
+    @staticmethod
+    def _join(tokens, values):
+        return ''.join(
+            token if i % 2 == 0 or values[token] is None else values[token]
+            for i, token in enumerate(tokens)
+        )
+
+    def render(self, booking):
+        """
+        メールタグを予約の値に置換した件名と本文を返す
+        booking: Bookingクラス
+        return: (件名, 本文)
+        """
+        values = {tag: MAIL_TAG_VALUES[tag](booking) for tag in self.tags}
+        return self._join(self.subject, values), self._join(self.content, values)
+
+    def send(self, booking):
+        """
+        送信待ちメールに追加する。送信はdeliver_mailコマンドで行う。
+        予約と同じトランザクション内で呼び出すと、予約がロールバックされた場合は送信されない。
+        booking: Bookingクラス
+        return: 保存したMailOutboxオブジェクト 同じ内容のメールを記録済みの場合はNone
+        """
+        mail = self.get_outbox(booking)
+        return mail if MailOutbox.objects.enqueue([mail]) else None
+
+    def get_outbox(self, booking):
+        """予約の送信待ちメールを保存せずに返す"""
+        subject, body = self.render(booking)
+        return MailOutbox.objects.build(
+            from_email=self.from_email,
+            to=booking.customer.email,
+            subject=subject,
+            body=body,
+            booking=booking,
+            system_mail_id=self.id,
+        )
+
+
 class SystemMailManager(models.Manager):
     """スーパーユーザーを除くスタッフ権限のユーザーを取得"""
+    REGISTERED_MAIL_ID = 1
+    REMINDER_MAIL_ID = 2
 
     def get_registered_mail(self):
-        return self.get(id=1)
+        return self.get(id=self.REGISTERED_MAIL_ID)
+
+    def get_compiled(self, pk):
+        """
+        システムメールのCompiledMailを返す。
+        プロセス内でキャッシュし、キャッシュに保存した更新日時が変わった場合のみDBから取得し直す。
+        キャッシュの更新日時は、変更前のデータを読み込んだプロセスが古い値で上書きしないように、
+        DBの値の方が新しい場合のみ更新する。古い値が残っても、settings.SYSTEM_MAIL_CACHE_TIMEOUT秒で削除される。
+        """
+        key = SystemMail.get_cache_key(pk)
+        updated_at = cache.get(key)
+        compiled = _compiled_mails.get(pk)
+        if updated_at is None or compiled is None or compiled.updated_at != updated_at:
+            compiled = CompiledMail(self.select_related('sender').get(id=pk))
+            _compiled_mails[pk] = compiled
+            if updated_at is None:
+                cache.add(key, compiled.updated_at, settings.SYSTEM_MAIL_CACHE_TIMEOUT)
+            elif updated_at < compiled.updated_at:
+                cache.set(key, compiled.updated_at, settings.SYSTEM_MAIL_CACHE_TIMEOUT)
+        return compiled
+
+    def get_registered_compiled(self):
+        return self.get_compiled(self.REGISTERED_MAIL_ID)
+
+    def get_reminder_compiled(self):
+        return self.get_compiled(self.REMINDER_MAIL_ID)
 
 
 class SystemMail(models.Model):
@@ -38,39 +138,293 @@ class SystemMail(models.Model):
     subject = models.CharField(_('件名'), max_length=64, blank=True)
     content = models.CharField(_('本文'), max_length=2000, blank=True)
     created_at = models.DateTimeField(_('作成日時'), default=timezone.now)
+    updated_at = models.DateTimeField(_('更新日時'), default=timezone.now)
 
     objects = SystemMailManager()
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # フィクスチャの読み込み時にも値を設定するため、auto_nowではなくsave()で更新日時を更新する
+        self.updated_at = timezone.now()
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def get_cache_key(pk):
+        return f'system_mail:{pk}:updated_at'
+
+    @classmethod
+    def invalidate(cls, pk_list):
+        """
+        CompiledMailのキャッシュに使う更新日時を削除する。
+        コミット前に別のプロセスが古いデータをキャッシュする場合があるため、コミット後にも削除する。
+        """
+        keys = [cls.get_cache_key(pk) for pk in pk_list]
+        if not keys:
+            return
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
     def replace_mail_tags(self, booking):
         """
         subjectとcontentのMailTagを置換する. 置換先がNoneの場合は置換しない。
         booking: Bookingクラス
         """
-        tag_replace_map = {
-            '__NAME__': booking.customer.username,
-            '__MAILADDRESS__': booking.customer.email,
-            '__TEL__': booking.customer.phone_number,
-            '__RESERVATION_DATE__': booking.booking_limit.formatted_start_datetime(),
-        }
-        for tag, new in tag_replace_map.items():
-            if new is None:
-                continue
-            self.subject = self.subject.replace(tag, new)
-            self.content = self.content.replace(tag, new)
+        self.subject, self.content = CompiledMail(self).render(booking)
 
     def send_system_mail(self, booking):
         """
-        send_mail()は送信に成功したメッセージの数を返す。
+        送信待ちメールに追加する。送信はdeliver_mailコマンドで行う。
         booking: Bookingクラス
+        return: MailOutboxオブジェクト
         """
-        self.replace_mail_tags(booking)
-        return send_mail(
-            self.subject,
-            self.content,
-            self.sender.email,
-            [booking.customer.email],
-            fail_silently=True
+        return CompiledMail(self).send(booking)
+
+
+class MailOutboxManager(models.Manager):
+
+    def build(self, **kwargs):
+        """内容のハッシュを設定した送信待ちメールを保存せずに返す"""
+        mail = self.model(**kwargs)
+        mail.content_hash = mail.get_content_hash()
+        return mail
+
+    def get_due(self):
+        """
+        送信日時を過ぎた送信待ちのメールを送信日時順に返す。
+        送信中のまま期限を過ぎたメールは、送信中にワーカーが停止したとみなして含める。
+        """
+        return self.filter(
+            status__in=[MailOutbox.PENDING, MailOutbox.SENDING], next_attempt_at__lte=timezone.now()
+        ).order_by('next_attempt_at', 'id')
+
+    def claim(self, batch_size, lease_seconds):
+        """
+        送信待ちのメールを最大batch_size件、送信中にして返す。送信中の期限はlease_seconds秒後にする。
+        短いトランザクションで送信中にするため、送信中は行をロックしない。
+        他のワーカーと同じメールを選択した場合も、送信待ちのまま残っているメールのみ送信中にできる。
+        """
+        leased_until = timezone.now() + timedelta(seconds=lease_seconds)
+        with transaction.atomic():
+            pk_list = list(self.get_due().select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+            if not pk_list:
+                return []
+            self.get_due().filter(id__in=pk_list).update(status=MailOutbox.SENDING, next_attempt_at=leased_until)
+        return list(
+            self.filter(id__in=pk_list, status=MailOutbox.SENDING, next_attempt_at=leased_until).order_by('id')
         )
+
+    def enqueue(self, mail_list):
+        """
+        送信待ちメールを追加する。
+        同じ予約・システムメール・内容のメールを記録済みの場合は、送信状態によらず追加しない。
+        予約とシステムメールがあるメールは、追加できた場合のみidを設定する。
+        return: 追加した件数
+        """
+        keyed = {}
+        unkeyed = []
+        for mail in mail_list:
+            if mail.booking_id and mail.system_mail_id:
+                keyed.setdefault(mail.get_delivery_key(), mail)
+            else:
+                unkeyed.append(mail)
+        # 記録済みのメールと、別のプロセスが同時に追加したメールは一意制約により追加しない
+        self.bulk_create([*keyed.values(), *unkeyed], ignore_conflicts=True)
+        if not keyed:
+            return len(unkeyed)
+
+        # 一意制約で追加しなかったメールを除くため、作成日時が同じメールを追加できたメールとして取得し直す
+        inserted = {
+            (booking_id, system_mail_id, content_hash, created_at): pk
+            for pk, booking_id, system_mail_id, content_hash, created_at in self.filter(
+                booking_id__in={mail.booking_id for mail in keyed.values()},
+                created_at__in={mail.created_at for mail in keyed.values()},
+            ).values_list('id', 'booking_id', 'system_mail_id', 'content_hash', 'created_at')
+        }
+        count = len(unkeyed)
+        for key, mail in keyed.items():
+            pk = inserted.get((*key, mail.created_at))
+            if pk is not None:
+                mail.pk = pk
+                mail._state.adding = False
+                count += 1
+        return count
+
+    def send_now(self, mail, resend=False):
+        """
+        メールをすぐに送信し、送信結果を記録する。
+        同じ予約・システムメール・内容のメールを記録済みの場合はそのメールを送信し、送信済みか送信中の場合は送信しない。
+        resend: Trueの場合は送信済みでも送信し直す。送信中の場合は送信しない
+        return: (MailOutboxオブジェクト, 送信できたかどうか)
+        """
+        if mail.booking_id and mail.system_mail_id:
+            if mail.pk is None and not self.enqueue([mail]):
+                booking_id, system_mail_id, content_hash = mail.get_delivery_key()
+                mail = self.get(booking_id=booking_id, system_mail_id=system_mail_id, content_hash=content_hash)
+            # deliver()と同時に送信しないように、送信中にできた場合のみ送信する
+            leased_until = timezone.now() + timedelta(seconds=settings.MAIL_OUTBOX_LEASE_SECONDS)
+            claimable = self.filter(id=mail.id).exclude(status=MailOutbox.SENDING, next_attempt_at__gt=timezone.now())
+            if not resend:
+                claimable = claimable.exclude(status=MailOutbox.SENT)
+            if not claimable.update(status=MailOutbox.SENDING, next_attempt_at=leased_until):
+                mail.refresh_from_db()
+                return mail, False
+            mail.refresh_from_db()
+        return mail, mail.send()
+
+    def deliver(self, batch_size=100, connection=None, rate=None):
+        """
+        送信待ちのメールを最大batch_size件、1つの接続で送信し、送信結果を記録する。
+        複数のワーカーで同時に実行できるように、メールを送信中にしてからトランザクションの外で送信し、
+        送信結果は1通ずつ記録する。送信中にワーカーが停止した場合は、送信中の期限が過ぎてから再送信する。
+        送信に失敗したメールは、失敗する度に再送信までの時間を2倍にして再送信する。
+        rate: 1秒間に送信する最大の件数 省略時はsettings.MAIL_OUTBOX_RATE_LIMIT
+        return: (送信した件数, 失敗した件数)
+        """
+        rate = rate or settings.MAIL_OUTBOX_RATE_LIMIT
+        # 送信間隔を空ける場合は、全て送信し終わるまで送信中にしておく
+        lease_seconds = settings.MAIL_OUTBOX_LEASE_SECONDS + (batch_size / rate if rate else 0)
+        mail_list = self.claim(batch_size, lease_seconds)
+        if not mail_list:
+            return 0, 0
+
+        connection = connection or get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            # 接続できない場合は全て送信失敗として再送信する
+            for mail in mail_list:
+                mail.attempts += 1
+                mail.set_failed(e)
+                mail.save_result()
+            return 0, len(mail_list)
+
+        sent = failed = 0
+        try:
+            started = time.monotonic()
+            for i, mail in enumerate(mail_list):
+                if rate:
+                    # 送信の間隔が1/rate秒以上になるように待つ
+                    time.sleep(max(0, started + i / rate - time.monotonic()))
+                # 失敗したメールを特定するため、接続を使い回して1通ずつ送信する
+                if mail.send_with(connection):
+                    sent += 1
+                else:
+                    failed += 1
+                mail.save_result()
+        finally:
+            connection.close()
+        return sent, failed
+
+
+class MailOutbox(models.Model):
+    """
+    送信待ちのメールと送信結果
+    予約のトランザクション内で追加し、deliver_mailコマンドで送信する
+    予約・システムメール・内容のハッシュが同じメールは1件のみ記録し、再実行時に重複して送信しない
+    送信中(SENDING)のメールは、next_attempt_atを送信中の期限とする
+    """
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+    SENDING = 3
+    STATUS_CHOICES = (
+        (PENDING, '送信待ち'),
+        (SENDING, '送信中'),
+        (SENT, '送信済み'),
+        (FAILED, '送信失敗'),
+    )
+    RESULT_FIELDS = ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at']
+
+    from_email = models.EmailField(_('送信元'))
+    to = models.EmailField(_('送信先'))
+    subject = models.CharField(_('件名'), max_length=255, blank=True)
+    body = models.TextField(_('本文'), blank=True)
+    status = models.PositiveSmallIntegerField(_('状態'), choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(_('送信回数'), default=0)
+    next_attempt_at = models.DateTimeField(_('送信日時'), default=timezone.now)
+    last_error = models.TextField(_('エラー'), blank=True)
+    sent_at = models.DateTimeField(_('送信完了日時'), null=True, blank=True)
+    created_at = models.DateTimeField(_('作成日時'), default=timezone.now)
+    booking = models.ForeignKey(
+        'booking.Booking', on_delete=models.SET_NULL, null=True, blank=True, related_name='mails'
+    )
+    system_mail = models.ForeignKey(SystemMail, on_delete=models.SET_NULL, null=True, blank=True)
+    content_hash = models.CharField(_('内容のハッシュ'), max_length=64, blank=True)
+
+    objects = MailOutboxManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+        constraints = [
+            # 予約がないメールはNULLのため重複を許す
+            models.UniqueConstraint(fields=['booking', 'system_mail', 'content_hash'], name='unique_mail_delivery'),
+        ]
+
+    def __str__(self):
+        return f'{self.to} {self.subject}'
+
+    def get_content_hash(self):
+        value = '\0'.join([self.from_email or '', self.to or '', self.subject, self.body])
+        return hashlib.sha256(value.encode()).hexdigest()
+
+    def get_delivery_key(self):
+        return self.booking_id, self.system_mail_id, self.content_hash
+
+    def send_with(self, connection):
+        """
+        接続を使って送信し、送信結果を設定する。保存はしない。
+        return: 送信できたかどうか
+        """
+        self.attempts += 1
+        try:
+            if not connection.send_messages([self.get_message(connection)]):
+                raise ValueError('メールが送信されませんでした。')
+        except Exception as e:
+            self.set_failed(e)
+            return False
+        self.status = MailOutbox.SENT
+        self.sent_at = timezone.now()
+        self.last_error = ''
+        return True
+
+    def send(self, connection=None):
+        """
+        すぐに送信し、送信結果を保存する。
+        return: 送信できたかどうか
+        """
+        connection = connection or get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            self.attempts += 1
+            self.set_failed(e)
+            result = False
+        else:
+            try:
+                result = self.send_with(connection)
+            finally:
+                connection.close()
+        if self.pk:
+            self.save_result()
+        else:
+            self.save()
+        return result
+
+    def save_result(self):
+        """送信結果の項目のみ保存する"""
+        self.save(update_fields=self.RESULT_FIELDS)
+
+    def get_message(self, connection=None):
+        return EmailMessage(self.subject, self.body, self.from_email, [self.to], connection=connection)
+
+    def set_failed(self, error):
+        """送信失敗を記録する。送信回数が上限に達した場合は送信失敗にする"""
+        self.last_error = f'{type(error).__name__}: {error}'
+        if settings.MAIL_OUTBOX_MAX_ATTEMPTS <= self.attempts:
+            self.status = MailOutbox.FAILED
+        else:
+            self.status = MailOutbox.PENDING
+            delay = settings.MAIL_OUTBOX_RETRY_SECONDS * 2 ** (self.attempts - 1)
+            self.next_attempt_at = timezone.now() + timedelta(seconds=delay)
@@ -1,11 +1,63 @@
-from yoyaku.mail.models import SystemMail
+from datetime import datetime, time, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import make_aware
+
+from yoyaku.booking.models import Booking
+from yoyaku.mail.models import MailOutbox, SystemMail
+
+REMINDER_PROGRESS_TIMEOUT = 60 * 60 * 24 * 2
 
 
 def send_customer_registered_mail(booking):
     """
-    予約完了メールを送信する
+    予約完了メールを送信待ちメールに追加する
+    deliver_mailコマンドを実行しない場合(settings.MAIL_OUTBOX_WORKERがFalse)は、コミット後に送信する
     booking: Bookingクラス
     """
-    system_mail = SystemMail.objects.get_registered_mail()
-    result = system_mail.send_system_mail(booking)
+    compiled = SystemMail.objects.get_registered_compiled()
+    result = compiled.send(booking)
+    if result and not settings.MAIL_OUTBOX_WORKER:
+        transaction.on_commit(lambda: MailOutbox.objects.send_now(result))
     return True if result else False
+
+
+def get_reminder_progress_key(target_date):
+    return f'booking_reminders:{target_date.isoformat()}:last_booking_id'
+
+
+def send_booking_reminders(target_date, chunk_size=1000, resume=False):
+    """
+    対象日に予約がある顧客への予約日時通知メールを送信待ちメールに追加する。送信はdeliver_mailコマンドで行う。
+    予約をid順にchunk_size件ずつ読み込んでchunk毎に追加し、追加済みの最後の予約idをキャッシュに記録する。
+    同じ内容のメールを記録済みの予約には追加しないため、再実行しても重複して送信しない。
+    target_date: datetime.date 対象日
+    resume: Trueの場合は前回追加済みの予約の次から再開する
+    return: 追加した件数
+    """
+    start = make_aware(datetime.combine(target_date, time()))
+    key = get_reminder_progress_key(target_date)
+    last_id = cache.get(key, 0) if resume else 0
+    compiled = SystemMail.objects.get_reminder_compiled()
+    bookings = (
+        Booking.objects.select_related('customer', 'booking_limit')
+        .filter(
+            booking_limit__start_datetime__gte=start,
+            booking_limit__start_datetime__lt=start + timedelta(days=1),
+            id__gt=last_id,
+        )
+        .order_by('id')
+        .iterator(chunk_size=chunk_size)
+    )
+    count = 0
+    while True:
+        chunk = list(islice(bookings, chunk_size))
+        if not chunk:
+            break
+        with transaction.atomic():
+            count += MailOutbox.objects.enqueue([compiled.get_outbox(booking) for booking in chunk])
+        cache.set(key, chunk[-1].id, REMINDER_PROGRESS_TIMEOUT)
+    return count
@@ -0,0 +1,23 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from yoyaku.mail.models import MailAddress, SystemMail
+
+
+@receiver(post_save, sender=SystemMail)
+@receiver(post_delete, sender=SystemMail)
+def invalidate_system_mail_cache(sender, instance, **kwargs):
+    """システムメールの変更時に、CompiledMailのキャッシュに使う更新日時を削除する"""
+    SystemMail.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=MailAddress)
+@receiver(pre_delete, sender=MailAddress)
+def invalidate_sender_cache(sender, instance, **kwargs):
+    """送信元のメールアドレスの変更時に、使っているシステムメールの更新日時を更新し、キャッシュを削除する"""
+    system_mails = SystemMail.objects.filter(sender=instance)
+    pk_list = list(system_mails.values_list('id', flat=True))
+    if pk_list:
+        system_mails.update(updated_at=timezone.now())
+        SystemMail.invalidate(pk_list)
@@ -0,0 +1,48 @@
+from io import StringIO
+
+from django.core import mail
+from django.core.management import call_command
+from datetime import datetime
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils.timezone import make_aware
+
+from yoyaku.mail.models import MailOutbox, SystemMail
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, MailAddressFactory
+from yoyaku.tests.test_case import ModelTestCase
+
+
+class TestDeliverMail(TestCase):
+
+    def test_handle(self):
+        for i in range(3):
+            MailOutbox.objects.create(from_email='from@example.com', to=f'to{i}@example.com', subject='件名')
+
+        out = StringIO()
+        call_command('deliver_mail', batch_size=2, stdout=out)
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(MailOutbox.objects.filter(status=MailOutbox.PENDING).exists())
+        self.assertIn('3 件のメールを送信しました。 送信に失敗したメール: 0 件', out.getvalue())
+
+
+class TestSendBookingReminders(ModelTestCase):
+
+    def setUp(self):
+        cache.clear()
+        SystemMail.objects.filter(id=SystemMail.objects.REMINDER_MAIL_ID).update(sender=MailAddressFactory())
+        bl = BookingLimitFactory(limit=2, start_datetime=make_aware(datetime(2020, 1, 6, 10)))
+        self.bookings = [BookingFactory(booking_limit=bl) for _ in range(2)]
+
+    def test_handle(self):
+        out = StringIO()
+        call_command('send_booking_reminders', '--date=2020-01-06', '--rate=1000', stdout=out)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(b.customer.email for b in self.bookings))
+        self.assertIn('2020-01-06 の予約 2 件の予約日時通知メールを送信待ちに追加しました。', out.getvalue())
+        self.assertIn('2 件のメールを送信しました。', out.getvalue())
+
+    def test_enqueue_only(self):
+        call_command('send_booking_reminders', '--date=2020-01-06', '--enqueue-only', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(MailOutbox.objects.filter(status=MailOutbox.PENDING).count(), 2)
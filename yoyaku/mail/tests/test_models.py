@@ -1,6 +1,15 @@
+from datetime import timedelta
+from smtplib import SMTPException
+from unittest.mock import patch
+
 from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.db import connection as db_connection
+from django.test import override_settings
+from django.utils import timezone
 
-from yoyaku.mail.models import SystemMail
+from yoyaku.mail.models import CompiledMail, MailOutbox, SystemMail
 from yoyaku.tests.factories import BookingFactory, MailAddressFactory
 from yoyaku.tests.test_case import ModelTestCase
 
@@ -33,9 +42,206 @@ class TestSystemMail(ModelTestCase):
         system_mail.sender = MailAddressFactory()
         system_mail.subject = system_mail.content = '__NAME__'
 
-        system_mail.send_system_mail(booking)
+        outbox = system_mail.send_system_mail(booking)
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(outbox.status, MailOutbox.PENDING)
+        self.assertEqual(outbox.from_email, system_mail.sender.email)
+        self.assertEqual(outbox.to, booking.customer.email)
+        self.assertEqual(outbox.subject, booking.customer.username)
+        self.assertEqual(outbox.body, booking.customer.username)
+        self.assertEqual(outbox.get_delivery_key(), (booking.id, system_mail.id, outbox.get_content_hash()))
+        # 保存したオブジェクトを返す
+        self.assertEqual(MailOutbox.objects.get(booking=booking).id, outbox.id)
+
+        # 同じ内容のメールは追加しない
+        self.assertIsNone(system_mail.send_system_mail(booking))
+        self.assertEqual(MailOutbox.objects.filter(booking=booking).count(), 1)
+
+
+class TestCompiledMail(ModelTestCase):
+    def setUp(self):
+        cache.clear()
+        self.booking = BookingFactory()
+        self.system_mail = SystemMail.objects.get_registered_mail()
+        self.system_mail.sender = MailAddressFactory()
+        self.system_mail.subject = '__NAME__様'
+        self.system_mail.content = '__NAME__,__TEL__,__UNKNOWN__,__RESERVATION_DATE__'
+        self.system_mail.save()
+
+    def test_render(self):
+        """モデルを変更せずに置換した件名と本文を返す"""
+        subject, content = CompiledMail(self.system_mail).render(self.booking)
+        customer = self.booking.customer
+        bl = self.booking.booking_limit
+        self.assertEqual(subject, f'{customer.username}様')
+        self.assertEqual(content, f'{customer.username},{customer.phone_number},__UNKNOWN__,{bl.formatted_start_datetime()}')
+        self.assertEqual(self.system_mail.subject, '__NAME__様')
+
+    def test_render_none(self):
+        """置換先がNoneの場合は置換しない"""
+        self.booking.customer.phone_number = None
+        subject, content = CompiledMail(self.system_mail).render(self.booking)
+        self.assertIn(',__TEL__,', content)
+
+    def test_get_compiled(self):
+        """更新日時が変わるまではDBから取得しない"""
+        compiled = SystemMail.objects.get_registered_compiled()
+        with self.assertNumQueries(0):
+            self.assertIs(SystemMail.objects.get_registered_compiled(), compiled)
+
+        self.system_mail.subject = '変更'
+        self.system_mail.save()
+        self.assertEqual(SystemMail.objects.get_registered_compiled().subject, ['変更'])
+
+    def test_get_compiled_stale_stamp(self):
+        """変更前のデータを読み込んだプロセスは、キャッシュの更新日時を古い値で上書きしない"""
+        key = SystemMail.get_cache_key(self.system_mail.id)
+        stale = self.system_mail.updated_at - timedelta(minutes=1)
+        cache.set(key, stale)
+        compiled = SystemMail.objects.get_registered_compiled()
+        self.assertEqual(cache.get(key), compiled.updated_at)
+
+        # 新しい更新日時がキャッシュにある場合は上書きしない
+        newer = self.system_mail.updated_at + timedelta(minutes=1)
+        cache.set(key, newer)
+        SystemMail.objects.get_registered_compiled()
+        self.assertEqual(cache.get(key), newer)
+
+    @override_settings(SYSTEM_MAIL_CACHE_TIMEOUT=30)
+    def test_get_compiled_timeout(self):
+        with patch('yoyaku.mail.models.cache.add', wraps=cache.add) as add:
+            SystemMail.objects.get_registered_compiled()
+        self.assertEqual(add.call_args.args[2], 30)
+
+    def test_get_compiled_sender_changed(self):
+        SystemMail.objects.get_registered_compiled()
+        sender = self.system_mail.sender
+        sender.email = 'changed@example.com'
+        sender.save()
+        self.assertEqual(SystemMail.objects.get_registered_compiled().from_email, 'changed@example.com')
+
+
+class TestMailOutboxManager(ModelTestCase):
+
+    def create_mail(self, **kwargs):
+        return MailOutbox.objects.create(from_email='from@example.com', to='to@example.com', **kwargs)
+
+    def test_deliver(self):
+        mail_list = [self.create_mail(subject=f'件名{i}') for i in range(3)]
+        self.create_mail(next_attempt_at=timezone.now() + timedelta(minutes=1))
+        self.create_mail(status=MailOutbox.SENT)
+
+        with patch('yoyaku.mail.models.get_connection', wraps=get_connection) as mock:
+            self.assertEqual(MailOutbox.objects.deliver(batch_size=2), (2, 0))
+            self.assertEqual(MailOutbox.objects.deliver(batch_size=2), (1, 0))
+            self.assertEqual(MailOutbox.objects.deliver(batch_size=2), (0, 0))
+        # バッチ毎に1つの接続で送信する
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual([m.subject for m in mail.outbox], ['件名0', '件名1', '件名2'])
+        for obj in mail_list:
+            obj.refresh_from_db()
+            self.assertEqual((obj.status, obj.attempts), (MailOutbox.SENT, 1))
+            self.assertIsNotNone(obj.sent_at)
+
+    def test_deliver_outside_transaction(self):
+        """送信中にしてからトランザクションの外で送信し、送信結果を1通ずつ記録する"""
+        obj = self.create_mail()
+        connection = get_connection()
+        # テストケースのトランザクション以外のトランザクション内で送信していないことを確認する
+        savepoints = len(db_connection.savepoint_ids)
+
+        def send_messages(messages):
+            self.assertEqual(len(db_connection.savepoint_ids), savepoints)
+            self.assertEqual(MailOutbox.objects.get(id=obj.id).status, MailOutbox.SENDING)
+            return 1
+
+        with patch.object(connection, 'send_messages', side_effect=send_messages):
+            self.assertEqual(MailOutbox.objects.deliver(connection=connection), (1, 0))
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, MailOutbox.SENT)
+
+    def test_claim(self):
+        """送信中のメールは期限が過ぎるまで他のワーカーが送信しない"""
+        obj = self.create_mail()
+        self.assertEqual(MailOutbox.objects.claim(10, 60), [obj])
+        self.assertEqual(MailOutbox.objects.claim(10, 60), [])
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, MailOutbox.SENDING)
+
+        # 送信中にワーカーが停止した場合は、期限が過ぎてから送信する
+        MailOutbox.objects.filter(id=obj.id).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(MailOutbox.objects.deliver(), (1, 0))
+        obj.refresh_from_db()
+        self.assertEqual((obj.status, obj.attempts), (MailOutbox.SENT, 1))
+
+    def test_send_now_sending(self):
+        """deliver()で送信中のメールはすぐに送信しない"""
+        booking = BookingFactory()
+        obj = MailOutbox.objects.build(from_email='from@example.com', to='to@example.com', booking=booking, system_mail_id=1)
+        MailOutbox.objects.enqueue([obj])
+        MailOutbox.objects.claim(10, 60)
+        mail_obj, success = MailOutbox.objects.send_now(obj)
+        self.assertFalse(success)
+        self.assertEqual(mail_obj.status, MailOutbox.SENDING)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_enqueue(self):
+        """予約・システムメール・内容が同じメールは記録済みの場合や重複している場合に追加しない"""
+        booking = BookingFactory()
+        self.create_mail(booking=booking, system_mail_id=1, content_hash='a', status=MailOutbox.FAILED)
+        mail_list = [
+            MailOutbox.objects.build(from_email='from@example.com', to='to@example.com', booking=booking, system_mail_id=1)
+            for _ in range(2)
+        ]
+        mail_list.append(MailOutbox.objects.build(from_email='from@example.com', to='to@example.com'))
+        mail_list.append(MailOutbox.objects.build(from_email='from@example.com', to='to@example.com'))
+        self.assertEqual(MailOutbox.objects.enqueue(mail_list), 3)
+        self.assertEqual(MailOutbox.objects.filter(booking=booking).count(), 2)
+        self.assertEqual(MailOutbox.objects.filter(booking=None).count(), 2)
+        # 追加できたメールのみidを設定する
+        self.assertIsNotNone(mail_list[0].pk)
+        self.assertIsNone(mail_list[1].pk)
+        self.assertEqual(
+            MailOutbox.objects.enqueue([
+                MailOutbox.objects.build(from_email='from@example.com', to='to@example.com', booking=booking, system_mail_id=1)
+            ]),
+            0,
+        )
+
+    def test_enqueue_conflict(self):
+        """別のプロセスが同時に追加したメールは、追加した件数に含めない"""
+        booking = BookingFactory()
+        mail_obj = MailOutbox.objects.build(from_email='from@example.com', to='to@example.com', booking=booking, system_mail_id=1)
+        self.create_mail(booking=booking, system_mail_id=1, content_hash=mail_obj.content_hash)
+        self.assertEqual(MailOutbox.objects.enqueue([mail_obj]), 0)
+        self.assertIsNone(mail_obj.pk)
+
+    @override_settings(MAIL_OUTBOX_MAX_ATTEMPTS=2, MAIL_OUTBOX_RETRY_SECONDS=60)
+    def test_deliver_retry(self):
+        """送信に失敗した場合は時間を空けて再送信し、上限に達した場合は送信失敗にする"""
+        obj = self.create_mail()
+        ok = self.create_mail()
+        connection = get_connection()
+        with patch.object(connection, 'send_messages', side_effect=[SMTPException('error'), 1]):
+            self.assertEqual(MailOutbox.objects.deliver(connection=connection), (1, 1))
+        obj.refresh_from_db()
+        ok.refresh_from_db()
+        self.assertEqual((obj.status, obj.attempts, obj.last_error), (MailOutbox.PENDING, 1, 'SMTPException: error'))
+        self.assertGreater(obj.next_attempt_at, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(ok.status, MailOutbox.SENT)
+
+        MailOutbox.objects.filter(id=obj.id).update(next_attempt_at=timezone.now())
+        with patch.object(connection, 'send_messages', side_effect=SMTPException('error')):
+            self.assertEqual(MailOutbox.objects.deliver(connection=connection), (0, 1))
+        obj.refresh_from_db()
+        self.assertEqual((obj.status, obj.attempts), (MailOutbox.FAILED, 2))
 
-        self.assertEqual(len(mail.outbox), 1)
-        m = mail.outbox[0]
-        self.assertEqual(m.subject, booking.customer.username)
-        self.assertEqual(m.body, booking.customer.username)
+    def test_deliver_connection_error(self):
+        """接続できない場合は全て再送信する"""
+        obj = self.create_mail()
+        connection = get_connection()
+        with patch.object(connection, 'open', side_effect=OSError('refused')):
+            self.assertEqual(MailOutbox.objects.deliver(connection=connection), (0, 1))
+        obj.refresh_from_db()
+        self.assertEqual((obj.status, obj.attempts), (MailOutbox.PENDING, 1))
@@ -1,6 +1,13 @@
-from yoyaku.mail.models import SystemMail
-from yoyaku.mail.send_mails import send_customer_registered_mail
-from yoyaku.tests.factories import BookingFactory, MailAddressFactory
+from datetime import date, datetime
+
+from django.core import mail
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils.timezone import make_aware
+
+from yoyaku.mail.models import MailOutbox, SystemMail
+from yoyaku.mail.send_mails import send_booking_reminders, send_customer_registered_mail
+from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, MailAddressFactory
 from yoyaku.tests.test_case import ModelTestCase
 
 
@@ -12,5 +19,51 @@ class TestSendMails(ModelTestCase):
 
     def test_send_customer_registered_mail(self):
         booking = BookingFactory()
-        result = send_customer_registered_mail(booking)
+        with self.captureOnCommitCallbacks(execute=True):
+            result = send_customer_registered_mail(booking)
         self.assertTrue(result)
+        # 送信はdeliver_mailコマンドで行う
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(MailOutbox.objects.get(booking=booking).status, MailOutbox.PENDING)
+
+    @override_settings(MAIL_OUTBOX_WORKER=False)
+    def test_send_customer_registered_mail_without_worker(self):
+        """deliver_mailコマンドを実行しない場合はコミット後に送信する"""
+        booking = BookingFactory()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(send_customer_registered_mail(booking))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(MailOutbox.objects.get(booking=booking).status, MailOutbox.SENT)
+
+
+class TestSendBookingReminders(ModelTestCase):
+    def setUp(self):
+        cache.clear()
+        system_mail = SystemMail.objects.get(id=SystemMail.objects.REMINDER_MAIL_ID)
+        system_mail.sender = MailAddressFactory()
+        system_mail.subject = '__NAME__様'
+        system_mail.save()
+        bl = BookingLimitFactory(limit=3, start_datetime=make_aware(datetime(2020, 1, 6, 10)))
+        self.bookings = [BookingFactory(booking_limit=bl) for _ in range(3)]
+        BookingFactory(booking_limit=BookingLimitFactory(start_datetime=make_aware(datetime(2020, 1, 7, 10))))
+
+    def test_send_booking_reminders(self):
+        self.assertEqual(send_booking_reminders(date(2020, 1, 6), chunk_size=2), 3)
+        self.assertEqual(
+            sorted(MailOutbox.objects.values_list('to', 'subject')),
+            sorted((b.customer.email, f'{b.customer.username}様') for b in self.bookings),
+        )
+
+    def test_resume(self):
+        """前回追加済みの予約の次から再開する"""
+        send_booking_reminders(date(2020, 1, 6), chunk_size=2)
+        booking = BookingFactory(booking_limit=BookingLimitFactory(start_datetime=make_aware(datetime(2020, 1, 6, 11))))
+        self.assertEqual(send_booking_reminders(date(2020, 1, 6), resume=True), 1)
+        self.assertEqual(MailOutbox.objects.filter(to=booking.customer.email).count(), 1)
+        self.assertEqual(send_booking_reminders(date(2020, 1, 6), resume=True), 0)
+
+    def test_rerun(self):
+        """再実行しても、同じ内容のメールは追加しない"""
+        send_booking_reminders(date(2020, 1, 6))
+        self.assertEqual(send_booking_reminders(date(2020, 1, 6)), 0)
+        self.assertEqual(MailOutbox.objects.count(), 3)
@@ -1,11 +1,15 @@
+from datetime import datetime
+from smtplib import SMTPException
 from unittest.mock import patch
 
 from django.core import mail
+from django.core.cache import cache
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.timezone import make_aware
 
 from yoyaku.mail.forms import AddressCreateUpdateForm, SendMailForm
-from yoyaku.mail.models import MailAddress, SystemMail
+from yoyaku.mail.models import MailAddress, MailOutbox, SystemMail
 from yoyaku.tests.factories import BookingFactory, BookingLimitFactory, MailAddressFactory, SystemMailFactory
 from yoyaku.tests.test_case import AuthViewTestCase
 
@@ -74,6 +78,36 @@ class TestSystemMailUpdateView(AuthViewTestCase):
         self.assertEqual(res.status_code, 404)
 
 
+class TestSendReminders(AuthViewTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.login()
+        self.viewname = 'mail:予約日時通知メール送信'
+        SystemMail.objects.filter(id=SystemMail.objects.REMINDER_MAIL_ID).update(sender=MailAddressFactory())
+
+    def test_post(self):
+        bl = BookingLimitFactory(limit=1, start_datetime=make_aware(datetime(2020, 1, 6, 10)))
+        booking = BookingFactory(booking_limit=bl)
+        res = self.client.post(reverse(self.viewname), {'target_date': '2020-01-06'})
+        self.assertRedirects(res, reverse('mail:システムメール一覧'))
+        self.assertEqual(list(MailOutbox.objects.values_list('to', flat=True)), [booking.customer.email])
+
+    def test_post_invalid_date(self):
+        """対象日が正しくない場合は送信待ちに追加しない"""
+        BookingFactory(booking_limit=BookingLimitFactory(start_datetime=make_aware(datetime(2020, 1, 6, 10))))
+        for data in ({}, {'target_date': ''}, {'target_date': '2020-13-01'}):
+            with self.subTest(data=data):
+                res = self.client.post(reverse(self.viewname), data, follow=True)
+                self.assertRedirects(res, reverse('mail:システムメール一覧'))
+                self.assertContains(res, '対象日が正しくないため')
+        self.assertFalse(MailOutbox.objects.exists())
+
+    def test_get_not_allowed(self):
+        res = self.client.get(reverse(self.viewname))
+        self.assertEqual(res.status_code, 405)
+
+
 class TestEditMailView(AuthViewTestCase):
     def setUp(self):
         self.login()
@@ -111,7 +145,10 @@ class TestEditMailView(AuthViewTestCase):
         )
         self.assertEqual(res.status_code, 200)
         self.assertTemplateUsed(res, 'mail/send_confirm.html')
-        self.assertEqual(list(res.context['object'].keys()), ['sender', 'to', 'subject', 'content'])
+        self.assertEqual(
+            list(res.context['object'].keys()), ['sender', 'to', 'subject', 'content', 'booking_id', 'system_mail_id']
+        )
+        self.assertContains(res, f'name="booking_id" value="{self.booking.id}"')
 
 
 class TestSendTestMailView(AuthViewTestCase):
@@ -156,8 +193,8 @@ class TestSendMail(AuthViewTestCase):
         self.assertEqual(m.subject, 'subject')
         self.assertEqual(m.body, 'content')
 
-    @patch('yoyaku.mail.views.send_mail', return_value=0)
-    def test_send_mail_failed(self, send_mail):
+    @patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=SMTPException('error'))
+    def test_send_mail_failed(self, send_messages):
         data = {
             'sender': 'from@example.com',
             'to': 'to@example.com',
@@ -167,6 +204,46 @@ class TestSendMail(AuthViewTestCase):
         res = self.client.post(reverse(self.viewname), data)
         self.assertEqual(res.content.decode('utf-8'), '{"msg": "メールを送信できませんでした。"}')
         self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(MailOutbox.objects.get().last_error, 'SMTPException: error')
+
+    def test_send_booking_mail_once(self):
+        """予約へのシステムメールは、同じ内容のメールを送信済みの場合は送信しない"""
+        booking = BookingFactory()
+        data = {
+            'sender': 'from@example.com',
+            'to': booking.customer.email,
+            'subject': 'subject',
+            'content': 'content',
+            'booking_id': booking.id,
+            'system_mail_id': 1,
+        }
+        self.client.post(reverse(self.viewname), data)
+        res = self.client.post(reverse(self.viewname), data)
+        self.assertEqual(res.content.decode('utf-8'), '{"msg": "同じ内容のメールを送信済みのため、送信しませんでした。"}')
+        self.assertEqual(len(mail.outbox), 1)
+
+        data['content'] = 'changed'
+        self.client.post(reverse(self.viewname), data)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(MailOutbox.objects.filter(booking=booking, status=MailOutbox.SENT).count(), 2)
+
+    def test_resend_booking_mail(self):
+        """再送信を指定した場合は、送信済みでも送信し直す"""
+        booking = BookingFactory()
+        data = {
+            'sender': 'from@example.com',
+            'to': booking.customer.email,
+            'subject': 'subject',
+            'content': 'content',
+            'booking_id': booking.id,
+            'system_mail_id': 1,
+        }
+        self.client.post(reverse(self.viewname), data)
+        res = self.client.post(reverse(self.viewname), {**data, 'resend': '1'})
+        self.assertEqual(res.content.decode('utf-8'), '{"msg": "メールを送信しました。"}')
+        self.assertEqual(len(mail.outbox), 2)
+        obj = MailOutbox.objects.get(booking=booking)
+        self.assertEqual((obj.status, obj.attempts), (MailOutbox.SENT, 2))
 
 
 class TestMailAddressListView(AuthViewTestCase):
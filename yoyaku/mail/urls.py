@@ -15,4 +15,5 @@ urlpatterns = [
     path('edit/<int:pk>/<int:booking_id>', views.EditMailView.as_view(), name='メール編集'),
     path('send_testmail/<int:pk>', views.SendTestMailView.as_view(), name='テストメール送信'),
     path('send_mail', views.send_system_mail, name='メール送信'),
+    path('send_reminders', views.send_reminders, name='予約日時通知メール送信'),
 ]
@@ -1,10 +1,12 @@
+from datetime import date, timedelta
+
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.core.mail import send_mail
 from django.http import Http404, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
+from django.utils.timezone import localdate
 from django.views.decorators.http import require_POST
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
@@ -12,7 +14,8 @@ from django.views.generic.list import ListView
 
 from yoyaku.booking.models import Booking
 from yoyaku.mail.forms import AddressCreateUpdateForm, SendMailForm, SystemMailUpdateForm
-from yoyaku.mail.models import MailAddress, MailTag, SystemMail
+from yoyaku.mail.models import MailAddress, MailOutbox, MailTag, SystemMail
+from yoyaku.mail.send_mails import send_booking_reminders
 
 
 class SystemMailMixin:
@@ -30,6 +33,12 @@ class SystemMailListView(SystemMailMixin, ListView):
                 .select_related('sender')
                 .values('id', 'name', 'subject', 'content', 'sender__email'))
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['reminder_mail_id'] = SystemMail.objects.REMINDER_MAIL_ID
+        context['reminder_date'] = localdate() + timedelta(days=1)
+        return context
+
 
 @method_decorator(login_required, name='dispatch')
 class SystemMailUpdateView(SystemMailMixin, UpdateView):
@@ -74,6 +83,8 @@ class EditMailView(UpdateView):
                 'to': booking.customer.email,
                 'subject': form.cleaned_data['subject'],
                 'content': form.cleaned_data['content'],
+                'booking_id': booking.id,
+                'system_mail_id': self.object.id,
             }
         }
         return render(self.request, 'mail/send_confirm.html', context)
@@ -94,17 +105,45 @@ class SendTestMailView(DetailView):
 @login_required()
 @require_POST
 def send_system_mail(request):
-    """メールを送信し、結果をjson形式で返す"""
-    # send_mail()は送信に成功したメッセージの数を返す。
-    success = send_mail(
-        request.POST['subject'],
-        request.POST['content'],
-        request.POST['sender'],
-        [request.POST['to']],
-        fail_silently=True,
+    """
+    メールを送信し、結果をjson形式で返す。送信結果を記録する。
+    予約へのシステムメールは、同じ内容のメールを送信済みの場合は送信しない。resendを指定した場合は送信し直す。
+    """
+    try:
+        booking_id = int(request.POST.get('booking_id') or 0) or None
+        system_mail_id = int(request.POST.get('system_mail_id') or 0) or None
+    except ValueError:
+        booking_id = system_mail_id = None
+    mail = MailOutbox.objects.build(
+        from_email=request.POST['sender'],
+        to=request.POST['to'],
+        subject=request.POST['subject'],
+        body=request.POST['content'],
+        booking_id=booking_id,
+        system_mail_id=system_mail_id if booking_id else None,
     )
-    params = {'msg': 'メールを送信しました。' if success else 'メールを送信できませんでした。'}
-    return JsonResponse(params, json_dumps_params={'ensure_ascii': False})
+    mail, success = MailOutbox.objects.send_now(mail, resend=bool(request.POST.get('resend')))
+    if success:
+        msg = 'メールを送信しました。'
+    elif mail.status == MailOutbox.SENT:
+        msg = '同じ内容のメールを送信済みのため、送信しませんでした。'
+    else:
+        msg = 'メールを送信できませんでした。'
+    return JsonResponse({'msg': msg}, json_dumps_params={'ensure_ascii': False})
+
+
+@login_required()
+@require_POST
+def send_reminders(request):
+    """対象日に予約がある顧客への予約日時通知メールを送信待ちに追加する。送信はdeliver_mailコマンドで行う"""
+    try:
+        target_date = date.fromisoformat(request.POST['target_date'])
+    except (KeyError, ValueError):
+        messages.error(request, '対象日が正しくないため、予約日時通知メールを送信待ちに追加しませんでした。')
+        return HttpResponseRedirect(reverse_lazy('mail:システムメール一覧'))
+    count = send_booking_reminders(target_date)
+    messages.info(request, f'{target_date} の予約 {count} 件の予約日時通知メールを送信待ちに追加しました。')
+    return HttpResponseRedirect(reverse_lazy('mail:システムメール一覧'))
 
 
 class MailAddressMixin: